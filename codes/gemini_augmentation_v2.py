@@ -1,7 +1,14 @@
 import cv2
+import copy
+import math
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import os
+import threading
 
 AUG = {
     'eda': A.Compose([
@@ -204,98 +211,967 @@ AUG = {
     ]),
 }
 
-def get_augmentation(cfg, epoch=0):
-    common_resize_transform = A.Compose([
+### Grayscale
+class GrayISONoise(A.ImageOnlyTransform):
+    """1채널 이미지용 ISONoise : albumentations ISONoise의 luminance(poisson) noise만 적용한다. (1채널에는 hue가 없다.)"""
+    def __init__(self, color_shift=(0.01, 0.05), intensity=(0.1, 0.5), p=0.5):
+        super().__init__(p=p)
+        self.color_shift = color_shift
+        self.intensity = intensity
+
+    def get_params(self):
+        return {'intensity': self.py_random.uniform(*self.intensity)}
+
+    def apply(self, img, intensity=0.1, **params):
+        lightness = img.astype(np.float32) / 255
+        noise = self.random_generator.poisson(lightness.std() * intensity, size=lightness.shape)
+        lightness += noise * intensity * (1.0 - lightness)
+        return np.rint(np.clip(lightness, 0, 1) * 255).astype(np.uint8)
+
+    def get_transform_init_args_names(self):
+        return ('color_shift', 'intensity')
+
+def map_policy(transform, fn):
+    """Compose/OneOf 구조는 유지하고, 모든 leaf 변환을 fn(leaf)로 바꾼 새 파이프라인을 만든다."""
+    if isinstance(transform, (A.Compose, A.OneOf)):
+        return type(transform)([map_policy(t, fn) for t in transform.transforms], p=transform.p)
+    return fn(transform)
+
+def to_grayscale(transform):
+    """RGB용 leaf 변환을 1채널 이미지에서 동작하는 같은 변환으로 바꾼다. (3채널 fill -> 1채널, ISONoise -> GrayISONoise)"""
+    args = transform.get_transform_init_args()
+    if isinstance(transform, A.ISONoise):
+        return GrayISONoise(**args)
+    fill = args.get('fill')
+    if isinstance(fill, (tuple, list)):
+        return type(transform)(**{**args, 'fill': float(np.mean(fill))})
+    return transform
+
+# AUG와 동일한 policy의 1채널 버전 (cfg.grayscale)
+GRAY_AUG = {name: map_policy(aug, to_grayscale) for name, aug in AUG.items()}
+
+def get_policy(cfg, name):
+    """cfg.grayscale에 맞는 AUG policy"""
+    return GRAY_AUG[name] if getattr(cfg, 'grayscale', False) else AUG[name]
+
+def get_norm_stats(cfg):
+    """Normalize mean, std : grayscale이면 채널 평균 1개"""
+    if getattr(cfg, 'grayscale', False):
+        return [float(np.mean(cfg.norm_mean))], [float(np.mean(cfg.norm_std))]
+    return cfg.norm_mean, cfg.norm_std
+
+### Aspect ratio bucket
+class BucketResize(A.ImageOnlyTransform):
+    """종횡비를 유지하며 bucket (h, w) 직사각형 안에 맞추고, 남는 부분은 fill로 채운다. (LongestMaxSize + PadIfNeeded의 직사각형 버전)
+
+    bucket은 transform(image=img, bucket=(h, w))로 sample마다 넘겨받고, 없으면 size 정사각형을 사용한다.
+    (ImageDataset.buckets, gemini_utils_v2.assign_aspect_buckets 참고)
+
+    :param int size: bucket이 없을 때의 정사각형 크기
+    :param fill: padding 색, defaults to 0
+    :param float scale: bucket 크기에 곱할 배율 (progressive resizing), defaults to 1.0
+    :param bool pad: False이면 bucket 안에 맞추기만 하고 padding하지 않는다. (resize_first), defaults to True
+    """
+    def __init__(self, size, fill=0, scale=1.0, pad=True, p=1.0):
+        super().__init__(p=p)
+        self.size = size
+        self.fill = fill
+        self.scale = scale
+        self.pad = pad
+
+    def get_params_dependent_on_data(self, params, data):
+        bucket = data.get('bucket')
+        if bucket is None:
+            return {'bucket': (self.size, self.size)}
+        return {'bucket': tuple(max(1, round(int(s) * self.scale)) for s in bucket)}
+
+    def apply(self, img, bucket=None, **params):
+        (h, w), (ih, iw) = bucket, img.shape[:2]
+        scale = min(h / ih, w / iw)
+        nh, nw = min(h, max(1, round(ih * scale))), min(w, max(1, round(iw * scale)))
+        channels = img.shape[2] if img.ndim == 3 else 1
+        img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        if not self.pad:
+            return img.reshape(nh, nw, channels)
+        top, left = (h - nh) // 2, (w - nw) // 2
+        img = cv2.copyMakeBorder(img, top, h - nh - top, left, w - nw - left, cv2.BORDER_CONSTANT, value=self.fill)
+        return img.reshape(h, w, channels) # cv2는 1채널 축을 없앤다.
+
+    def get_transform_init_args_names(self):
+        return ('size', 'fill', 'scale', 'pad')
+
+def get_resize(cfg, fill, size=None):
+    """종횡비를 유지하며 size 정사각형(aspect_buckets 사용 시 sample별 bucket 직사각형)으로 맞추는 변환 목록
+
+    :param cfg: 설정 namespace
+    :param fill: padding 색
+    :param int size: 해상도, defaults to cfg.image_size (bucket은 size / image_size 배율로 줄어든다.)
+    """
+    size = size or cfg.image_size
+    if (getattr(cfg, 'aspect_buckets', None) or {}).get('enabled', False):
+        return [BucketResize(size, fill=fill, scale=size / cfg.image_size)]
+    return [
         # 긴 변을 기준으로 종횡비를 유지하며 resize
-        A.LongestMaxSize(max_size=cfg.image_size),
-        # cfg.image_size 정사각형으로 만들고, 여백은 흰색으로 채움.
-        A.PadIfNeeded(min_height=cfg.image_size, min_width=cfg.image_size, border_mode=cv2.BORDER_CONSTANT, fill=(255, 255, 255), p=1.0),
-        A.Normalize(mean=cfg.norm_mean, std=cfg.norm_std),
-        ToTensorV2(),
-    ])
+        A.LongestMaxSize(max_size=size),
+        # size 정사각형으로 만들고, 여백은 흰색으로 채움.
+        A.PadIfNeeded(min_height=size, min_width=size, border_mode=cv2.BORDER_CONSTANT, fill=fill, p=1.0),
+    ]
 
-    # epoch에 따라 동적으로 변환하는 증강 기법
-    if cfg.dynamic_augmentation['enabled']:
-        
-        weak_policy = cfg.dynamic_augmentation['policies']['weak']
-        middle_policy = cfg.dynamic_augmentation['policies']['middle']
-        strong_policy = cfg.dynamic_augmentation['policies']['strong']
-
-        if epoch < weak_policy['end_epoch']:
-            print("⚙️ Using weak_policy augmentation...")
-            active_augs = [AUG[aug] for aug in weak_policy['augs']]
-        elif epoch < middle_policy['end_epoch']:
-            print("⚙️ Using middle_policy augmentation...")
-            active_augs = [AUG[aug] for aug in middle_policy['augs']]
-        elif epoch < strong_policy['end_epoch']:
-            print("⚙️ Using strong_policy augmentation...")
-            active_augs = [AUG[aug] for aug in strong_policy['augs']]
-        else:
-            active_augs = [AUG[aug] for aug in strong_policy['augs']]
+### Resize-first augmentation
+def _scale_ints(values, factor, low=1):
+    return tuple(max(low, int(round(v * factor))) for v in values)
+
+def _scale_odds(values, factor):
+    # blur kernel은 3 이상의 홀수
+    return tuple(max(3, int(round(v * factor))) | 1 for v in values)
+
+def rescale_transform(transform, factor):
+    """pixel 단위 parameter를 factor배 해상도에서 같은 효과가 나도록 바꾼 leaf 변환 (map_policy용)
+
+    - Morphological scale, Blur/MotionBlur/MedianBlur blur_limit, GaussianBlur blur_limit/sigma_limit, CoarseDropout hole 크기(pixel) : factor배
+    - GaussNoise std, ISONoise color_shift/intensity : pixel별 독립 noise는 area 축소 시 표준편차가 factor배로 줄어들므로 factor배
+    - Affine, Perspective, GridDistortion 등 비율 단위 parameter와 색 변환은 해상도와 무관하므로 그대로 둔다.
+    """
+    args = transform.get_transform_init_args()
+    if isinstance(transform, A.Morphological):
+        args['scale'] = _scale_ints(args['scale'], factor)
+    elif isinstance(transform, A.GaussianBlur):
+        if all(args['blur_limit']): # (0, 0)이면 sigma로 kernel 크기를 정한다.
+            args['blur_limit'] = _scale_odds(args['blur_limit'], factor)
+        args['sigma_limit'] = tuple(v * factor for v in args['sigma_limit'])
+    elif isinstance(transform, A.Blur): # MotionBlur, MedianBlur 포함
+        args['blur_limit'] = _scale_odds(args['blur_limit'], factor)
+    elif isinstance(transform, A.CoarseDropout):
+        for key in ['hole_height_range', 'hole_width_range']:
+            if all(isinstance(v, int) for v in args[key]): # float는 이미지 크기에 대한 비율
+                args[key] = _scale_ints(args[key], factor)
+    elif isinstance(transform, A.GaussNoise):
+        args['std_range'] = tuple(v * factor for v in args['std_range'])
+    elif isinstance(transform, (A.ISONoise, GrayISONoise)):
+        args['color_shift'] = tuple(v * factor for v in args['color_shift'])
+        args['intensity'] = tuple(v * factor for v in args['intensity'])
     else:
-        active_augs = [AUG[aug] for aug, active in cfg.augmentation.items() if active and aug in AUG]
+        return transform
+    return type(transform)(**args)
+
+def get_prefit(cfg, size=None):
+    """resize_first에서 증강 전에 적용하는 축소 : 종횡비를 유지하며 size(또는 bucket) 안에 맞추고 padding은 하지 않는다."""
+    size = size or cfg.image_size
+    if (getattr(cfg, 'aspect_buckets', None) or {}).get('enabled', False):
+        return [BucketResize(size, scale=size / cfg.image_size, pad=False)]
+    return [A.LongestMaxSize(max_size=size)]
+
+class ResizeFirst:
+    """먼저 학습 해상도로 줄인 뒤 증강하는 transform (cfg.resize_first)
+
+    원본 scan 위에서 증강하고 LongestMaxSize로 버리는 대신, 줄어든 이미지 위에서 증강해 sample당 연산량을 픽셀 수만큼 줄인다.
+    증강은 sample의 실제 축소 배율에 맞게 rescale_transform()으로 바꾼 policy를 사용한다.
+    배율은 2^(1/2) 단계로 양자화해서, 배율별 policy를 (worker마다) 한 번만 만든다.
+
+    :param list prefit: get_prefit() 변환 목록
+    :param augment: 원본 해상도 기준 증강 (A.OneOf, A.Compose)
+    :param post: 나머지 resize/pad, Normalize, ToTensorV2
+    """
+    def __init__(self, prefit, augment, post):
+        self.prefit = A.Compose(prefit)
+        self.augment = augment
+        self.post = post
+        self.rescaled = {} # 양자화된 log2(배율) -> policy
+
+    def _augment_at(self, factor):
+        level = round(math.log2(factor) * 2) / 2
+        if level == 0:
+            return self.augment
+        if level not in self.rescaled:
+            self.rescaled[level] = map_policy(self.augment, lambda t: rescale_transform(t, 2 ** level))
+        return self.rescaled[level]
+
+    def __call__(self, **data):
+        before = max(data['image'].shape[:2])
+        data = self.prefit(**data)
+        augment = self._augment_at(max(data['image'].shape[:2]) / before)
+        return self.post(**augment(**data))
+
+def compose_augmentation(cfg, augment, resize, size=None):
+    """augment -> resize 파이프라인, cfg.resize_first이면 축소 -> (rescale된) augment -> resize 순서로 적용한다.
+
+    :param augment: 증강 (A.OneOf, A.Compose)
+    :param resize: resize/pad, Normalize, ToTensorV2 변환
+    :param int size: 학습 해상도, defaults to cfg.image_size
+    """
+    if getattr(cfg, 'resize_first', False):
+        return ResizeFirst(get_prefit(cfg, size), augment, resize)
+    return A.Compose([augment, resize])
+
+### Progressive resizing
+def get_image_size(cfg, epoch=0):
+    """epoch의 train 해상도 : progressive_resizing['schedule']에서 epoch까지 시작한 마지막 단계의 크기, 사용하지 않으면 image_size"""
+    resizing = getattr(cfg, 'progressive_resizing', None)
+    if not resizing or not resizing['enabled']:
+        return cfg.image_size
+    schedule = sorted(resizing['schedule'])
+    size = schedule[0][1] # 첫 단계 이전 epoch도 첫 단계 크기로 학습한다.
+    for start_epoch, stage_size in schedule:
+        if epoch >= start_epoch:
+            size = stage_size
+    return size
+
+def get_batch_size(cfg, epoch=0):
+    """epoch의 train batch 크기 : scale_batch이면 batch당 픽셀 수가 image_size 기준과 같도록 batch_size를 키운다."""
+    resizing = getattr(cfg, 'progressive_resizing', None)
+    if not resizing or not resizing['enabled'] or not resizing['scale_batch']:
+        return cfg.batch_size
+    return max(1, int(cfg.batch_size * (cfg.image_size / get_image_size(cfg, epoch)) ** 2))
+
+def use_uint8_transfer(cfg):
+    """device_transfer['uint8'] : loader는 uint8 (H, W, C) batch를 내고, Normalize는 학습 device에서 한다. (DeviceTransfer)"""
+    return (getattr(cfg, 'device_transfer', None) or {}).get('uint8', False)
+
+def get_augmentation_engine(cfg):
+    """train 증강을 적용할 엔진 : 'albumentations'(worker에서 sample 단위) 또는 'tensor'(학습 device에서 batch 단위)"""
+    return getattr(cfg, 'augmentation_engine', 'albumentations')
+
+def get_phase(cfg, epoch=0):
+    """dynamic augmentation 단계 : 'weak', 'middle', 'strong', dynamic augmentation을 사용하지 않으면 None"""
+    if not cfg.dynamic_augmentation['enabled']:
+        return None
+    policies = cfg.dynamic_augmentation['policies']
+    for phase in ['weak', 'middle']:
+        if epoch < policies[phase]['end_epoch']:
+            return phase
+    return 'strong' # strong end_epoch 이후에도 strong을 유지한다.
+
+def get_active_policies(cfg, epoch=0, verbose=True):
+    """epoch에 적용할 AUG policy 이름 목록
+
+    :param cfg: 설정 namespace
+    :param int epoch: 현재 epoch, defaults to 0
+    :param bool verbose: dynamic augmentation 단계 출력 여부, defaults to True
+    :return list: AUG의 key 목록
+    """
+    # epoch에 따라 동적으로 변환하는 증강 기법
+    phase = get_phase(cfg, epoch)
+    if phase is not None:
+        if verbose: print(f"⚙️ Using {phase}_policy augmentation...")
+        return [aug for aug in cfg.dynamic_augmentation['policies'][phase]['augs']]
+    return [aug for aug, active in cfg.augmentation.items() if active and aug in AUG]
+
+def get_augmentation(cfg, epoch=0, verbose=True):
+    white = 255 if getattr(cfg, 'grayscale', False) else (255, 255, 255)
+    norm_mean, norm_std = get_norm_stats(cfg)
+    uint8_transfer = use_uint8_transfer(cfg)
+    def resize_transform(size, on_device=uint8_transfer):
+        if on_device: # uint8 (H, W, C) 그대로 반환하고, Normalize는 DeviceTransfer가 학습 device에서 한다.
+            return A.Compose(get_resize(cfg, white, size))
+        return A.Compose([
+            *get_resize(cfg, white, size),
+            A.Normalize(mean=norm_mean, std=norm_std),
+            ToTensorV2(),
+        ])
+    common_resize_transform = resize_transform(cfg.image_size)
+    # progressive resizing : train 증강만 epoch의 해상도로 resize한다. (validation/test는 항상 image_size)
+    train_resize_transform = resize_transform(get_image_size(cfg, epoch))
+    # tta_predict는 sample을 바로 모델에 넣으므로, TTA transform은 항상 worker에서 Normalize한다.
+    tta_resize_transform = resize_transform(cfg.image_size, on_device=False)
 
     train_transforms = []
-    active_augs = [AUG[aug] for aug, active in cfg.augmentation.items() if active and aug in AUG]
+    active_augs = [get_policy(cfg, aug) for aug in get_active_policies(cfg, epoch, verbose)]
 
-    if cfg.online_augmentation:
+    # augmentation_engine이 tensor인 경우, worker는 resize만 수행하고 증강은 TrainModule에서 batch 단위로 적용한다.
+    # (get_batch_augmentation 참고)
+    if get_augmentation_engine(cfg) == 'tensor':
+        train_transforms.append(A.Compose([
+            *get_resize(cfg, white, get_image_size(cfg, epoch)),
+            *([] if uint8_transfer else [ToTensorV2()]), # uint8 (C, H, W), uint8_transfer이면 (H, W, C)
+        ]))
+    elif cfg.online_augmentation:
         # online augmentation 학습 : 실시간으로 증강 기법을 적용하여, 더 다양한 증강 형태의 데이터를 학습할 수 있다.
         # 장점 : 무한한 다양성, 과적합 방지 효과 증대, 저장 공간 효율성
         # 단점 : 전처리 과정의 증가로 학습 시간 증가, 재현성이 떨어짐. 너무 많은 증강 기법을 적용하면, 의도치 않은 결과가 나올 수 있다.
         if active_augs:
-            online_transform = A.Compose([
+            online_transform = compose_augmentation(
+                cfg,
                 A.OneOf(active_augs, p=0.85), # 85% 확률로 active_augs에 설정된 증강 기법들이 적용된다. 15% 확률로 원본 train 데이터를 사용한다.
-                common_resize_transform # Resize 기법은 항상 동일하게.
-            ])
+                train_resize_transform, # Resize 기법은 항상 동일하게.
+                get_image_size(cfg, epoch)
+            )
             train_transforms.append(online_transform)
         else: # 따로 지정한 증강 기법이 없는 경우, Resize 기법만 사용
-            train_transforms.append(common_resize_transform)
+            train_transforms.append(train_resize_transform)
     else:
         # offline augmentation 학습 : 개별적으로 dataset을 만들어 ConcatDataset을 최종 생성한다. 모든 증강 기법을 적용 가능하고, 마치 데이터셋 개수 자체가 늘어난 것 같은 효과를 준다. (원래라면, 증강한 데이터를 저장해야 하지만 이건 생략.)
         # 단점 : 다양성 제한
         if active_augs:
             for aug_pipeline in active_augs: # 각각의 aug를 transform_func으로 만든다.
-                train_transforms.append(A.Compose([aug_pipeline, common_resize_transform]))
+                train_transforms.append(compose_augmentation(cfg, aug_pipeline, train_resize_transform, get_image_size(cfg, epoch)))
         else:
-            train_transforms.append(common_resize_transform)
+            train_transforms.append(train_resize_transform)
 
     # validation 증강은 기본 증강만 사용한다.
     val_transform = common_resize_transform
 
     # Validation transform with 'eda' augmentation to simulate test conditions
     # tta_transform은 TTA에서도 사용할 증강이다.
-    val_tta_transform = A.Compose([
-        AUG['eda'],
-        common_resize_transform
-    ])
+    val_tta_transform = compose_augmentation(cfg, get_policy(cfg, 'eda'), tta_resize_transform)
     test_tta_transform = A.Compose([
         # inference time transform은 해당 코드에서 직접 구현.
-        common_resize_transform
+        tta_resize_transform
     ])
 
 
     return train_transforms, val_transform, val_tta_transform, test_tta_transform
 
+### Batch(tensor) augmentation
+# AUG의 albumentations 파이프라인과 같은 증강을 collate된 batch 전체에 한 번에 적용한다.
+# 모든 연산은 float32 (B, C, H, W), [0, 255] 범위에서 sample별 random parameter를 vector로 뽑아 수행한다.
+# worker에서는 resize/pad만 하므로, 증강은 image_size 정사각형(aspect_buckets 사용 시 bucket 직사각형) 이미지 위에서 적용된다.
+def _uniform(value_range, n, device):
+    low, high = value_range
+    return torch.empty(n, device=device).uniform_(float(low), float(high))
+
+def _randint(value_range, n, device):
+    low, high = value_range
+    return torch.randint(int(low), int(high) + 1, (n,), device=device)
+
+def _odd_randint(value_range, n, device):
+    """value_range 안의 홀수 커널 크기"""
+    low, high = int(value_range[0]), int(value_range[1])
+    choices = torch.arange(low | 1, high + 1, 2, device=device)
+    return choices[torch.randint(len(choices), (n,), device=device)]
+
+def _xy(value):
+    """albumentations의 {'x': range, 'y': range} 인자를 (x_range, y_range)로"""
+    if isinstance(value, dict):
+        return value['x'], value['y']
+    return value, value
+
+def _fill_tensor(fill, x):
+    fill = torch.as_tensor(fill if fill is not None else 0, dtype=x.dtype, device=x.device).flatten()
+    return fill[:x.shape[1]].view(1, -1, 1, 1) if fill.numel() > 1 else fill.view(1, 1, 1, 1)
+
+def _warp(x, grid, fill=0, mode='bilinear'):
+    """grid_sample로 warp하고, 이미지 바깥 영역은 fill 값으로 채운다."""
+    fill = _fill_tensor(fill, x)
+    return F.grid_sample(x - fill, grid, mode=mode, padding_mode='zeros', align_corners=False) + fill
+
+def _base_grid(n, h, w, device):
+    """align_corners=False 기준 정규화 좌표 (n, h, w, 2)"""
+    ys = (torch.arange(h, device=device) * 2 + 1) / h - 1
+    xs = (torch.arange(w, device=device) * 2 + 1) / w - 1
+    grid = torch.stack(torch.meshgrid(xs, ys, indexing='xy'), dim=-1)
+    return grid.unsqueeze(0).expand(n, h, w, 2)
+
+def _luminance(x):
+    if x.shape[1] != 3:
+        return x.mean(1)
+    return 0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]
+
+def _depthwise_conv(x, kernels):
+    """sample별 커널 (B, kh, kw)로 channel마다 convolution (reflect padding)"""
+    b, c, h, w = x.shape
+    kh, kw = kernels.shape[-2:]
+    weight = kernels.repeat_interleave(c, dim=0).unsqueeze(1) # (B*C, 1, kh, kw)
+    y = F.pad(x.reshape(1, b * c, h, w), (kw // 2, kw // 2, kh // 2, kh // 2), mode='reflect')
+    return F.conv2d(y, weight, groups=b * c).view(b, c, h, w)
+
+def _separable_blur(x, kernels):
+    """sample별 1D 커널 (B, K)로 가로/세로 blur"""
+    x = _depthwise_conv(x, kernels.unsqueeze(1))
+    return _depthwise_conv(x, kernels.unsqueeze(2))
+
+class BatchTransform:
+    """batch 증강의 기본 클래스 : sample마다 확률 p로 apply()를 적용한다.
+
+    albumentations 변환의 init 인자를 그대로 받고, 사용하지 않는 인자(border_mode, interpolation 등)는 무시한다.
+    """
+    def __init__(self, p=0.5, **kwargs):
+        self.p = p
+
+    def __call__(self, x):
+        mask = torch.rand(x.shape[0], device=x.device) < self.p
+        if not mask.any():
+            return x
+        if mask.all():
+            return self.apply(x).clamp_(0, 255)
+        x[mask] = self.apply(x[mask]).clamp_(0, 255)
+        return x
+
+    def apply(self, x):
+        raise NotImplementedError
+
+class BatchCompose(BatchTransform):
+    def __init__(self, transforms, p=1.0):
+        super().__init__(p=p)
+        self.transforms = transforms
+
+    def apply(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+class BatchOneOf(BatchTransform):
+    """sample마다 transforms 중 하나를 (각 transform의 p에 비례하는 확률로) 골라 적용한다."""
+    def __init__(self, transforms, p=0.5):
+        super().__init__(p=p)
+        self.transforms = transforms
+        self.weights = torch.tensor([t.p for t in transforms], dtype=torch.float32)
+
+    def apply(self, x):
+        choice = torch.multinomial(self.weights.to(x.device), x.shape[0], replacement=True)
+        for i, t in enumerate(self.transforms):
+            selected = choice == i
+            if selected.any():
+                x[selected] = t.apply(x[selected]).clamp_(0, 255)
+        return x
+
+class BatchHorizontalFlip(BatchTransform):
+    def apply(self, x):
+        return x.flip(-1)
+
+class BatchVerticalFlip(BatchTransform):
+    def apply(self, x):
+        return x.flip(-2)
+
+class BatchTranspose(BatchTransform):
+    def apply(self, x):
+        h, w = x.shape[-2:]
+        x = x.transpose(-1, -2)
+        if h == w:
+            return x
+        # aspect ratio bucket 직사각형 batch : 전치한 (w, h) 이미지를 종횡비를 유지하며 (h, w) 안에 맞추고 흰색으로 채운다.
+        scale = min(h, w) / max(h, w)
+        nh, nw = max(1, round(w * scale)), max(1, round(h * scale))
+        x = F.interpolate(x, size=(nh, nw), mode='bilinear', align_corners=False, antialias=True)
+        top, left = (h - nh) // 2, (w - nw) // 2
+        return F.pad(x, (left, w - nw - left, top, h - nh - top), value=255.)
+
+class BatchAffine(BatchTransform):
+    """scale, translate, rotate, shear를 sample별 affine matrix로 만들어 affine_grid 한 번으로 적용한다."""
+    def __init__(self, scale=(1.0, 1.0), translate_percent=(0.0, 0.0), rotate=(0.0, 0.0), shear=(0.0, 0.0), fill=0, p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.scale = _xy(scale)
+        self.translate = _xy(translate_percent if translate_percent is not None else (0.0, 0.0))
+        self.rotate = rotate
+        self.shear = _xy(shear)
+        self.fill = fill
+
+    def apply(self, x):
+        b, _, h, w = x.shape
+        dev = x.device
+        sx, sy = _uniform(self.scale[0], b, dev), _uniform(self.scale[1], b, dev)
+        tx, ty = _uniform(self.translate[0], b, dev) * w, _uniform(self.translate[1], b, dev) * h
+        angle = torch.deg2rad(_uniform(self.rotate, b, dev))
+        shx = torch.tan(torch.deg2rad(_uniform(self.shear[0], b, dev)))
+        shy = torch.tan(torch.deg2rad(_uniform(self.shear[1], b, dev)))
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        # 이미지 중심 기준 forward matrix = Rotate @ Shear @ Scale (cv2와 같이 양의 각도 = 반시계 방향)
+        rot = torch.stack([cos, sin, -sin, cos], dim=-1).view(b, 2, 2)
+        shear = torch.stack([torch.ones_like(shx), shx, shy, torch.ones_like(shy)], dim=-1).view(b, 2, 2)
+        forward = rot @ shear @ torch.diag_embed(torch.stack([sx, sy], dim=-1))
+        # affine_grid는 output -> input 좌표 변환이 필요하므로 역행렬을 정규화 좌표계로 옮긴다.
+        to_pixel = torch.diag(torch.tensor([w / 2, h / 2], device=dev))
+        to_norm = torch.diag(torch.tensor([2 / w, 2 / h], device=dev))
+        inverse = torch.linalg.inv(forward)
+        theta = torch.empty(b, 2, 3, device=dev)
+        theta[:, :, :2] = to_norm @ inverse @ to_pixel
+        theta[:, :, 2] = -(to_norm @ inverse @ torch.stack([tx, ty], dim=-1).unsqueeze(-1)).squeeze(-1)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        return _warp(x, grid, self.fill)
+
+class BatchRotate(BatchAffine):
+    def __init__(self, limit=(-90, 90), fill=0, p=0.5, **kwargs):
+        super().__init__(rotate=limit, fill=fill, p=p)
+
+class BatchPerspective(BatchTransform):
+    """네 꼭짓점을 안쪽으로 흔든 사각형을 전체 이미지로 펴는 homography (keep_size=True)"""
+    def __init__(self, scale=(0.05, 0.1), fill=0, p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.scale = scale
+        self.fill = fill
+
+    def apply(self, x):
+        b, _, h, w = x.shape
+        dev = x.device
+        sigma = _uniform(self.scale, b, dev).view(b, 1, 1)
+        offset = (torch.randn(b, 4, 2, device=dev) * sigma).abs().clamp_(max=0.3) * 2 # 정규화 좌표 [-1, 1] 기준
+        dst = torch.tensor([[-1., -1.], [1., -1.], [1., 1.], [-1., 1.]], device=dev).expand(b, 4, 2)
+        src = dst - dst.sign() * offset # 각 꼭짓점을 이미지 안쪽으로 이동
+        # dst(output) -> src(input) homography를 DLT로 계산한다.
+        zeros, ones = torch.zeros(b, 4, device=dev), torch.ones(b, 4, device=dev)
+        xd, yd, xs, ys = dst[..., 0], dst[..., 1], src[..., 0], src[..., 1]
+        rows_x = torch.stack([xd, yd, ones, zeros, zeros, zeros, -xs * xd, -xs * yd], dim=-1)
+        rows_y = torch.stack([zeros, zeros, zeros, xd, yd, ones, -ys * xd, -ys * yd], dim=-1)
+        coeffs = torch.linalg.solve(torch.cat([rows_x, rows_y], dim=1), torch.cat([xs, ys], dim=1))
+        homography = torch.cat([coeffs, torch.ones(b, 1, device=dev)], dim=1).view(b, 3, 3)
+        base = _base_grid(b, h, w, dev).reshape(b, -1, 2)
+        points = torch.cat([base, torch.ones(b, h * w, 1, device=dev)], dim=-1) @ homography.transpose(1, 2)
+        grid = (points[..., :2] / points[..., 2:]).view(b, h, w, 2)
+        return _warp(x, grid, self.fill)
+
+class BatchGridDistortion(BatchTransform):
+    """x, y 축을 num_steps 구간으로 나누고 구간별 길이를 흔드는 piecewise-linear 왜곡"""
+    def __init__(self, num_steps=5, distort_limit=(-0.3, 0.3), fill=0, p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.num_steps = num_steps
+        self.distort_limit = distort_limit
+        self.fill = fill
+
+    def _axis_map(self, b, size, dev):
+        steps = 1 + torch.empty(b, self.num_steps, device=dev).uniform_(*self.distort_limit)
+        bounds = torch.cat([torch.zeros(b, 1, device=dev), steps.cumsum(1)], dim=1)
+        bounds = bounds / bounds[:, -1:] # 이미지 밖으로 나가지 않도록 [0, 1]로 정규화
+        pos = (torch.arange(size, device=dev) + 0.5) / size * self.num_steps
+        cell = pos.floor().long().clamp_(max=self.num_steps - 1)
+        frac = pos - cell
+        left, right = bounds[:, cell], bounds[:, cell + 1]
+        return (left + frac * (right - left)) * 2 - 1 # (b, size)
+
+    def apply(self, x):
+        b, _, h, w = x.shape
+        gx = self._axis_map(b, w, x.device)[:, None, :].expand(b, h, w)
+        gy = self._axis_map(b, h, x.device)[:, :, None].expand(b, h, w)
+        return _warp(x, torch.stack([gx, gy], dim=-1), self.fill)
+
+class BatchRandomBrightnessContrast(BatchTransform):
+    def __init__(self, brightness_limit=(-0.2, 0.2), contrast_limit=(-0.2, 0.2), brightness_by_max=True, p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.brightness_by_max = brightness_by_max
+
+    def apply(self, x):
+        b = x.shape[0]
+        alpha = 1 + _uniform(self.contrast_limit, b, x.device).view(b, 1, 1, 1)
+        beta = _uniform(self.brightness_limit, b, x.device).view(b, 1, 1, 1)
+        beta = beta * (255 if self.brightness_by_max else x.mean(dim=(1, 2, 3), keepdim=True))
+        return x * alpha + beta
+
+class BatchColorJitter(BatchTransform):
+    # RGB -> YIQ : hue 회전은 I, Q 평면에서의 회전이다.
+    RGB2YIQ = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+
+    def __init__(self, brightness=(0.8, 1.2), contrast=(0.8, 1.2), saturation=(0.8, 1.2), hue=(-0.5, 0.5), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def apply(self, x):
+        b = x.shape[0]
+        dev = x.device
+        x = (x * _uniform(self.brightness, b, dev).view(b, 1, 1, 1)).clamp_(0, 255)
+        mean = _luminance(x).mean(dim=(1, 2)).view(b, 1, 1, 1)
+        x = ((x - mean) * _uniform(self.contrast, b, dev).view(b, 1, 1, 1) + mean).clamp_(0, 255)
+        if x.shape[1] != 3: # grayscale에는 saturation, hue가 없다.
+            return x
+        gray = _luminance(x).unsqueeze(1)
+        x = ((x - gray) * _uniform(self.saturation, b, dev).view(b, 1, 1, 1) + gray).clamp_(0, 255)
+        angle = _uniform(self.hue, b, dev) * 2 * math.pi
+        cos, sin, one, zero = torch.cos(angle), torch.sin(angle), torch.ones(b, device=dev), torch.zeros(b, device=dev)
+        rot = torch.stack([one, zero, zero, zero, cos, -sin, zero, sin, cos], dim=-1).view(b, 3, 3)
+        rgb2yiq = self.RGB2YIQ.to(dev)
+        matrix = torch.linalg.inv(rgb2yiq) @ rot @ rgb2yiq # (b, 3, 3)
+        return torch.einsum('bij,bjhw->bihw', matrix, x)
+
+class BatchRGBShift(BatchTransform):
+    def __init__(self, r_shift_limit=(-20, 20), g_shift_limit=(-20, 20), b_shift_limit=(-20, 20), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.limits = [r_shift_limit, g_shift_limit, b_shift_limit]
+
+    def apply(self, x):
+        if x.shape[1] != 3:
+            return x
+        shift = torch.stack([_uniform(limit, x.shape[0], x.device) for limit in self.limits], dim=1)
+        return x + shift.view(-1, 3, 1, 1)
+
+class BatchGaussNoise(BatchTransform):
+    def __init__(self, std_range=(0.2, 0.44), mean_range=(0.0, 0.0), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.std_range = std_range
+        self.mean_range = mean_range
+
+    def apply(self, x):
+        b = x.shape[0]
+        std = _uniform(self.std_range, b, x.device).view(b, 1, 1, 1) * 255
+        mean = _uniform(self.mean_range, b, x.device).view(b, 1, 1, 1) * 255
+        return x + torch.randn_like(x) * std + mean
+
+class BatchISONoise(BatchTransform):
+    """albumentations ISONoise의 luminance(poisson) noise 근사. hue noise는 크기가 매우 작아 생략한다."""
+    def __init__(self, color_shift=(0.01, 0.05), intensity=(0.1, 0.5), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.intensity = intensity
+
+    def apply(self, x):
+        b = x.shape[0]
+        intensity = _uniform(self.intensity, b, x.device).view(b, 1, 1, 1)
+        lightness = (x.amax(1, keepdim=True) + x.amin(1, keepdim=True)) / (2 * 255) # HLS의 L
+        rate = lightness.std(dim=(2, 3), keepdim=True) * intensity
+        noise = torch.poisson(rate.expand_as(lightness).contiguous())
+        return x + noise * intensity * (1 - lightness) * 255
+
+class BatchGaussianBlur(BatchTransform):
+    def __init__(self, blur_limit=(3, 7), sigma_limit=(0.5, 3.0), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.blur_limit = blur_limit
+        self.sigma_limit = sigma_limit
+
+    def apply(self, x):
+        b = x.shape[0]
+        sigma = _uniform(self.sigma_limit, b, x.device)
+        if tuple(self.blur_limit) == (0, 0): # 커널 크기를 sigma로 계산 (albumentations와 동일)
+            ksize = (sigma * 3.5).long() * 2 + 1
+        else:
+            ksize = _odd_randint(self.blur_limit, b, x.device)
+        t = torch.arange(int(ksize.max()), device=x.device) - int(ksize.max()) // 2
+        kernel = torch.exp(-t[None] ** 2 / (2 * sigma[:, None] ** 2)) * (t[None].abs() <= ksize[:, None] // 2)
+        return _separable_blur(x, kernel / kernel.sum(1, keepdim=True))
+
+class BatchBlur(BatchTransform):
+    def __init__(self, blur_limit=(3, 7), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.blur_limit = blur_limit
+
+    def apply(self, x):
+        ksize = _odd_randint(self.blur_limit, x.shape[0], x.device)
+        t = torch.arange(int(ksize.max()), device=x.device) - int(ksize.max()) // 2
+        kernel = (t[None].abs() <= ksize[:, None] // 2).float()
+        return _separable_blur(x, kernel / kernel.sum(1, keepdim=True))
+
+class BatchMotionBlur(BatchTransform):
+    def __init__(self, blur_limit=(3, 7), angle_range=(0.0, 360.0), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.blur_limit = blur_limit
+        self.angle_range = angle_range
+
+    def apply(self, x):
+        b = x.shape[0]
+        dev = x.device
+        ksize = _odd_randint(self.blur_limit, b, dev)
+        size = int(ksize.max())
+        angle = torch.deg2rad(_uniform(self.angle_range, b, dev))
+        # 커널 중심을 지나는 선분을 sample별 각도로 rasterize
+        t = torch.linspace(-1, 1, 4 * size, device=dev)[None] * ((ksize[:, None] - 1) / 2)
+        ix = (torch.cos(angle)[:, None] * t).round().long() + size // 2
+        iy = (torch.sin(angle)[:, None] * t).round().long() + size // 2
+        kernel = torch.zeros(b, size * size, device=dev).scatter_(1, iy * size + ix, 1.0).view(b, size, size)
+        return _depthwise_conv(x, kernel / kernel.sum(dim=(1, 2), keepdim=True))
+
+class BatchDownscale(BatchTransform):
+    """nearest로 줄였다가 nearest로 키우는 것과 같은 pixelation을 grid 한 번으로 적용한다."""
+    def __init__(self, scale_range=(0.25, 0.25), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.scale_range = scale_range
+
+    def apply(self, x):
+        b, _, h, w = x.shape
+        scale = _uniform(self.scale_range, b, x.device).view(b, 1)
+        def axis(size):
+            pos = torch.arange(size, device=x.device)[None] + 0.5
+            src = ((pos * scale).floor() + 0.5) / scale # 축소 이미지 픽셀 중심의 원본 좌표
+            return src / size * 2 - 1
+        grid = torch.stack([axis(w)[:, None, :].expand(b, h, w), axis(h)[:, :, None].expand(b, h, w)], dim=-1)
+        return _warp(x, grid, mode='nearest')
+
+class BatchCLAHE(BatchTransform):
+    """tile별 clipped histogram equalization을 luminance에 적용하고, tile 경계는 LUT를 bilinear 보간한다."""
+    def __init__(self, clip_limit=(1.0, 4.0), tile_grid_size=(8, 8), p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.clip_limit = clip_limit
+        self.tile_grid_size = tile_grid_size
+
+    def apply(self, x):
+        b, _, h, w = x.shape
+        dev = x.device
+        gy, gx = self.tile_grid_size
+        th, tw = -(-h // gy), -(-w // gx)
+        lum = _luminance(x)
+        levels = F.pad(lum, (0, gx * tw - w, 0, gy * th - h), mode='replicate').round().clamp_(0, 255).long()
+        tiles = levels.view(b, gy, th, gx, tw).permute(0, 1, 3, 2, 4).reshape(b, gy * gx, th * tw)
+        hist = torch.zeros(b, gy * gx, 256, device=dev).scatter_add_(2, tiles, torch.ones_like(tiles, dtype=torch.float32))
+        clip = (_uniform(self.clip_limit, b, dev) * th * tw / 256).clamp_(min=1).view(b, 1, 1)
+        excess = (hist - clip).clamp_(min=0).sum(-1, keepdim=True)
+        hist = hist.clamp(max=clip) + excess / 256
+        lut = (hist.cumsum(-1) * 255 / (th * tw)).view(b, gy * gx * 256)
+        # 각 픽셀에서 주변 4개 tile의 LUT 값을 bilinear 보간
+        fy = ((torch.arange(h, device=dev) + 0.5) / th - 0.5).clamp(0, gy - 1)
+        fx = ((torch.arange(w, device=dev) + 0.5) / tw - 0.5).clamp(0, gx - 1)
+        y0, x0 = fy.floor().long(), fx.floor().long()
+        y1, x1 = (y0 + 1).clamp(max=gy - 1), (x0 + 1).clamp(max=gx - 1)
+        wy, wx = (fy - y0)[:, None], (fx - x0)[None, :]
+        value = levels[:, :h, :w].reshape(b, -1)
+        def lookup(ty, tx):
+            index = ((ty[:, None] * gx + tx[None, :]) * 256).view(1, -1) + value
+            return lut.gather(1, index).view(b, h, w)
+        equalized = (lookup(y0, x0) * (1 - wy) * (1 - wx) + lookup(y0, x1) * (1 - wy) * wx
+                     + lookup(y1, x0) * wy * (1 - wx) + lookup(y1, x1) * wy * wx)
+        return x + (equalized - lum).unsqueeze(1)
+
+class BatchCoarseDropout(BatchTransform):
+    def __init__(self, num_holes_range=(1, 1), hole_height_range=(0.1, 0.1), hole_width_range=(0.1, 0.1), fill=0, p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.num_holes_range = num_holes_range
+        self.hole_height_range = hole_height_range
+        self.hole_width_range = hole_width_range
+        self.fill = fill
+
+    @staticmethod
+    def _hole_sizes(value_range, size, shape, device):
+        if isinstance(value_range[0], float): # 이미지 크기 대비 비율
+            value_range = (max(1, int(value_range[0] * size)), max(1, int(value_range[1] * size)))
+        low, high = value_range
+        return torch.randint(int(low), int(high) + 1, shape, device=device)
+
+    def apply(self, x):
+        b, _, h, w = x.shape
+        dev = x.device
+        num_holes = _randint(self.num_holes_range, b, dev)
+        k = int(self.num_holes_range[1])
+        hh = self._hole_sizes(self.hole_height_range, h, (b, k), dev).clamp_(max=h)
+        hw = self._hole_sizes(self.hole_width_range, w, (b, k), dev).clamp_(max=w)
+        y0 = (torch.rand(b, k, device=dev) * (h - hh + 1)).floor()
+        x0 = (torch.rand(b, k, device=dev) * (w - hw + 1)).floor()
+        active = (torch.arange(k, device=dev)[None] < num_holes[:, None]).unsqueeze(-1)
+        ys, xs = torch.arange(h, device=dev), torch.arange(w, device=dev)
+        rows = (ys >= y0[..., None]) & (ys < (y0 + hh)[..., None]) & active # (b, k, h)
+        cols = (xs >= x0[..., None]) & (xs < (x0 + hw)[..., None]) # (b, k, w)
+        mask = (rows.unsqueeze(-1) & cols.unsqueeze(-2)).any(1).unsqueeze(1)
+        return torch.where(mask, _fill_tensor(self.fill, x), x)
+
+class BatchMorphological(BatchTransform):
+    def __init__(self, scale=(2, 3), operation='dilation', p=0.5, **kwargs):
+        super().__init__(p=p)
+        self.scale = scale
+        self.operation = operation
+
+    def apply(self, x):
+        ksize = _randint(self.scale, x.shape[0], x.device)
+        out = torch.empty_like(x)
+        for k in ksize.unique().tolist(): # 커널 크기 종류가 적으므로 크기별로 묶어서 처리
+            selected = ksize == k
+            y = x[selected] if self.operation == 'dilation' else -x[selected]
+            y = F.max_pool2d(F.pad(y, ((k - 1) // 2, k // 2, (k - 1) // 2, k // 2), mode='replicate'), k, stride=1)
+            out[selected] = y if self.operation == 'dilation' else -y
+        return out
+
+BATCH_TRANSFORMS = {
+    'HorizontalFlip': BatchHorizontalFlip,
+    'VerticalFlip': BatchVerticalFlip,
+    'Transpose': BatchTranspose,
+    'Affine': BatchAffine,
+    'Rotate': BatchRotate,
+    'Perspective': BatchPerspective,
+    'GridDistortion': BatchGridDistortion,
+    'RandomBrightnessContrast': BatchRandomBrightnessContrast,
+    'ColorJitter': BatchColorJitter,
+    'RGBShift': BatchRGBShift,
+    'GaussNoise': BatchGaussNoise,
+    'ISONoise': BatchISONoise,
+    'GrayISONoise': BatchISONoise,
+    'GaussianBlur': BatchGaussianBlur,
+    'Blur': BatchBlur,
+    'MotionBlur': BatchMotionBlur,
+    'Downscale': BatchDownscale,
+    'CLAHE': BatchCLAHE,
+    'CoarseDropout': BatchCoarseDropout,
+    'Morphological': BatchMorphological,
+}
+
+def to_batch_transform(transform):
+    """albumentations 파이프라인을 같은 init 인자를 갖는 batch 변환으로 바꾼다."""
+    if isinstance(transform, A.OneOf):
+        return BatchOneOf([to_batch_transform(t) for t in transform.transforms], p=transform.p)
+    if isinstance(transform, A.Compose):
+        return BatchCompose([to_batch_transform(t) for t in transform.transforms], p=transform.p)
+    name = type(transform).__name__
+    assert name in BATCH_TRANSFORMS, f"{name} is not supported by the tensor augmentation engine."
+    return BATCH_TRANSFORMS[name](**transform.get_transform_init_args())
+
+# AUG와 동일한 policy의 batch 버전
+TENSOR_AUG = {name: to_batch_transform(aug) for name, aug in AUG.items()}
+
+class BatchAugmentation:
+    """uint8 (B, C, H, W) batch에 online 증강(OneOf, p=0.85)과 Normalize를 적용한다.
+
+    collate 이후 학습 device(CPU 또는 GPU)에서 호출되므로, worker의 sample별 python overhead가 없다.
+
+    :param list policies: TENSOR_AUG의 batch policy 목록
+    :param mean: Normalize mean
+    :param std: Normalize std
+    """
+    def __init__(self, policies, mean, std, p=0.85):
+        self.augment = BatchOneOf(policies, p=p) if policies else None
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+
+    @torch.no_grad()
+    def __call__(self, x):
+        x = x.float()
+        if self.augment is not None:
+            x = self.augment(x)
+        mean, std = self.mean.to(x.device), self.std.to(x.device)
+        return (x / 255 - mean) / std
+
+def get_batch_augmentation(cfg, epoch=0):
+    """augmentation_engine이 tensor일 때 TrainModule에서 batch에 적용할 증강을 반환한다."""
+    assert cfg.online_augmentation, "tensor augmentation engine은 online_augmentation에서만 사용할 수 있습니다."
+    policies = [TENSOR_AUG[aug] for aug in get_active_policies(cfg, epoch, verbose=False)]
+    norm_mean, norm_std = get_norm_stats(cfg)
+    return BatchAugmentation(policies, mean=norm_mean, std=norm_std)
+
+### Augmentation schedule
+class AugmentationSchedule:
+    """dynamic augmentation 단계(와 progressive resizing 해상도)별 train 증강을 한 번만 만들어 두고, 공유 epoch 값으로 단계를 고르는 transform
+
+    epoch은 shared-memory tensor에 저장되므로, 이미 fork된 persistent DataLoader worker도
+    set_epoch() 이후의 다음 sample부터 새 단계의 증강을 사용한다.
+    install()로 train 데이터셋의 transform을 ScheduledTransform으로 바꿔 둔다.
+
+    :param cfg: 설정 namespace
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        if cfg.dynamic_augmentation['enabled']:
+            policies = cfg.dynamic_augmentation['policies']
+            starts = {'weak': 0, 'middle': policies['weak']['end_epoch'], 'strong': policies['middle']['end_epoch']}
+        else:
+            starts = {None: 0}
+        resizing = getattr(cfg, 'progressive_resizing', None)
+        stage_epochs = set(starts.values())
+        if resizing and resizing['enabled']:
+            stage_epochs |= {start_epoch for start_epoch, _ in resizing['schedule']}
+        # (단계, 해상도)별 train_transforms (조합이 시작되는 epoch 기준으로 한 번만 만든다.)
+        self.pipelines = {}
+        for epoch in sorted(stage_epochs):
+            key = self._key(epoch)
+            if key not in self.pipelines:
+                self.pipelines[key] = get_augmentation(cfg, epoch, verbose=False)[0]
+        self.batch_pipelines = {}
+        if get_augmentation_engine(cfg) == 'tensor':
+            self.batch_pipelines = {phase: get_batch_augmentation(cfg, epoch) for phase, epoch in starts.items()}
+        self.phase_names = list(starts)
+        self.epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+        self.phase = None
+
+    def set_epoch(self, epoch):
+        self.epoch[0] = epoch
+        phase = get_phase(self.cfg, epoch)
+        if phase != self.phase and phase is not None:
+            print(f"⚙️ Using {phase}_policy augmentation...")
+        self.phase = phase
+
+    def _key(self, epoch):
+        return get_phase(self.cfg, epoch), get_image_size(self.cfg, epoch)
+
+    def transforms(self):
+        """현재 단계의 train_transforms"""
+        return self.pipelines[self._key(int(self.epoch[0]))]
+
+    def batch_augmentation(self, epoch=None):
+        """epoch(기본값: 공유 epoch) 단계의 BatchAugmentation, tensor 엔진이 아니면 None"""
+        epoch = int(self.epoch[0]) if epoch is None else epoch
+        return self.batch_pipelines.get(get_phase(self.cfg, epoch))
+
+    def install(self, dataset):
+        """train 데이터셋(ImageDataset, ShardImageDataset, MultiViewDataset, ConcatDataset)의 transform을 교체한다."""
+        if hasattr(dataset, 'transforms'): # MultiViewDataset
+            if self.cfg.online_augmentation:
+                dataset.transforms = [ScheduledTransform(self, 0)] * dataset.num_views
+            else:
+                dataset.transforms = [ScheduledTransform(self, i) for i in range(dataset.num_views)]
+        elif hasattr(dataset, 'datasets'): # ConcatDataset
+            for i, sub_dataset in enumerate(dataset.datasets):
+                sub_dataset.transform = ScheduledTransform(self, i)
+        else:
+            dataset.transform = ScheduledTransform(self, 0)
+
+class ScheduledTransform:
+    """AugmentationSchedule의 현재 단계에서 index번째 train transform을 적용한다.
+
+    offline 증강에서 단계별 증강 기법 수가 다르면 index를 단계의 증강 기법 수로 나눈 나머지를 사용한다.
+    """
+    def __init__(self, schedule, index=0):
+        self.schedule = schedule
+        self.index = index
+
+    def __call__(self, **data):
+        transforms = self.schedule.transforms()
+        return transforms[self.index % len(transforms)](**data)
+
 ### Offline augmentation
+class SeededTransform:
+    """가상 샘플(variant)마다 seed를 고정해서 적용하는 albumentations transform
+
+    variant 번호로 seed를 정하므로 같은 가상 샘플은 매 epoch, 모든 worker에서 같은 이미지가 된다.
+    set_random_seed와 transform 호출 사이에 다른 thread가 RNG를 바꾸지 않도록,
+    thread backend(ThreadPoolLoader)에서는 thread마다 transform 복사본을 사용한다.
+
+    :param A.Compose transform: 적용할 transform (전역 AUG를 바꾸지 않도록 복사해서 사용한다)
+    :param int seed: 기준 seed
+    """
+    def __init__(self, transform, seed):
+        self.transform = copy.deepcopy(transform)
+        self.seed = seed
+        self._local = threading.local()
+
+    def __getstate__(self): # process worker로 보낼 때 thread별 복사본은 버린다.
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _thread_transform(self):
+        transform = getattr(self._local, 'transform', None)
+        if transform is None:
+            transform = self._local.transform = copy.deepcopy(self.transform)
+        return transform
+
+    def __call__(self, img, variant):
+        transform = self._thread_transform()
+        transform.set_random_seed(self.seed + variant)
+        return transform(image=img)['image']
+
+def get_variant_transform(cfg):
+    """class_imbalance 설정 시 가상 샘플에 적용할 seed 고정 Cutout"""
+    if hasattr(cfg, 'class_imbalance') and cfg.class_imbalance:
+        # Cutout 증강 파이프라인 설정
+        cutout_transform = A.Compose([
+            A.CoarseDropout(
+                num_holes_range=(1, 2), # 마스킹 개수
+                hole_height_range=(int(cfg.image_size * 0.05), int(cfg.image_size * 0.1)), # 마스킹의 높이 범위
+                hole_width_range=(int(cfg.image_size * 0.05), int(cfg.image_size * 0.2)), # 마스킹의 너비 범위
+                fill=(0,0,0), # 검정색 마스킹
+                p=1.0
+            )
+        ])
+        if getattr(cfg, 'grayscale', False):
+            cutout_transform = map_policy(cutout_transform, to_grayscale)
+        return SeededTransform(cutout_transform, cfg.random_seed)
+    return None
+
+def get_val_view_transform(cfg):
+    """validation TTA view에 적용할 seed 고정 'eda' 증강"""
+    return SeededTransform(get_policy(cfg, 'eda'), cfg.random_seed)
+
 def augment_class_imbalance(cfg, train_df):
-    # Cutout 증강 파이프라인 설정
-    cutout_transform = A.Compose([
-        # 이미지 크기 조정
-        A.CoarseDropout(
-            num_holes_range=(1, 2), # 마스킹 개수
-            hole_height_range=(int(cfg.image_size * 0.05), int(cfg.image_size * 0.1)), # 마스킹의 높이 범위
-            hole_width_range=(int(cfg.image_size * 0.05), int(cfg.image_size * 0.2)), # 마스킹의 너비 범위
-            fill=(0,0,0), # 검정색 마스킹
-            p=1.0
-        )
-    ])
+    """aug_class의 샘플 수가 max_samples가 되도록 가상 cutout 샘플을 추가한다.
+
+    파일을 쓰지 않고, 원본 ID와 variant 번호만 가진 행을 만든다.
+    실제 cutout은 ImageDataset에서 원본을 디코딩한 뒤 get_variant_transform()의 SeededTransform으로 적용한다.
+
+    :param cfg: 설정 namespace
+    :param pd.DataFrame train_df: ID, target 데이터프레임
+    :return pd.DataFrame: ID, target, variant 데이터프레임
+    """
     # 증강 대상 클래스
     augment_classes = cfg.class_imbalance['aug_class']
     max_samples = cfg.class_imbalance['max_samples']
 
-    # 증강 이미지, 라벨, ID 리스트 초기화
-    augmented_labels = []    # 증강된 이미지 라벨
-    augmented_ids = []       # 증강된 이미지 ID
+    sampled_dfs = []
     total_augmented = 0
     # 증강 대상 클래스 루프
     for cls in augment_classes:
@@ -310,80 +1186,31 @@ def augment_class_imbalance(cfg, train_df):
         # 만약 현재 이미지 수가 목표치보다 많거나 같으면 증강할 필요 없으므로 다음 클래스로 넘어감
         if to_generate <= 0:
             continue
-        # 증강할 이미지들을 원본 데이터프레임에서 샘플링 (중복 허용: replace=True)
-        # 목표 샘플 수 (to_generate)만큼 이미지를 샘플링하며,
-        # 만약 현재 이미지 개수(current_count)가 to_generate보다 적으면 중복 선택(replace=True)
-        # 이 부분은 원래 코드의 `if/else` 조건문을 통합한 것입니다.
-        sampled_df = cls_df.sample(n=to_generate, replace=False, random_state=cfg.random_seed).reset_index(drop=True)
-        # 샘플링된 각 이미지에 대해 증강 수행 및 저장
-        for idx, row in sampled_df.iterrows():
-            img_id = row['ID']
-            img_path = os.path.join(cfg.data_dir, 'train', img_id)
-            # 이미지 로드 (OpenCV는 기본적으로 BGR로 로드)
-            img = cv2.imread(img_path)
-            # BGR 이미지를 RGB로 변환 (Albumentations는 RGB를 기대)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-            # 정의된 Cutout 증강 적용
-            augmented_img = cutout_transform(image=img)['image']
-
-            # 증강된 이미지의 새로운 ID 생성 (기존 ID 앞에 'aug_' 접두사 추가)
-            new_id = f"aug_{img_id}"
-            save_path = os.path.join(cfg.data_dir, 'train', new_id)
-
-            # 증강된 RGB 이미지를 다시 BGR로 변환하여 파일로 저장
-            cv2.imwrite(save_path, cv2.cvtColor(augmented_img, cv2.COLOR_RGB2BGR))
-
-            # 증강된 이미지의 라벨과 ID를 리스트에 추가
-            augmented_labels.append(cls)
-            augmented_ids.append(new_id)
-            total_augmented += 1
+        # 증강할 이미지들을 원본 데이터프레임에서 샘플링
+        # 현재 이미지 개수(current_count)가 to_generate보다 적을 때만 중복 선택(replace=True)
+        sampled_df = cls_df.sample(n=to_generate, replace=to_generate > current_count, random_state=cfg.random_seed)
+        sampled_dfs.append(sampled_df[['ID', 'target']])
+        total_augmented += to_generate
         print(f"총 {total_augmented} 개의 이미지 증강")
-    return augmented_ids, augmented_labels
+    if not sampled_dfs:
+        return pd.DataFrame({'ID': [], 'target': [], 'variant': []}).astype({'target': int, 'variant': int})
+    imb_aug_df = pd.concat(sampled_dfs, ignore_index=True)
+    imb_aug_df['variant'] = np.arange(len(imb_aug_df)) # 가상 샘플마다 고유한 cutout seed
+    return imb_aug_df
 
-def augment_validation(cfg, val_df):
-    # 증강 이미지, 라벨, ID 리스트 초기화
-    augmented_labels = []    # 증강된 이미지 라벨
-    augmented_ids = []       # 증강된 이미지 ID
-    total_augmented = 0
-    val_tta_transform = AUG['eda']
-    # 증강 대상 클래스 루프
-    for idx, row in val_df.iterrows():
-        img_id = row['ID']
-        cls = row['target']
-        img_path = os.path.join(cfg.data_dir, 'train', img_id)
-        # 이미지 로드 (OpenCV는 기본적으로 BGR로 로드)
-        img = cv2.imread(img_path)
-        # BGR 이미지를 RGB로 변환 (Albumentations는 RGB를 기대)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-        # 정의된 Cutout 증강 적용 > 총 4번 적용
-        for i_ in range(4):
-            augmented_img = val_tta_transform(image=img)['image']
-
-            # 증강된 이미지의 새로운 ID 생성 (기존 ID 앞에 'aug_' 접두사 추가)
-            new_id = f"val{i_}_{img_id}"
-            save_path = os.path.join(cfg.data_dir, 'train', new_id)
-
-            # 증강된 RGB 이미지를 다시 BGR로 변환하여 파일로 저장
-            cv2.imwrite(save_path, cv2.cvtColor(augmented_img, cv2.COLOR_RGB2BGR))
-
-            # 증강된 이미지의 라벨과 ID를 리스트에 추가
-            augmented_labels.append(cls)
-            augmented_ids.append(new_id)
-            total_augmented += 1
-    print(f"총 {total_augmented} 개의 validation 이미지 증강")
-    return augmented_ids, augmented_labels
-
-def delete_offline_augmented_images(cfg, augmented_ids):
-    train_dir = os.path.join(cfg.data_dir, 'train')
-    _ = 0
-    for filename in augmented_ids:
-        file_path = os.path.join(train_dir, filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            _ += 1
-        else:
-            print("Wrong filename:", file_path)
-    print(_,"개 이미지 제거")
+def augment_validation(cfg, val_df, n_views=4):
+    """validation 이미지마다 'eda' 증강 view n_views개를 가상 샘플로 추가한다.
+
+    파일을 쓰지 않고, 원본 ID와 variant 번호만 가진 행을 만든다.
+    view는 ImageDataset에서 get_val_view_transform()으로 만들고, get_variant_cache()에 학습 해상도의 uint8로 저장한다.
 
+    :param cfg: 설정 namespace
+    :param pd.DataFrame val_df: ID, target 데이터프레임
+    :param int n_views: 이미지당 view 개수, defaults to 4
+    :return pd.DataFrame: ID, target, variant 데이터프레임
+    """
+    # view i의 variant는 i * len(val_df) + (행 번호) : 모든 view가 서로 다른 seed를 갖는다.
+    val_aug_df = pd.concat([val_df[['ID', 'target']]] * n_views, ignore_index=True)
+    val_aug_df['variant'] = np.arange(len(val_aug_df))
+    print(f"총 {len(val_aug_df)} 개의 validation 이미지 증강")
+    return val_aug_df
@@ -1,6 +1,8 @@
 import os
+import contextlib
 from tqdm import tqdm
 import torch
+from torch.utils.data import BatchSampler
 import pandas as pd
 import numpy as np
 import seaborn as sns
@@ -10,7 +12,15 @@ import wandb
 import albumentations as A
 import matplotlib.image as mpimg
 
-def tta_predict(model, dataset, tta_transform, device, cfg, flag='val'):
+def tta_predict(model, dataset, tta_transform, device, cfg, flag='val', precision=None):
+    """
+    aspect_buckets 사용 시 dataset.buckets(get_dataloader의 assign_aspect_buckets가 설정)의 sample별 bucket으로 resize하므로,
+    TTA view는 predict의 bucket batch와 같은 해상도가 된다. view는 이미지마다 batch 크기 1로 예측한다.
+
+    :param precision: autocast를 정하는 PrecisionPolicy, defaults to autocast 없음
+    """
+    autocast = precision.autocast if precision is not None else contextlib.nullcontext
+    buckets = getattr(dataset, 'buckets', None)
     if cfg.tta_dropout:
         model.train()
     else:
@@ -18,21 +28,24 @@ def tta_predict(model, dataset, tta_transform, device, cfg, flag='val'):
     predictions = []
     with torch.no_grad():
         if flag=='val':
-            for image, _ in tqdm(dataset, desc="validation TTA Prediction"): # load batch
+            for i, (image, _) in enumerate(tqdm(dataset, desc="validation TTA Prediction")): # load batch
+                bucket = {} if buckets is None else {'bucket': buckets[i]}
                 # read raw images from dataset_raw
                 tta_preds = []
                 image = image.clamp(0, 255).to(torch.uint8) 
                 image = image.permute(1, 2, 0).cpu().numpy() # H,W,C 로 변형
                 for _ in range(5): # 5 TTA iterations
-                    augmented_image = tta_transform(image=image)['image']
+                    augmented_image = tta_transform(image=image, **bucket)['image']
                     augmented_image = augmented_image.to(device)
                     augmented_image = augmented_image.unsqueeze(0) # batch, H,W,C 로 변형
-                    outputs = model(augmented_image) # inference
-                    tta_preds.append(outputs.softmax(1).cpu().numpy()) # append inference result
+                    with autocast():
+                        outputs = model(augmented_image) # inference
+                    tta_preds.append(outputs.float().softmax(1).cpu().numpy()) # append inference result
                 avg_preds = np.mean(tta_preds, axis=0) # 5 TTA 예측 결과 확률값을 평균 낸다.
                 predictions.extend(avg_preds.argmax(1))
         else: # inference time transform
-            for image, _ in tqdm(dataset, desc="test TTA Prediction"): # load batch
+            for i, (image, _) in enumerate(tqdm(dataset, desc="test TTA Prediction")): # load batch
+                bucket = {} if buckets is None else {'bucket': buckets[i]}
                 tta_preds = []
                 image = image.clamp(0, 255).to(torch.uint8) 
                 image = image.permute(1, 2, 0).cpu().numpy() # H,W,C 로 변형
@@ -47,37 +60,51 @@ def tta_predict(model, dataset, tta_transform, device, cfg, flag='val'):
                 augs.append(a4)
                 augs.append(tta_transform) # 증강 안 하는 버전
                 for transform_func in augs:
-                    augmented_image = transform_func(image=image)['image']
+                    augmented_image = transform_func(image=image, **bucket)['image']
                     augmented_image = augmented_image.to(device)
                     augmented_image = augmented_image.unsqueeze(0) # batch, H,W,C 로 변형
-                    outputs = model(augmented_image) # inference
-                    tta_preds.append(outputs.softmax(1).cpu().numpy()) # append inference result
+                    with autocast():
+                        outputs = model(augmented_image) # inference
+                    tta_preds.append(outputs.float().softmax(1).cpu().numpy()) # append inference result
                     del augmented_image
                     torch.cuda.empty_cache()
                 avg_preds = np.mean(tta_preds, axis=0) # 5 TTA 예측 결과 확률값을 평균 낸다.
                 predictions.extend(avg_preds.argmax(1))
     return predictions
 
-def predict(model, loader, device):
+def predict(model, loader, device, transfer=None, precision=None):
+    """
+    :param transfer: loader batch를 device로 옮기는 DeviceTransfer (uint8 batch는 device에서 Normalize, 다음 batch를 미리 전송), defaults to images.to(device)
+    :param precision: 학습과 같은 autocast를 적용할 PrecisionPolicy, defaults to autocast 없음
+    """
+    autocast = precision.autocast if precision is not None else contextlib.nullcontext
     model.eval()
     predictions = []
+    batches = transfer.prefetch(loader) if transfer is not None else ((images.to(device), y) for images, y in loader)
     with torch.no_grad():
-        for images, _ in tqdm(loader, desc="Prediction"):
-            images = images.to(device)
-            outputs = model(images)
+        for images, _ in tqdm(batches, desc="Prediction", total=len(loader)):
+            with autocast():
+                outputs = model(images)
             predictions.extend(outputs.argmax(1).cpu().numpy())
+    # aspect ratio bucket 등 custom batch_sampler는 dataset 순서와 다르게 batch를 만들므로, 예측을 원래 순서로 되돌린다.
+    # (predict에 쓰는 loader의 batch_sampler는 SequentialSampler 기반이라 다시 순회해도 같은 순서다.)
+    if loader.batch_sampler is not None and not isinstance(loader.batch_sampler, BatchSampler):
+        order = np.asarray([idx for batch in loader.batch_sampler for idx in batch], dtype=np.int64)
+        reordered = np.empty(len(predictions), dtype=np.int64)
+        reordered[order] = predictions
+        predictions = list(reordered)
     return predictions
 
-def do_validation(df, model, data, transform_func, cfg, run=None, show=False, savepath=None):
+def do_validation(df, model, data, transform_func, cfg, run=None, show=False, savepath=None, transfer=None, precision=None):
     if cfg.val_TTA:
         print("Running TTA on validation set...")
         # offline 증강을 수행했을 때는 tta_predict() 호출할 필요가 없다.
         # val_preds = tta_predict(model, data, transform_func, cfg.device, flag='val')
         # offline TTA 증강 시에는 predict 호출
-        val_preds = predict(model, data, cfg.device)
+        val_preds = predict(model, data, cfg.device, transfer=transfer, precision=precision)
     else:
         print("Running Normal Validation...")
-        val_preds = predict(model, data, cfg.device)
+        val_preds = predict(model, data, cfg.device, transfer=transfer, precision=precision)
     val_targets = df['target'].values
     val_f1 = f1_score(val_targets, val_preds, average='macro')
     # 메타데이터 로드
@@ -28,6 +28,7 @@ from PIL import Image
 from zoneinfo import ZoneInfo
 from datetime import datetime
 import argparse
+import glob
 
 #📢 project_root 설정 필수
 project_root = '/data/ephemeral/home/upstageailab-cv-classification-cv_5'
@@ -38,6 +39,7 @@ from codes.gemini_augmentation_v2 import *
 from codes.gemini_evalute_v2 import *
 
 if __name__ == "__main__":
+    run = None # 설정/--resume 검사에서 예외가 나도 finally에서 참조할 수 있도록 먼저 정의한다.
     try:
         # python 파일 실행할 때 config.yaml 파일 이름을 입력받아서 설정 파일을 지정한다.
         parser = argparse.ArgumentParser(description="Run deep learning training with specified configuration.")
@@ -47,6 +49,12 @@ if __name__ == "__main__":
             default='config.yaml', # 기본값 설정
             help='Name of the configuration YAML file (e.g., config.yaml, experiment_A.yaml)'
         )
+        parser.add_argument(
+            '--resume',
+            type=str,
+            default=None,
+            help='Submission directory of an interrupted run to resume from its latest checkpoints'
+        )
         
         args = parser.parse_args()
 
@@ -96,8 +104,25 @@ if __name__ == "__main__":
             f"tTTA_{1 if cfg.test_TTA else 0}-"
             f"MP_{1 if cfg.mixed_precision else 0}"
         )
+        if args.resume:
+            # 중단된 실험의 이름과 submission 폴더를 그대로 쓰고, TrainModule은 checkpoints/의 최신 checkpoint부터 이어서 학습한다.
+            args.resume = os.path.abspath(args.resume.rstrip('/'))
+            next_run_name = os.path.basename(args.resume)
+            cfg.resume = True
+            # checkpoint가 없으면 새로 학습하면서 이어야 할 실험 폴더를 덮어쓰게 되므로 실행하지 않는다.
+            checkpoint_cfg = dict(getattr(cfg, 'checkpoint', None) or {})
+            checkpoint_dir = checkpoint_cfg.get('checkpoint_dir', None)
+            if checkpoint_dir in (None, 'None'):
+                checkpoint_dir = os.path.join(args.resume, 'checkpoints')
+            if not glob.glob(os.path.join(glob.escape(checkpoint_dir), '*.ckpt')):
+                raise ValueError(f"--resume: {checkpoint_dir}에 checkpoint가 없습니다. (중단된 실험을 checkpoint['every'] >= 1로 학습했는지 확인하세요.)")
+            # 이어서 학습하는 동안에도 checkpoint를 남긴다.
+            if checkpoint_cfg.get('every', 0) <= 0:
+                checkpoint_cfg['every'] = 1
+                print("⚙️ --resume: checkpoint['every'] 0 -> 1")
+            cfg.checkpoint = checkpoint_cfg
+            print(f"📢 Resume run: {next_run_name}")
 
-        run = None 
         if hasattr(cfg, 'wandb') and cfg.wandb['log']:
             run = wandb.init(
                 project=cfg.wandb['project'],
@@ -107,9 +132,9 @@ if __name__ == "__main__":
 
         ### submission 폴더 생성
         # 모델 저장, 시각화 그래프 저장, submission 파일 등등 저장 용도
-        submission_dir = os.path.join(cfg.data_dir, 'submissions', next_run_name)
+        submission_dir = args.resume or os.path.join(cfg.data_dir, 'submissions', next_run_name)
         try:
-            os.makedirs(submission_dir, exist_ok=False)
+            os.makedirs(submission_dir, exist_ok=bool(args.resume))
             # cfg에 추가 
             cfg.submission_dir = submission_dir
         except:
@@ -118,6 +143,14 @@ if __name__ == "__main__":
 
         ### Data Load
         df = pd.read_csv(os.path.join(cfg.data_dir, cfg.train_data))
+        decoder = get_image_decoder(cfg)
+        # 이미지 캐시 설정 시, 원본 이미지를 한 번만 디코딩해서 모든 fold/epoch에서 재사용한다.
+        train_cache = get_image_cache(cfg, df['ID'], split='train')
+        train_shards = get_image_shards(cfg, df['ID'], split='train')
+        # class_imbalance 가상 샘플에 적용할 seed 고정 cutout
+        variant_transform = get_variant_transform(cfg)
+        # validation TTA view에 적용할 seed 고정 'eda' 증강
+        val_view_transform = get_val_view_transform(cfg)
 
         # Cross validation if n_folds >= 3
         if cfg.n_folds >= 3:
@@ -131,199 +164,171 @@ if __name__ == "__main__":
 
             skf = StratifiedKFold(n_splits=cfg.n_folds, shuffle=True, random_state=cfg.random_seed)
             for fold, (train_idx, val_idx) in enumerate(skf.split(df, df['target'])):
-                try:
-                    print(f"===== FOLD {fold+1} =====")
-                    print("="*20)
-                    train_df, val_df = df.iloc[train_idx], df.iloc[val_idx]
-                    # config.yaml에 class_imbalance 설정했을 경우,
-                    # offline cutout 증강으로 클래스 불균형을 맞춘다.
-                    augmented_ids, augmented_labels = [], []
-                    # 클래스 불균형 해소를 위한 이미지 offline 증강
-                    if hasattr(cfg, 'class_imbalance') and cfg.class_imbalance:
-                        augmented_ids, augmented_labels = augment_class_imbalance(cfg, train_df)
-                        imb_aug_df = pd.DataFrame({
-                            "ID": augmented_ids,
-                            "target": augmented_labels
-                        })
-                        # 기존 train 데이터 프레임과 병합
-                        train_df = pd.concat([train_df, imb_aug_df], ignore_index=True)
-                        train_df = train_df.reset_index(drop=True)
-                    # validation 데이터를 offline으로 eda 증강을 적용
-                    val_augmented_ids, augmented_labels = [], []
-                    if cfg.val_TTA:
-                        val_augmented_ids, augmented_labels = augment_validation(cfg, val_df)
-                        val_aug_df = pd.DataFrame({
-                            "ID": val_augmented_ids,
-                            "target": augmented_labels
-                        })
-                        # 기존 train 데이터 프레임과 병합
-                        val_df = pd.concat([val_df, val_aug_df], ignore_index=True)
-                        val_df = val_df.reset_index(drop=True)
-                    # train augmentation
-                    if cfg.online_augmentation:
-                        train_dataset = ImageDataset(train_df, os.path.join(cfg.data_dir, "train"), transform=train_transforms[0])
-                    sampler = None
-                    shuffle = True
-                    if cfg.weighted_random_sampler:
-                        targets = train_df['target'].values
-                        class_counts = np.bincount(targets)
-                        class_weights = 1. / class_counts
-                        weights = class_weights[targets]
-                        sampler = WeightedRandomSampler(weights, len(weights))
-                        shuffle = False
-
-                    val_dataset = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=val_transform)
-
-                    if cfg.weighted_random_sampler:
-                        train_loader = DataLoader(train_dataset, batch_size=cfg.batch_size, sampler=sampler, shuffle=False, num_workers=8, pin_memory=True)
-                    else:
-                        train_loader = DataLoader(train_dataset, batch_size=cfg.batch_size, shuffle=True, num_workers=8, pin_memory=True)
-                    val_loader = DataLoader(val_dataset, batch_size=cfg.batch_size, shuffle=False, num_workers=8, pin_memory=True)
-
-                    # For TTA, we need a loader with raw images
-                    raw_transform = A.Compose([
-                        ToTensorV2()
-                    ])
-                    val_dataset_raw = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=raw_transform)
-                    val_loader_raw = DataLoader(val_dataset_raw, batch_size=cfg.batch_size, shuffle=False, num_workers=8, pin_memory=True)
-
-                    ### Define TrainModule
-                    # Model
-                    model = get_timm_model(cfg)
-                    class_weights = None
-                    if hasattr(cfg, 'class_weighting') and cfg.class_weighting:
-                        class_counts = train_df['target'].value_counts()
-                        weights = 1.0/class_counts
-                        class_weights = torch.tensor(weights, dtype=torch.float32).to(cfg.device)
-                    criterion = get_criterion(cfg, class_weights=class_weights)
-                    optimizer = get_optimizer(model, cfg)
-                    scheduler = get_scheduler(optimizer, cfg, steps_per_epoch=len(train_loader))
-
-                    trainer = TrainModule(
-                        model=model,
-                        criterion=criterion,
-                        optimizer=optimizer,
-                        scheduler=scheduler,
-                        train_loader=train_loader,
-                        valid_loader=val_loader,
-                        cfg=cfg,
-                        verbose=1,
-                        run=None #run don't use wandb logging while cross-validation
-                    )
-                    ### Train
-                    train_result = trainer.training_loop()
-                    if not train_result:
-                        raise ValueError("Failed to train model...")
-                    # save fold results
-                    train_losses_for_plot.append(trainer.train_losses_for_plot)
-                    train_acc_for_plot.append(trainer.train_acc_for_plot)
-                    train_f1_for_plot.append(trainer.train_f1_for_plot)
-                    val_losses_for_plot.append(trainer.val_losses_for_plot)
-                    val_acc_for_plot.append(trainer.val_acc_for_plot)
-                    val_f1_for_plot.append(trainer.val_f1_for_plot)
-
-                    # fold early stopped moment
-                    folds_es.append(trainer.es.best_loss_epoch)
-
-                    # evaluate
-                    val_preds, val_f1 = do_validation(
-                        df=val_df,
-                        model=trainer.model,
-                        data=val_loader,
-                        transform_func=val_tta_transform,
-                        cfg=cfg,
-                        run=run,
-                        show=False,
-                        savepath=os.path.join(cfg.submission_dir, f"val_confusion_matrix{'_TTA' if cfg.val_TTA else ''}_Fold{fold}.png")
-                    )
-                    folds_val_f1.append(val_f1)
-                finally:
-                    delete_offline_augmented_images(cfg=cfg, augmented_ids=augmented_ids)
-                    delete_offline_augmented_images(cfg=cfg, augmented_ids=val_augmented_ids)
-                
-                print("="*20)
+                print(f"===== FOLD {fold+1} =====")
                 print("="*20)
-
-            # out of cross-validation
-            # 1. plot
-            # 2. print average val f1
-            # 3. set epoch
-            # 4. train whole dataset & make final model
-            plot_cross_validation(train_losses_for_plot, val_losses_for_plot, "Loss", cfg, show=False)
-            plot_cross_validation(train_acc_for_plot, val_acc_for_plot, "Accuracy", cfg, show=False)
-            plot_cross_validation(train_f1_for_plot, val_f1_for_plot, "F1-score", cfg, show=False)
-            best_epoch = int(np.mean(folds_es))
-            print(f"📢  Avg F1: {np.mean(folds_val_f1):.5f}, Best Epoch: {best_epoch}")
-            # config.yaml에 class_imbalance 설정했을 경우,
-            # offline cutout 증강으로 클래스 불균형을 맞춘다.
-            augmented_ids, augmented_labels = [], []
-            try:
-                # 클래스 불균형 해소를 위한 이미지 offline 증강
+                train_df, val_df = df.iloc[train_idx], df.iloc[val_idx]
+                # config.yaml에 class_imbalance 설정했을 경우,
+                # 가상 cutout 샘플로 클래스 불균형을 맞춘다. (파일을 쓰지 않는다)
                 if hasattr(cfg, 'class_imbalance') and cfg.class_imbalance:
-                    augmented_ids, augmented_labels = augment_class_imbalance(cfg, df)
-                    imb_aug_df = pd.DataFrame({
-                        "ID": augmented_ids,
-                        "target": augmented_labels
-                    })
+                    imb_aug_df = augment_class_imbalance(cfg, train_df)
                     # 기존 train 데이터 프레임과 병합
-                    df = pd.concat([df, imb_aug_df], ignore_index=True)
-                    df = df.reset_index(drop=True)
+                    train_df = pd.concat([train_df, imb_aug_df], ignore_index=True)
+                    train_df = train_df.reset_index(drop=True)
+                # validation 데이터에 eda 증강 view를 가상 샘플로 추가 (파일을 쓰지 않는다)
+                if cfg.val_TTA:
+                    val_aug_df = augment_validation(cfg, val_df)
+                    # 기존 validation 데이터 프레임과 병합
+                    val_df = pd.concat([val_df, val_aug_df], ignore_index=True)
+                    val_df = val_df.reset_index(drop=True)
+                # view는 처음 읽을 때 한 번만 만들어서 모든 epoch에서 재사용한다.
+                val_view_cache = get_variant_cache(cfg, val_df)
+                # train augmentation
+                train_dataset = get_train_dataset(cfg, train_df, os.path.join(cfg.data_dir, "train"), train_transforms, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=variant_transform)
                 sampler = None
                 shuffle = True
                 if cfg.weighted_random_sampler:
                     targets = train_df['target'].values
-                    class_counts = np.bincount(targets) # 0~16 각각 클래스별 개수를 구함.
-                    class_weights = 1. / class_counts # 각 클래스별 개수에 따라 가중치 부여. 개수가 적은 클래스일수록 높은 가중치
-                    weights = class_weights[targets] # 각 데이터 샘플의 target을 weight로 치환한다.
-                    # 재현성 보장을 위한 generator 시드 고정
-                    g = get_generator(cfg)
-                    sampler = WeightedRandomSampler(weights, len(weights), generator=g)
-                # train augmentation
-                if cfg.online_augmentation:
-                    train_dataset = ImageDataset(df, os.path.join(cfg.data_dir, "train"), transform=train_transforms[0])
-                else:
-                    datasets = [ImageDataset(df, os.path.join(cfg.data_dir, "train"), transform=t) for t in train_transforms]
-                    train_dataset = ConcatDataset(datasets)
-                if cfg.weighted_random_sampler:
-                    train_loader = DataLoader(train_dataset, batch_size=cfg.batch_size, sampler=sampler, shuffle=False, num_workers=8, pin_memory=True)
-                else:
-                    train_loader = DataLoader(train_dataset, batch_size=cfg.batch_size, shuffle=True, num_workers=8, pin_memory=True)
-                model = get_timm_model(cfg)
-                criterion = get_criterion(cfg)
+                    class_counts = np.bincount(targets)
+                    class_weights = 1. / class_counts
+                    weights = class_weights[targets]
+                    sampler = WeightedRandomSampler(weights, len(weights))
+                    shuffle = False
+
+                val_dataset = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=val_transform, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=val_view_transform, variant_cache=val_view_cache)
+
+                train_loader = get_dataloader(cfg, train_dataset, 'train', shuffle=True, sampler=sampler)
+                val_loader = get_dataloader(cfg, val_dataset, 'val')
+
+                # For TTA, we need a loader with raw images
+                raw_transform = A.Compose([
+                    ToTensorV2()
+                ])
+                val_dataset_raw = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=raw_transform, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=val_view_transform, variant_cache=val_view_cache)
+                val_loader_raw = get_dataloader(cfg, val_dataset_raw, 'val_raw', tune=False)
+
+                ### Define TrainModule
+                # Model
+                precision = get_precision_policy(cfg) # compile warmup과 학습이 같은 autocast를 사용한다.
+                model = get_timm_model(cfg, precision=precision)
+                class_weights = None
+                if hasattr(cfg, 'class_weighting') and cfg.class_weighting:
+                    class_counts = train_df['target'].value_counts()
+                    weights = 1.0/class_counts
+                    class_weights = torch.tensor(weights, dtype=torch.float32).to(cfg.device)
+                criterion = get_criterion(cfg, class_weights=class_weights)
                 optimizer = get_optimizer(model, cfg)
-                scheduler = get_scheduler(optimizer, cfg, steps_per_epoch=len(train_loader))
+                scheduler = get_scheduler(optimizer, cfg, steps_per_epoch=get_epoch_steps(train_loader, [get_batch_size(cfg, epoch) for epoch in range(cfg.epochs + 1)])) # training_loop은 epoch 0..epochs를 학습한다.
+
                 trainer = TrainModule(
                     model=model,
                     criterion=criterion,
                     optimizer=optimizer,
                     scheduler=scheduler,
                     train_loader=train_loader,
-                    valid_loader=None,
+                    valid_loader=val_loader,
                     cfg=cfg,
                     verbose=1,
-                    run=run
+                    run=None, #run don't use wandb logging while cross-validation
+                    rebatch_loader=rebatch_dataloader,
+                    checkpoint_name=f'fold{fold}',
+                    precision=precision,
+                    transfer=get_device_transfer(cfg, *get_norm_stats(cfg))
                 )
-                trainer.training_loop() # early stop 없이 best_epoch 만큼 학습한다.
-                ### Save Model
-                trainer.save_experiments(savepath=os.path.join(cfg.submission_dir, f'{next_run_name}.pth'))
-            
-            finally:
-                delete_offline_augmented_images(cfg=cfg, augmented_ids=augmented_ids)
+                ### Train
+                train_result = trainer.training_loop()
+                if not train_result:
+                    raise ValueError("Failed to train model...")
+                # save fold results
+                train_losses_for_plot.append(trainer.train_losses_for_plot)
+                train_acc_for_plot.append(trainer.train_acc_for_plot)
+                train_f1_for_plot.append(trainer.train_f1_for_plot)
+                val_losses_for_plot.append(trainer.val_losses_for_plot)
+                val_acc_for_plot.append(trainer.val_acc_for_plot)
+                val_f1_for_plot.append(trainer.val_f1_for_plot)
+
+                # fold early stopped moment
+                folds_es.append(trainer.es.best_loss_epoch)
+
+                # evaluate
+                val_preds, val_f1 = do_validation(
+                    df=val_df,
+                    model=trainer.model,
+                    data=val_loader,
+                    transform_func=val_tta_transform,
+                    cfg=cfg,
+                    run=run,
+                    show=False,
+                    savepath=os.path.join(cfg.submission_dir, f"val_confusion_matrix{'_TTA' if cfg.val_TTA else ''}_Fold{fold}.png"),
+                    transfer=trainer.transfer,
+                    precision=trainer.precision
+                )
+                folds_val_f1.append(val_f1)
+                
+                print("="*20)
+                print("="*20)
+
+            # out of cross-validation
+            # 1. plot
+            # 2. print average val f1
+            # 3. set epoch
+            # 4. train whole dataset & make final model
+            plot_cross_validation(train_losses_for_plot, val_losses_for_plot, "Loss", cfg, show=False)
+            plot_cross_validation(train_acc_for_plot, val_acc_for_plot, "Accuracy", cfg, show=False)
+            plot_cross_validation(train_f1_for_plot, val_f1_for_plot, "F1-score", cfg, show=False)
+            best_epoch = int(np.mean(folds_es))
+            print(f"📢  Avg F1: {np.mean(folds_val_f1):.5f}, Best Epoch: {best_epoch}")
+            # config.yaml에 class_imbalance 설정했을 경우,
+            # 가상 cutout 샘플로 클래스 불균형을 맞춘다. (파일을 쓰지 않는다)
+            if hasattr(cfg, 'class_imbalance') and cfg.class_imbalance:
+                imb_aug_df = augment_class_imbalance(cfg, df)
+                # 기존 train 데이터 프레임과 병합
+                df = pd.concat([df, imb_aug_df], ignore_index=True)
+                df = df.reset_index(drop=True)
+            sampler = None
+            shuffle = True
+            if cfg.weighted_random_sampler:
+                targets = train_df['target'].values
+                class_counts = np.bincount(targets) # 0~16 각각 클래스별 개수를 구함.
+                class_weights = 1. / class_counts # 각 클래스별 개수에 따라 가중치 부여. 개수가 적은 클래스일수록 높은 가중치
+                weights = class_weights[targets] # 각 데이터 샘플의 target을 weight로 치환한다.
+                # 재현성 보장을 위한 generator 시드 고정
+                g = get_generator(cfg)
+                sampler = WeightedRandomSampler(weights, len(weights), generator=g)
+            # train augmentation
+            train_dataset = get_train_dataset(cfg, df, os.path.join(cfg.data_dir, "train"), train_transforms, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=variant_transform)
+            train_loader = get_dataloader(cfg, train_dataset, 'train', shuffle=True, sampler=sampler)
+            precision = get_precision_policy(cfg) # compile warmup과 학습이 같은 autocast를 사용한다.
+            model = get_timm_model(cfg, precision=precision)
+            criterion = get_criterion(cfg)
+            optimizer = get_optimizer(model, cfg)
+            scheduler = get_scheduler(optimizer, cfg, steps_per_epoch=get_epoch_steps(train_loader, [get_batch_size(cfg, epoch) for epoch in range(cfg.epochs + 1)])) # training_loop은 epoch 0..epochs를 학습한다.
+            trainer = TrainModule(
+                model=model,
+                criterion=criterion,
+                optimizer=optimizer,
+                scheduler=scheduler,
+                train_loader=train_loader,
+                valid_loader=None,
+                cfg=cfg,
+                verbose=1,
+                run=run,
+                rebatch_loader=rebatch_dataloader,
+                checkpoint_name='full',
+                precision=precision,
+                transfer=get_device_transfer(cfg, *get_norm_stats(cfg))
+            )
+            trainer.training_loop() # early stop 없이 best_epoch 만큼 학습한다.
+            ### Save Model
+            trainer.save_experiments(savepath=os.path.join(cfg.submission_dir, f'{next_run_name}.pth'))
 
         # No Cross Validation
         else:
             # Train-validation 분할
             train_df, val_df = train_test_split(df, test_size=cfg.val_split_ratio, random_state=cfg.random_seed, stratify=df['target'] if cfg.stratify else None)
             # config.yaml에 class_imbalance 설정했을 경우,
-            # offline cutout 증강으로 클래스 불균형을 맞춘다.
-            augmented_ids, augmented_labels = [], []
-            # 클래스 불균형 해소를 위한 이미지 offline 증강
+            # 가상 cutout 샘플로 클래스 불균형을 맞춘다. (파일을 쓰지 않는다)
             if hasattr(cfg, 'class_imbalance') and cfg.class_imbalance:
-                augmented_ids, augmented_labels = augment_class_imbalance(cfg, train_df)
-                imb_aug_df = pd.DataFrame({
-                    "ID": augmented_ids,
-                    "target": augmented_labels
-                })
+                imb_aug_df = augment_class_imbalance(cfg, train_df)
                 # 기존 train 데이터 프레임과 병합
                 train_df = pd.concat([train_df, imb_aug_df], ignore_index=True)
                 train_df = train_df.reset_index(drop=True)
@@ -332,17 +337,14 @@ if __name__ == "__main__":
             # Augmentation 설정    
             train_transforms, val_transform, val_tta_transform, test_tta_transform = get_augmentation(cfg, epoch=0)
 
-            # validation 데이터를 offline으로 eda 증강을 적용
-            val_augmented_ids, augmented_labels = [], []
+            # validation 데이터에 eda 증강 view를 가상 샘플로 추가 (파일을 쓰지 않는다)
             if cfg.val_TTA:
-                val_augmented_ids, augmented_labels = augment_validation(cfg, val_df)
-                val_aug_df = pd.DataFrame({
-                    "ID": val_augmented_ids,
-                    "target": augmented_labels
-                })
-                # 기존 train 데이터 프레임과 병합
+                val_aug_df = augment_validation(cfg, val_df)
+                # 기존 validation 데이터 프레임과 병합
                 val_df = pd.concat([val_df, val_aug_df], ignore_index=True)
                 val_df = val_df.reset_index(drop=True)
+            # view는 처음 읽을 때 한 번만 만들어서 모든 epoch에서 재사용한다.
+            val_view_cache = get_variant_cache(cfg, val_df)
 
             sampler = None
             shuffle = True
@@ -356,33 +358,27 @@ if __name__ == "__main__":
                 sampler = WeightedRandomSampler(weights, len(weights), generator=g)
 
             # train augmentation
-            if cfg.online_augmentation:
-                train_dataset = ImageDataset(train_df, os.path.join(cfg.data_dir, "train"), transform=train_transforms[0])
-            else:
-                datasets = [ImageDataset(train_df, os.path.join(cfg.data_dir, "train"), transform=t) for t in train_transforms]
-                train_dataset = ConcatDataset(datasets)
+            train_dataset = get_train_dataset(cfg, train_df, os.path.join(cfg.data_dir, "train"), train_transforms, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=variant_transform)
 
-            val_dataset = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=val_transform)
+            val_dataset = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=val_transform, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=val_view_transform, variant_cache=val_view_cache)
 
-            if cfg.weighted_random_sampler:
-                train_loader = DataLoader(train_dataset, batch_size=cfg.batch_size, sampler=sampler, shuffle=False, num_workers=8, pin_memory=True)
-            else:
-                train_loader = DataLoader(train_dataset, batch_size=cfg.batch_size, shuffle=True, num_workers=8, pin_memory=True)
-            val_loader = DataLoader(val_dataset, batch_size=cfg.batch_size, shuffle=False, num_workers=8, pin_memory=True)
+            train_loader = get_dataloader(cfg, train_dataset, 'train', shuffle=True, sampler=sampler)
+            val_loader = get_dataloader(cfg, val_dataset, 'val')
 
             # For TTA, we need a loader with raw images
             raw_transform = A.Compose([
                 ToTensorV2()
             ])
-            val_dataset_raw = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=raw_transform)
-            val_loader_raw = DataLoader(val_dataset_raw, batch_size=cfg.batch_size, shuffle=False, num_workers=8, pin_memory=True)
+            val_dataset_raw = ImageDataset(val_df, os.path.join(cfg.data_dir, "train"), transform=raw_transform, cache=train_cache, decoder=decoder, shards=train_shards, variant_transform=val_view_transform, variant_cache=val_view_cache)
+            val_loader_raw = get_dataloader(cfg, val_dataset_raw, 'val_raw', tune=False)
 
             ### Define TrainModule
             # Model
-            model = get_timm_model(cfg)
+            precision = get_precision_policy(cfg) # compile warmup과 학습이 같은 autocast를 사용한다.
+            model = get_timm_model(cfg, precision=precision)
             criterion = get_criterion(cfg)
             optimizer = get_optimizer(model, cfg)
-            scheduler = get_scheduler(optimizer, cfg, steps_per_epoch=len(train_loader))
+            scheduler = get_scheduler(optimizer, cfg, steps_per_epoch=get_epoch_steps(train_loader, [get_batch_size(cfg, epoch) for epoch in range(cfg.epochs + 1)])) # training_loop은 epoch 0..epochs를 학습한다.
 
             trainer = TrainModule(
                 model=model,
@@ -393,7 +389,10 @@ if __name__ == "__main__":
                 valid_loader=val_loader,
                 cfg=cfg,
                 verbose=1,
-                run=run
+                run=run,
+                rebatch_loader=rebatch_dataloader,
+                precision=precision,
+                transfer=get_device_transfer(cfg, *get_norm_stats(cfg))
             )
 
             ### Train
@@ -420,7 +419,9 @@ if __name__ == "__main__":
                 cfg=cfg, 
                 run=run, 
                 show=False, 
-                savepath=os.path.join(cfg.submission_dir, f"val_confusion_matrix{'_TTA' if cfg.val_TTA else ''}.png")
+                savepath=os.path.join(cfg.submission_dir, f"val_confusion_matrix{'_TTA' if cfg.val_TTA else ''}.png"),
+                transfer=trainer.transfer,
+                precision=trainer.precision
             )
             print("📢 Validation F1-score:",val_f1)
 
@@ -432,17 +433,19 @@ if __name__ == "__main__":
 
         # Inference
         test_df = pd.read_csv(os.path.join(cfg.data_dir, "sample_submission.csv"))
+        test_cache = get_image_cache(cfg, test_df['ID'], split='test')
+        test_shards = get_image_shards(cfg, test_df['ID'], split='test')
 
         if cfg.test_TTA:
-            test_dataset_raw = ImageDataset(test_df, os.path.join(cfg.data_dir, "test"), transform=raw_transform)
-            test_loader_raw = DataLoader(test_dataset_raw, batch_size=cfg.batch_size, shuffle=False, num_workers=8, pin_memory=True)
+            test_dataset_raw = ImageDataset(test_df, os.path.join(cfg.data_dir, "test"), transform=raw_transform, cache=test_cache, decoder=decoder, shards=test_shards)
+            test_loader_raw = get_dataloader(cfg, test_dataset_raw, 'test_raw', tune=False)
             print("Running TTA on test set...")
-            test_preds = tta_predict(trainer.model, test_dataset_raw, test_tta_transform, device, cfg, flag='test')
+            test_preds = tta_predict(trainer.model, test_dataset_raw, test_tta_transform, device, cfg, flag='test', precision=trainer.precision)
         else:
-            test_dataset = ImageDataset(test_df, os.path.join(cfg.data_dir, "test"), transform=val_transform)
-            test_loader = DataLoader(test_dataset, batch_size=cfg.batch_size, shuffle=False, num_workers=8, pin_memory=True)
+            test_dataset = ImageDataset(test_df, os.path.join(cfg.data_dir, "test"), transform=val_transform, cache=test_cache, decoder=decoder, shards=test_shards)
+            test_loader = get_dataloader(cfg, test_dataset, 'test')
             print("Running inference on test set...")
-            test_preds = predict(trainer.model, test_loader, device)
+            test_preds = predict(trainer.model, test_loader, device, transfer=trainer.transfer, precision=trainer.precision)
 
         pred_df = pd.read_csv(os.path.join(cfg.data_dir, "sample_submission.csv"))
         pred_df['target'] = test_preds
@@ -479,8 +482,4 @@ if __name__ == "__main__":
 
     finally:
         if run:
-            run.finish()
-        if augmented_ids:
-            ### Offline Augmentation 파일 삭제
-            delete_offline_augmented_images(cfg=cfg, augmented_ids=augmented_ids)
-            delete_offline_augmented_images(cfg=cfg, augmented_ids=val_augmented_ids)
\ No newline at end of file
+            run.finish()
\ No newline at end of file
@@ -4,9 +4,12 @@ import torch
 import numpy as np
 from tqdm import tqdm
 import copy
+import glob
+import random
 import time
+import tempfile
+import threading
 from types import SimpleNamespace
-from sklearn.metrics import f1_score
 
 import sys
 sys.path.append(
@@ -14,14 +17,195 @@ sys.path.append(
 	"/data/ephemeral/home/upstageailab-cv-classification-cv_5/codes"
 )
 
-from gemini_augmentation_v2 import get_augmentation
+from gemini_augmentation_v2 import AugmentationSchedule, get_image_size, get_batch_size
+
+class PrecisionPolicy:
+    """학습 device에 맞는 autocast device type, dtype과 GradScaler 사용 여부 (train, validation, predict 공통)
+
+    CPU는 bfloat16 autocast를 사용하고, CUDA는 float16(GradScaler 사용) 또는 bfloat16을 사용한다.
+    bfloat16은 float32와 지수 범위가 같아서 gradient scaling이 필요 없다. 그 외 device(mps 등)는 autocast를 쓰지 않는다.
+
+    :param device: 학습 device
+    :param bool enabled: mixed precision 사용 여부, defaults to True
+    :param str cuda_dtype: CUDA autocast dtype ('float16', 'bfloat16'), defaults to 'float16'
+    :param str cpu_dtype: CPU autocast dtype ('bfloat16', 'float32'이면 사용 안 함), defaults to 'bfloat16'
+    """
+    def __init__(self, device, enabled=True, cuda_dtype='float16', cpu_dtype='bfloat16'):
+        self.device_type = torch.device(device).type
+        dtype = {'cuda': cuda_dtype, 'cpu': cpu_dtype}.get(self.device_type)
+        if self.device_type == 'cuda' and dtype == 'bfloat16' and not torch.cuda.is_bf16_supported():
+            print("⚠️ bfloat16 is not supported on this GPU, using float16 autocast")
+            dtype = 'float16'
+        self.enabled = enabled and dtype not in (None, 'float32')
+        self.dtype = getattr(torch, dtype) if self.enabled else torch.float32
+        self.grad_scaling = self.enabled and self.dtype == torch.float16
+
+    def autocast(self):
+        if not self.enabled:
+            return torch.amp.autocast(device_type='cpu', enabled=False)
+        return torch.amp.autocast(device_type=self.device_type, dtype=self.dtype)
+
+    def grad_scaler(self):
+        """float16 autocast일 때만 loss scaling을 하는 GradScaler (그 외에는 scale/step/update가 그대로 통과한다.)"""
+        return torch.amp.GradScaler('cuda', enabled=self.grad_scaling)
+
+    def __repr__(self):
+        return f"{self.device_type} {str(self.dtype).replace('torch.', '')}{' + GradScaler' if self.grad_scaling else ''}"
+
+def get_precision_policy(cfg):
+    """cfg.device, cfg.mixed_precision, cfg.precision 설정의 PrecisionPolicy"""
+    precision = getattr(cfg, 'precision', None) or {}
+    return PrecisionPolicy(cfg.device, enabled=cfg.mixed_precision, cuda_dtype=precision.get('cuda_dtype', 'float16'),
+                           cpu_dtype=precision.get('cpu_dtype', 'bfloat16'))
+
+class WeightSnapshot:
+    """model state_dict를 한 번만 할당한 buffer에 덮어써서 보관하는 best weights 저장소
+
+    mode
+      device : 학습 device에 state_dict 복사본 (copy.deepcopy, parameter 메모리 2배)
+      cpu : CPU buffer(CUDA면 pinned)에 non_blocking으로 복사한다. 복사는 학습 stream에서 다음 step보다 먼저 실행되고,
+            buffer를 읽을 때만 CUDA event를 기다린다.
+      mmap : memory-mapped 파일 하나에 모든 tensor를 이어서 복사한다. (RAM도 아낄 때)
+    load()는 load_state_dict로 model parameter에 제자리 복사한다.
+
+    :param str mode: 'device', 'cpu', 'mmap', defaults to 'cpu'
+    :param str snapshot_dir: mmap 파일 디렉토리, None이면 시스템 임시 디렉토리, defaults to None
+    """
+    def __init__(self, mode='cpu', snapshot_dir=None):
+        assert mode in ('device', 'cpu', 'mmap'), f"unknown weight snapshot mode: {mode}"
+        self.mode = mode
+        self.snapshot_dir = snapshot_dir
+        self.buffers = None
+        self.event = None
+
+    def _allocate(self, state):
+        if self.mode == 'cpu':
+            pin = torch.cuda.is_available() and any(v.is_cuda for v in state.values())
+            return {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=pin) for k, v in state.items()}
+        # mmap : tensor마다 64 bytes 정렬된 offset에 이어서 저장한다.
+        offsets, total = {}, 0
+        for k, v in state.items():
+            offsets[k] = total
+            total += (v.numel() * v.element_size() + 63) // 64 * 64
+        if self.snapshot_dir:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix='.weights', dir=self.snapshot_dir)
+        os.close(fd)
+        data = np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(total, 1),))
+        try:
+            os.remove(path) # mapping은 유지되고, 프로세스가 끝나면 파일도 사라진다.
+        except OSError:
+            pass
+        return {k: torch.from_numpy(data[offsets[k]:offsets[k] + v.numel() * v.element_size()]).view(v.dtype).view(v.shape)
+                for k, v in state.items()}
+
+    def save(self, model):
+        state = model.state_dict()
+        if self.mode == 'device':
+            self.buffers = copy.deepcopy(state)
+            return
+        if self.buffers is None:
+            self.buffers = self._allocate(state)
+        for k, v in state.items():
+            self.buffers[k].copy_(v.detach(), non_blocking=self.buffers[k].is_pinned())
+        if any(v.is_cuda for v in state.values()):
+            self.event = torch.cuda.Event()
+            self.event.record()
+
+    def state_dict(self):
+        if self.event is not None:
+            self.event.synchronize()
+        return self.buffers
+
+    def load(self, model):
+        model.load_state_dict(self.state_dict())
+
+    def load_state_dict(self, state):
+        """checkpoint에 저장한 snapshot을 buffer에 복사한다."""
+        if self.mode == 'device':
+            self.buffers = state
+            return
+        if self.buffers is None:
+            self.buffers = self._allocate(state)
+        for k, v in state.items():
+            self.buffers[k].copy_(v)
+
+def _to_cpu(obj):
+    """dict/list/tuple 안의 tensor를 모두 CPU 복사본으로 바꾼다. (학습이 계속 바꾸는 원본과 메모리를 공유하지 않는다.)"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+class CheckpointManager:
+    """학습 상태 checkpoint를 background thread에서 저장하고, 최근 keep개만 남긴다. (cfg.checkpoint)
+
+    state는 학습 thread에서 CPU 복사본으로 만들고, thread가 임시 파일에 torch.save한 뒤 os.replace로 바꿔 넣는다.
+    저장 도중 중단돼도 디렉토리에는 완성된 checkpoint만 남는다. 저장은 한 번에 하나씩만 진행한다.
+
+    :param str checkpoint_dir: checkpoint 디렉토리
+    :param str name: 파일 이름 prefix (fold별 TrainModule 구분)
+    :param int keep: 남길 checkpoint 개수, defaults to 3
+    """
+    def __init__(self, checkpoint_dir, name, keep=3):
+        self.checkpoint_dir = checkpoint_dir
+        self.name = name
+        self.keep = max(1, keep)
+        self.thread = None
+        self.error = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def path(self, epoch):
+        return os.path.join(self.checkpoint_dir, f"{self.name}_epoch{epoch:04d}.ckpt")
+
+    def checkpoints(self):
+        """저장된 checkpoint 경로 (epoch 순서)"""
+        return sorted(glob.glob(os.path.join(glob.escape(self.checkpoint_dir), f"{glob.escape(self.name)}_epoch*.ckpt")))
+
+    def save(self, state, epoch):
+        self.wait()
+        state = _to_cpu(state)
+        self.thread = threading.Thread(target=self._write, args=(state, epoch))
+        self.thread.start()
+
+    def _write(self, state, epoch):
+        try:
+            path = self.path(epoch)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            for old in self.checkpoints()[:-self.keep]:
+                os.remove(old)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """진행 중인 저장이 끝날 때까지 기다린다."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load(self):
+        """가장 최근 checkpoint, 없으면 None"""
+        checkpoints = self.checkpoints()
+        if not checkpoints:
+            return None
+        print(f"📢 Resume from checkpoint: {checkpoints[-1]}")
+        return torch.load(checkpoints[-1], map_location='cpu', weights_only=False)
 
 class EarlyStopping:
-    def __init__(self, patience=5, min_delta=1e-6, restore_best_weights=True):
+    def __init__(self, patience=5, min_delta=1e-6, restore_best_weights=True, snapshot=None):
         self.patience = patience
         self.min_delta = min_delta
         self.restore_best_weights = restore_best_weights
-        self.best_model_state_dict = None
+        # best weights는 미리 할당한 buffer에 덮어쓴다. (기본값: CPU pinned buffer)
+        self.snapshot = snapshot if snapshot is not None else WeightSnapshot('cpu')
+        self.has_snapshot = False # snapshot에 best weights가 저장되어 있는지
         self.best_loss = None
         self.best_loss_epoch = 0
         self.counter = 0
@@ -31,10 +215,10 @@ class EarlyStopping:
         if self.best_loss is None:
             #현재의 모델로 self.best_loss, self.best_model_state_dict 업데이트
             self.best_loss = val_loss
-            self.best_model_state_dict = copy.deepcopy(model.state_dict())
+            self._save(model)
         elif val_loss < self.best_loss - self.min_delta:
 			#val_loss가 best_loss보다 좋을 때 > self.best_loss와 self.best_model 업데이트
-            self.best_model_state_dict = copy.deepcopy(model.state_dict())
+            self._save(model)
             self.best_loss = val_loss
             self.best_loss_epoch = epoch
             self.counter = 0
@@ -45,27 +229,268 @@ class EarlyStopping:
             self.status = f"No improvement in the last {self.counter} epochs"
             if self.counter >= self.patience:
                 self.status = f"Early stopping triggered after {self.counter} epochs."
-                if self.restore_best_weights and self.best_model_state_dict is not None:
-                    model.load_state_dict(self.best_model_state_dict)
+                if self.restore_best_weights and self.has_snapshot:
+                    self.snapshot.load(model)
                 return True # ealy stopped
         return False # end with no early stop
+
+    def _save(self, model):
+        self.snapshot.save(model)
+        self.has_snapshot = True
+
+    @property
+    def best_model_state_dict(self):
+        """best weights state_dict, 없으면 None (CUDA 비동기 복사가 끝날 때까지 기다린 뒤 반환한다.)"""
+        return self.snapshot.state_dict() if self.has_snapshot else None
     
     def restore_best(self, model):
-        if self.best_loss is not None and self.best_model_state_dict is not None:
+        if self.best_loss is not None and self.has_snapshot:
             print(f"Restore model_state_dict of which best_loss: {self.best_loss:.6f}")
-            model.load_state_dict(self.best_model_state_dict)
+            self.snapshot.load(model)
             return True
         return False
+
+class BatchRing:
+    """producer thread 1개와 consumer 1개가 공유하는 memory-mapped batch ring buffer
+
+    batch 이미지는 고정 크기 slot에 raw bytes로 쓰고, shape/dtype/target은 slot별 meta로 관리한다.
+    slot보다 큰 batch(progressive resizing에서 batch 크기를 유지하는 경우 등)는 meta에 tensor를 그대로 담는다.
+
+    :param str path: memmap 파일 경로
+    :param int slot_bytes: slot 하나의 크기
+    :param int num_slots: slot 개수
+    """
+    def __init__(self, path, slot_bytes, num_slots):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='w+', shape=(num_slots, slot_bytes))
+        self.meta = [None] * num_slots
+        self.free = threading.Semaphore(num_slots)
+        self.filled = threading.Semaphore(0)
+        self.head, self.tail = 0, 0
+
+    def put(self, meta, images=None):
+        """빈 slot이 생길 때까지 기다렸다가 batch를 쓴다."""
+        self.free.acquire()
+        slot, self.head = self.head, (self.head + 1) % len(self.meta)
+        if images is not None:
+            nbytes = images.numel() * images.element_size()
+            if nbytes <= self.data.shape[1]:
+                self.data[slot, :nbytes] = images.contiguous().view(-1).view(torch.uint8).numpy()
+                meta = {**meta, 'shape': tuple(images.shape), 'dtype': images.dtype, 'nbytes': nbytes}
+            else:
+                meta = {**meta, 'images': images}
+        self.meta[slot] = meta
+        self.filled.release()
+
+    def get(self):
+        """다음 slot의 (meta, images). images는 memmap view이므로 release() 전까지만 유효하다."""
+        self.filled.acquire()
+        slot, self.tail = self.tail, (self.tail + 1) % len(self.meta)
+        meta = self.meta[slot]
+        images = meta.get('images')
+        if images is None and 'nbytes' in meta:
+            images = torch.from_numpy(self.data[slot, :meta['nbytes']]).view(meta['dtype']).view(meta['shape'])
+        return meta, images
+
+    def release(self):
+        """get()으로 꺼낸 가장 오래된 slot을 producer에게 돌려준다."""
+        self.free.release()
+
+    def close(self):
+        del self.data
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class EpochProducer:
+    """다음 epoch들의 train batch를 background thread에서 미리 만들어 BatchRing에 채워 두는 producer (cfg.epoch_producer)
+
+    train_loader의 DataLoader worker pool이 증강을 하고, thread가 epoch마다 TrainModule.prepare_epoch()로
+    증강 단계/해상도/shard 순서를 맞춘 뒤 train_loader를 끝까지 순회한다. 학습 중인 epoch보다 앞서서 batch를 만들기 때문에
+    validation, checkpoint 저장, epoch 경계에서도 CPU 증강이 멈추지 않는다. ring이 가득 차면 producer가 기다린다.
+
+    :param trainer: TrainModule
+    :param str ring_dir: memmap 파일을 만들 디렉토리, None이면 시스템 임시 디렉토리
+    :param int ring_mb: ring buffer 크기(MB), slot 크기는 첫 batch 크기로 정한다.
+    """
+    def __init__(self, trainer, ring_dir=None, ring_mb=2048):
+        self.trainer = trainer
+        self.ring_dir = ring_dir
+        self.ring_mb = ring_mb
+        self.ring = None
+        self.error = None
+        self.ready = threading.Event() # ring 할당 또는 producer 실패
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, first_epoch, last_epoch):
+        self.thread = threading.Thread(target=self._produce, args=(first_epoch, last_epoch), daemon=True)
+        self.thread.start()
+
+    def _allocate(self, images):
+        slot_bytes = int(images.numel() * images.element_size() * 1.25) # 마지막 batch, bucket별 크기 차이 여유분
+        num_slots = max(2, self.ring_mb * 2**20 // slot_bytes)
+        if self.ring_dir:
+            os.makedirs(self.ring_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix='.ring', dir=self.ring_dir)
+        os.close(fd)
+        self.ring = BatchRing(path, slot_bytes, num_slots)
+        print(f"📢 Epoch producer: {num_slots} batch ring buffer ({slot_bytes * num_slots / 2**20:.0f}MB) at {path}")
+        self.ready.set()
+
+    def _produce(self, first_epoch, last_epoch):
+        try:
+            for epoch in range(first_epoch, last_epoch + 1):
+                loader = self.trainer.prepare_epoch(epoch)
+                for images, targets in loader:
+                    if self.stopped.is_set():
+                        return
+                    if self.ring is None:
+                        self._allocate(images)
+                    self.ring.put({'epoch': epoch, 'targets': targets}, images)
+                if self.ring is None:
+                    raise RuntimeError(f"train_loader yielded no batch at epoch {epoch}")
+                self.ring.put({'epoch': epoch, 'end': True})
+        except Exception as e:
+            self.error = e
+            if self.ring is not None:
+                self.ring.put({'error': e})
+            self.ready.set()
+
+    def batches(self, epoch):
+        """epoch의 (images, targets) batch를 ring에서 순서대로 꺼낸다. images는 다음 batch를 꺼낼 때까지 유효하다."""
+        self.ready.wait()
+        if self.ring is None:
+            raise self.error
+        while True:
+            meta, images = self.ring.get()
+            if 'error' in meta:
+                raise meta['error']
+            if meta.get('end'):
+                self.ring.release()
+                assert meta['epoch'] == epoch, f"epoch producer is at epoch {meta['epoch']}, trainer at {epoch}"
+                return
+            yield images, meta['targets']
+            self.ring.release()
+
+    def stop(self):
+        """producer thread를 멈추고 ring buffer 파일을 지운다. (early stopping 등으로 남은 epoch은 버린다.)"""
+        self.stopped.set()
+        if self.ring is not None:
+            self.ring.release() # put()에서 빈 slot을 기다리는 producer를 깨운다.
+        if self.thread is not None:
+            self.thread.join()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+class MetricAccumulator:
+    """epoch 동안 loss 합계와 confusion matrix를 device에서 누적하고, epoch 끝에 한 번만 host로 가져와 loss, accuracy, macro-F1을 계산한다.
+
+    batch마다 .item()이나 .cpu()로 device를 동기화하지 않는다. loss 합계는 float32로 누적한다. (mps는 float64 tensor를 지원하지 않는다.)
+    macro-F1은 sklearn f1_score(average='macro')와 같이 target 또는 예측에 나온 class만 평균한다.
+    """
+    def __init__(self):
+        self.loss_sum = None
+        self.confusion = None # (num_classes * num_classes,) target * num_classes + pred
+
+    def update(self, loss, outputs, targets):
+        num_classes = outputs.shape[1]
+        if self.confusion is None:
+            self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.int64, device=outputs.device)
+            self.loss_sum = torch.zeros((), dtype=torch.float32, device=outputs.device)
+        predicted = outputs.detach().argmax(1)
+        self.confusion += torch.bincount(targets * num_classes + predicted, minlength=num_classes * num_classes)
+        self.loss_sum += loss.detach().float() * targets.size(0)
+
+    def compute(self):
+        """:return: (평균 loss, accuracy(%), macro-F1)"""
+        confusion = self.confusion.cpu().double()
+        num_classes = int(round(confusion.numel() ** 0.5))
+        confusion = confusion.view(num_classes, num_classes)
+        total = confusion.sum().item()
+        tp = confusion.diag()
+        support, predicted = confusion.sum(1), confusion.sum(0)
+        present = (support + predicted) > 0
+        f1 = 2 * tp[present] / (support[present] + predicted[present])
+        return self.loss_sum.item() / total, 100 * tp.sum().item() / total, f1.mean().item()
+
+class HistogramLogger:
+    """layer group별 weight/gradient histogram을 device에서 계산하고, bin count만 host로 가져와 wandb.Histogram으로 만든다. (cfg.histogram)
+
+    group의 parameter를 하나로 이어 붙이지 않고, group 범위(min, max)를 구한 뒤 parameter마다 torch.histc 결과를 더한다.
+    sample_ratio < 1이면 parameter마다 원소 일부만 random sample해서 histogram을 만든다.
+    sample은 seed로 만든 전용 torch.Generator로 뽑으므로, logging 여부와 주기가 학습 RNG(dropout, 증강, shuffle)를 바꾸지 않는다.
+
+    :param model: torch model
+    :param int every: every epoch마다 logging, 0이면 logging하지 않는다, defaults to 5
+    :param int bins: histogram bin 개수, defaults to 64
+    :param float sample_ratio: parameter별 sample 비율, defaults to 1.0
+    :param int group_depth: parameter 이름에서 group 이름으로 쓸 앞부분 깊이 (1 -> layer1, layer2, ...), defaults to 1
+        TimmWrapper(custom_layer)의 backbone은 한 단계 더 내려가서 backbone.layer1, backbone.layer2, ...로 묶는다.
+    :param int seed: sample용 generator seed, defaults to 0
+    """
+    def __init__(self, model, every=5, bins=64, sample_ratio=1.0, group_depth=1, seed=0):
+        self.every = every
+        self.bins = bins
+        self.sample_ratio = sample_ratio
+        self.seed = seed
+        self.generators = {} # device별 sample generator
+        self.groups = {}
+        for name, param in model.named_parameters():
+            parts = name.split('.')
+            depth = group_depth + 1 if parts[0] == 'backbone' else group_depth # backbone 전체가 group 하나가 되지 않도록
+            self.groups.setdefault('.'.join(parts[:depth]), []).append(param)
+
+    def due(self, epoch):
+        return self.every > 0 and epoch % self.every == 0
+
+    def _sample(self, x):
+        x = x.detach().reshape(-1)
+        if self.sample_ratio < 1 and x.numel() > 1:
+            k = max(1, int(x.numel() * self.sample_ratio))
+            generator = self.generators.get(x.device)
+            if generator is None:
+                generator = self.generators[x.device] = torch.Generator(device=x.device).manual_seed(self.seed)
+            x = x[torch.randint(x.numel(), (k,), device=x.device, generator=generator)]
+        return x.float()
+
+    def _histogram(self, tensors):
+        values = [self._sample(t) for t in tensors if t is not None and t.numel() > 0]
+        if not values:
+            return None
+        bounds = torch.stack([torch.stack(torch.aminmax(v)) for v in values]).cpu() # group 범위만 host로 가져온다.
+        lo, hi = bounds[:, 0].min().item(), bounds[:, 1].max().item()
+        if hi <= lo:
+            hi = lo + 1e-6
+        counts = sum(torch.histc(v, bins=self.bins, min=lo, max=hi) for v in values)
+        return wandb.Histogram(np_histogram=(counts.cpu().numpy(), np.linspace(lo, hi, self.bins + 1)))
+
+    def log(self):
+        """:return dict: {'weights/<group>': Histogram, 'gradients/<group>': Histogram}"""
+        epoch_log = {}
+        for group, params in self.groups.items():
+            weights = self._histogram(params)
+            if weights is not None:
+                epoch_log[f'weights/{group}'] = weights
+            grads = self._histogram([p.grad for p in params])
+            if grads is not None:
+                epoch_log[f'gradients/{group}'] = grads
+        return epoch_log
 	
 class TrainModule():
-	def __init__(self, model: torch.nn.Module, criterion, optimizer, scheduler, train_loader, valid_loader, cfg: SimpleNamespace, verbose:int =50, run=None):
+	def __init__(self, model: torch.nn.Module, criterion, optimizer, scheduler, train_loader, valid_loader, cfg: SimpleNamespace, verbose:int =50, run=None, rebatch_loader=None, checkpoint_name='train', precision=None, transfer=None):
 		'''
 		model, criterion, scheduler, train_loader, valid_loader 미리 정의해서 전달
 		cfg : es_patience, epochs 등에 대한 hyperparameters를 namespace 객체로 입력
+		rebatch_loader : progressive resizing 단계마다 train_loader의 batch 크기를 바꾸는 함수 f(cfg, loader, batch_size) (gemini_utils_v2.rebatch_dataloader)
+		checkpoint_name : checkpoint 파일 이름 prefix (fold마다 다르게 지정), cfg.resume이면 이 이름의 최신 checkpoint부터 이어서 학습한다.
+		precision : get_timm_model(compile warmup)과 공유할 PrecisionPolicy, None이면 cfg로 만든다.
+		transfer : loader batch를 device로 옮기는 DeviceTransfer (gemini_utils_v2.get_device_transfer)
 		'''
 		required_attrs = ['scheduler_name','patience', 'epochs']
 		for attr in required_attrs:
 			assert hasattr(cfg, attr), f"AttributeError: There's no '{attr}' attribute in cfg."
+		assert transfer is not None, "transfer(DeviceTransfer) MUST BE given. (gemini_utils_v2.get_device_transfer)"
 		assert verbose > 0 and verbose < cfg.epochs, f"Logging frequency({verbose}) MUST BE smaller than EPOCHS({cfg.epochs}) and positive value."
 		
 		self.model = model
@@ -79,7 +504,11 @@ class TrainModule():
 			self.model.to(self.cfg.device)
 		else:
 			self.cfg.device = 'cpu'
-		self.es = EarlyStopping(patience=self.cfg.patience)
+		# loader batch -> device 전송 (device_transfer['uint8']이면 Normalize도 device에서 한다.)
+		self.transfer = transfer # model의 channels_last 변환은 get_timm_model(apply_execution_mode)에서 한다.
+		snapshot_cfg = getattr(cfg, 'weight_snapshot', None) or {}
+		snapshot_dir = snapshot_cfg.get('snapshot_dir', None)
+		self.es = EarlyStopping(patience=self.cfg.patience, snapshot=WeightSnapshot(snapshot_cfg.get('mode', 'cpu'), None if snapshot_dir in (None, 'None') else snapshot_dir))
 		### list for plot
 		self.train_losses_for_plot, self.val_losses_for_plot = [], []
 		self.train_acc_for_plot, self.val_acc_for_plot = [], [] # classification
@@ -88,30 +517,72 @@ class TrainModule():
 		self.verbose = verbose
 		# wandb run object
 		self.run = run
-		# Mixed Precision > 'cuda' device 에서만 가능하다.
-		self.scaler = torch.amp.GradScaler(enabled=self.cfg.mixed_precision) # 기본적으로 FP16에 최적화되어 있습니다.
+		# Mixed Precision > CPU는 bfloat16, CUDA는 float16(GradScaler) 또는 bfloat16 autocast를 사용한다.
+		self.precision = precision if precision is not None else get_precision_policy(self.cfg)
+		print(f"⚙️ Precision: {self.precision}")
+		self.scaler = self.precision.grad_scaler() # float16 autocast일 때만 loss scaling을 한다.
+		# VRAM이 부족할 때만 batch마다 torch.cuda.empty_cache()를 호출한다. (호출할 때마다 device 동기화)
+		self.low_memory = getattr(cfg, 'low_memory', False)
+		# gradient accumulation : loader batch 하나를 나눠서 forward/backward할 micro-batch 수
+		self.accumulation = max(1, getattr(cfg, 'grad_accumulation', 1) or 1)
+		# wandb weight/gradient histogram
+		self.histogram = HistogramLogger(self.model, seed=getattr(cfg, 'random_seed', 0), **(getattr(cfg, 'histogram', None) or {}))
+		# checkpoint['every'] epoch마다 학습 상태를 저장하고, cfg.resume이면 최신 checkpoint부터 이어서 학습한다.
+		checkpoint_cfg = getattr(cfg, 'checkpoint', None) or {}
+		checkpoint_dir = checkpoint_cfg.get('checkpoint_dir', None)
+		if checkpoint_dir in (None, 'None') and getattr(cfg, 'submission_dir', None):
+			checkpoint_dir = os.path.join(cfg.submission_dir, 'checkpoints')
+		self.checkpoint_every = checkpoint_cfg.get('every', 0)
+		self.checkpoints = None
+		if self.checkpoint_every > 0 and checkpoint_dir not in (None, 'None'):
+			self.checkpoints = CheckpointManager(checkpoint_dir, checkpoint_name, keep=checkpoint_cfg.get('keep', 3))
+		self.resume = getattr(cfg, 'resume', False)
+		self.done = False
 		self.epoch_counter = 0
+		# augmentation_engine이 tensor인 경우, train batch(uint8)에 device에서 증강 + Normalize를 적용한다.
+		self.batch_augmentation = None
+		# dynamic augmentation 단계별 증강을 한 번만 만들고, DataLoader worker가 생성되기 전에 train 데이터셋에 설치한다.
+		self.augmentation_schedule = AugmentationSchedule(cfg)
+		self.augmentation_schedule.install(self.train_loader.dataset)
+		# progressive resizing : 현재 train 해상도와 batch 크기 (main에서 만든 train_loader는 image_size, batch_size 기준)
+		self.rebatch_loader = rebatch_loader
+		self.image_size = cfg.image_size
+		self.batch_size = cfg.batch_size
+		self.train_data_wait = 0.0
+		# epoch_producer : DataLoader worker가 다음 epoch batch를 미리 만들어 memory-mapped ring buffer에 채운다.
+		producer_cfg = getattr(cfg, 'epoch_producer', None) or {}
+		self.producer = None
+		if producer_cfg.get('enabled', False):
+			ring_dir = producer_cfg.get('ring_dir', None)
+			self.producer = EpochProducer(self, ring_dir=None if ring_dir in (None, 'None') else ring_dir, ring_mb=producer_cfg.get('ring_mb', 2048))
 
-	def training_step(self):
+	def training_step(self, batches=None):
+		'''
+		batches : (train_x, train_y) batch iterable, None이면 self.train_loader (epoch producer 사용 시 ring buffer)
+		'''
 		# set train mode
 		self.model.train()
-		running_loss = 0.0
-		correct = 0 # classification
-		total = 0
-		all_preds = []
-		all_targets = []
+		metrics = MetricAccumulator() # loss, confusion matrix를 device에서 누적한다.
 		
-		for train_x, train_y in self.train_loader: # batch training
-			train_x, train_y = train_x.to(self.cfg.device), train_y.to(self.cfg.device)
+		# 다음 batch를 미리 device로 옮겨 둔다. tensor 엔진은 uint8 batch를 BatchAugmentation에서 증강 + Normalize한다.
+		prefetcher = self.transfer.prefetch(self.train_loader if batches is None else batches, normalize=self.batch_augmentation is None)
+		st = time.time()
+		for train_x, train_y in prefetcher: # batch training
+			if self.batch_augmentation is not None:
+				train_x = self.transfer.to_memory_format(self.batch_augmentation(train_x))
 			
 			self.optimizer.zero_grad() # 이전 gradient 초기화
 
-			# if self.cfg.mixed_precision: 
-				# autocast 컨텍스트 매니저 사용 > # FP16을 사용해 메모리 사용량 감소
-			with torch.amp.autocast(device_type='cuda', enabled=self.cfg.mixed_precision):
-				outputs = self.model(train_x)
-				loss = self.criterion(outputs, train_y)
-			self.scaler.scale(loss).backward()
+			# gradient accumulation : loader batch(logical batch)를 micro-batch로 나눠 forward/backward하고, optimizer는 batch마다 한 번 step한다.
+			for micro_x, micro_y in zip(train_x.chunk(self.accumulation), train_y.chunk(self.accumulation)):
+				# if self.cfg.mixed_precision: 
+					# autocast 컨텍스트 매니저 사용 > # FP16을 사용해 메모리 사용량 감소
+				with self.precision.autocast():
+					outputs = self.model(micro_x)
+					loss = self.criterion(outputs, micro_y)
+				# micro-batch 평균 loss에 크기 비율을 곱해, 누적된 gradient가 logical batch 평균 loss의 gradient가 되게 한다.
+				self.scaler.scale(loss * (micro_y.size(0) / train_y.size(0))).backward()
+				metrics.update(loss, outputs, micro_y) # classification
 			self.scaler.step(self.optimizer)
 			self.scaler.update() # 다음 반복을 위해 스케일 팩터를 업데이트
 
@@ -125,24 +596,17 @@ class TrainModule():
 				self.scheduler.step()
 			elif self.cfg.scheduler_name in ["CosineAnnealingWarmupRestarts"]:
 				self.scheduler.step(self.epoch_counter)
-			
-			running_loss += loss.item() * train_y.size(0) # train_loss 
-			_, predicted = torch.max(outputs, 1) # 가장 확률 높은 클래스 예측 # classification
-			correct += (predicted == train_y).sum().item() # classification
-			total += train_y.size(0) 
-
-			all_preds.extend(predicted.cpu().numpy())
-			all_targets.extend(train_y.cpu().numpy())
 
 			# **********************************************
-			# VRAM 부족 시: 각 배치 처리 후 GPU 캐시 비우기
-			del train_x, train_y, outputs, loss # 사용된 변수 명시적 삭제
-			torch.cuda.empty_cache()           # <-- 여기에 추가
+			# VRAM 부족 시(low_memory): 각 배치 처리 후 GPU 캐시 비우기
+			del train_x, train_y, micro_x, micro_y, outputs, loss # 사용된 변수 명시적 삭제
+			if self.low_memory:
+				torch.cuda.empty_cache()
 			# **********************************************
 			
-		epoch_loss = running_loss / total # average loss of 1 epoch
-		epoch_acc = 100 * correct / total # classification
-		epoch_f1 = f1_score(all_targets, all_preds, average='macro') # classification
+		# data stall : train loop가 batch를 기다린 시간의 비율
+		self.train_data_wait = prefetcher.wait_time / max(time.time() - st, 1e-9)
+		epoch_loss, epoch_acc, epoch_f1 = metrics.compute() # average loss of 1 epoch, classification
 		return epoch_loss, epoch_acc, epoch_f1  # classification		
 	
 	def validation_step(self):
@@ -152,52 +616,59 @@ class TrainModule():
 		else:
 			self.model.eval()  # 평가 모드
 		self.model.eval()  # 평가 모드
-		val_loss = 0
-		correct = 0 # classification
-		total = 0
-		all_preds = []
-		all_targets = []
+		metrics = MetricAccumulator() # loss, confusion matrix를 device에서 누적한다.
 		
 		with torch.no_grad():  # gradient 계산 비활성화
-			for val_x, val_y in self.valid_loader: # batch training
-				val_x, val_y = val_x.to(self.cfg.device), val_y.to(self.cfg.device)
+			for val_x, val_y in self.transfer.prefetch(self.valid_loader): # batch training
 				
 				# if self.cfg.mixed_precision: # FP16을 사용해 메모리 사용량 감소
 				# autocast 컨텍스트 매니저 사용
-				with torch.amp.autocast(device_type='cuda', enabled=self.cfg.mixed_precision):
+				with self.precision.autocast():
 					outputs = self.model(val_x)
 					loss = self.criterion(outputs, val_y)
 				# else:
 				# 	outputs = self.model(val_x)
 				# 	loss = self.criterion(outputs, val_y)
 								
-				val_loss += loss.item() * val_y.size(0)
-				_, predicted = torch.max(outputs, 1) # classification
-				correct += (predicted == val_y).sum().item() # classification
-				total += val_y.size(0)
-
-				all_preds.extend(predicted.cpu().numpy())
-				all_targets.extend(val_y.cpu().numpy())
+				metrics.update(loss, outputs, val_y) # classification
 
 				# **********************************************
-				# VRAM 부족 시: 각 배치 처리 후 GPU 캐시 비우기
+				# VRAM 부족 시(low_memory): 각 배치 처리 후 GPU 캐시 비우기
 				del val_x, val_y, outputs, loss # 사용된 변수 명시적 삭제
-				torch.cuda.empty_cache()           # <-- 여기에 추가
+				if self.low_memory:
+					torch.cuda.empty_cache()
 				# **********************************************
 		
-		epoch_loss = val_loss / total # average loss of 1 epoch
-		epoch_acc = 100 * correct / total # classification
-		epoch_f1 = f1_score(all_targets, all_preds, average='macro') # classification
+		epoch_loss, epoch_acc, epoch_f1 = metrics.compute() # average loss of 1 epoch, classification
 		return epoch_loss, epoch_acc, epoch_f1 # classification
 	
 	def update_transform(self, epoch):
-		train_transforms, _, _, _ = get_augmentation(self.cfg, epoch)
-		if self.cfg.online_augmentation:
-			self.train_loader.dataset.transform = train_transforms[0]
-		else:
-			# ConcatDataset의 경우, 각 sub-dataset의 transform을 업데이트해야 합니다.
-			for i, dataset in enumerate(self.train_loader.dataset.datasets):
-				dataset.transform = train_transforms[i]
+		# tensor 엔진의 device 증강은 학습 중인 epoch 단계를 따른다. (worker 쪽 증강 단계는 prepare_epoch에서 바꾼다.)
+		self.batch_augmentation = self.augmentation_schedule.batch_augmentation(epoch)
+
+	def prepare_epoch(self, epoch):
+		'''
+		train_loader가 epoch의 batch를 만들도록 worker 쪽 상태(증강 단계, train 해상도, shard 순서)를 맞추고 train_loader를 반환한다.
+		epoch producer를 사용하면 producer thread가 학습 중인 epoch보다 앞서서 호출한다.
+		'''
+		# 단계별 증강은 미리 만들어 두었으므로, 공유 epoch 값만 바꾼다. (persistent worker에도 반영된다.)
+		self.augmentation_schedule.set_epoch(epoch)
+		self.update_loader(epoch) # epoch에 따라 train 해상도와 batch 크기를 바꾼다.
+		if hasattr(self.train_loader.dataset, 'set_epoch'): # shard dataset은 epoch마다 다른 순서로 섞는다.
+			self.train_loader.dataset.set_epoch(epoch)
+		return self.train_loader
+
+	def update_loader(self, epoch):
+		# progressive resizing : train 해상도가 바뀌면 batch당 픽셀 수를 맞추도록 train_loader를 다시 만든다.
+		image_size = get_image_size(self.cfg, epoch)
+		if image_size == self.image_size:
+			return
+		self.image_size = image_size
+		batch_size = get_batch_size(self.cfg, epoch)
+		print(f"⚙️ Progressive resizing: image_size {image_size}, batch_size {batch_size}")
+		if batch_size != self.batch_size and self.rebatch_loader is not None:
+			self.train_loader = self.rebatch_loader(self.cfg, self.train_loader, batch_size)
+			self.batch_size = batch_size
 
 	def training_loop(self):
 		# try:
@@ -207,17 +678,28 @@ class TrainModule():
 		self.train_f1_for_plot, self.val_f1_for_plot = [], []
 		self.epoch_counter = 0
 		epoch_timer = []
-		done = False
+		self.done = False
+		if self.resume and self.checkpoints is not None:
+			state = self.checkpoints.load()
+			if state is not None:
+				self.load_state_dict(state)
 		
-		pbar = tqdm(total=self.cfg.epochs)
-		while not done and self.epoch_counter<=self.cfg.epochs:
+		pbar = tqdm(total=self.cfg.epochs, initial=self.epoch_counter)
+		if self.producer is not None:
+			self.producer.start(self.epoch_counter, self.cfg.epochs)
+		while not self.done and self.epoch_counter<=self.cfg.epochs:
+			batches = None
+			if self.producer is not None:
+				batches = self.producer.batches(self.epoch_counter)
+			else:
+				self.prepare_epoch(self.epoch_counter)
 			self.update_transform(self.epoch_counter) # epoch에 따라 증강 기법을 바꾼다.
 			st = time.time()
 			self.epoch_counter += 1
 			
 			# train
 			# train_loss = self.training_step() # regression
-			train_loss, train_acc, train_f1 = self.training_step() # classification
+			train_loss, train_acc, train_f1 = self.training_step(batches) # classification
 			
 			self.train_losses_for_plot.append(train_loss)
 			self.train_acc_for_plot.append(train_acc) # classification
@@ -250,24 +732,16 @@ class TrainModule():
 					'train_accuracy': train_acc,
 					'train_f1': train_f1,
 					'learning_rate': self.optimizer.param_groups[0]['lr'],
+					'train_data_wait': self.train_data_wait,
 				}
 				if self.valid_loader is not None:
 					epoch_log['val_loss'] = val_loss
 					epoch_log['val_accuracy'] = val_acc
 					epoch_log['val_f1'] = val_f1
 
-				# logging weights & gradients
-				all_grads = []
-				all_weights = []
-				for param in self.model.parameters():
-					if param.data is not None:
-						all_weights.append(param.data.cpu().view(-1))
-					if param.grad is not None:
-						all_grads.append(param.grad.cpu().view(-1))
-				if all_grads:
-					epoch_log['weight/all'] = wandb.Histogram(torch.cat(all_weights))
-				if all_weights:
-					epoch_log['weights/all'] = wandb.Histogram(torch.cat(all_weights))
+				# logging weights & gradients : histogram['every'] epoch마다 layer group별 histogram (device에서 계산)
+				if self.histogram.due(self.epoch_counter):
+					epoch_log.update(self.histogram.log())
 				
 				self.run.log(epoch_log, step=self.epoch_counter) # wandb logging
 			if self.epoch_counter == 1 or self.epoch_counter % self.verbose == 0:
@@ -276,17 +750,79 @@ class TrainModule():
 				epoch_timer = [] # reset timer list
 				# print(f"Epoch {self.epoch_counter}/{self.cfg.epochs} [Time: {mean_time_spent:.2f}s], Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.8f}")
 				if self.valid_loader is not None:
-					print(f"Epoch {self.epoch_counter}/{self.cfg.epochs} [Time: {mean_time_spent:.2f}s], Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.8f}\n Train ACC: {train_acc:.2f}%, Validation ACC: {val_acc:.2f}%\n Train F1: {train_f1:.4f}, Validation F1: {val_f1:.4f}") # classification
+					print(f"Epoch {self.epoch_counter}/{self.cfg.epochs} [Time: {mean_time_spent:.2f}s, Data wait: {self.train_data_wait:.1%}], Train Loss: {train_loss:.4f}, Validation Loss: {val_loss:.8f}\n Train ACC: {train_acc:.2f}%, Validation ACC: {val_acc:.2f}%\n Train F1: {train_f1:.4f}, Validation F1: {val_f1:.4f}") # classification
 				else:
-					print(f"Epoch {self.epoch_counter}/{self.cfg.epochs} [Time: {mean_time_spent:.2f}s], Train Loss: {train_loss:.4f} | Train ACC: {train_acc:.2f}% | Train F1: {train_f1:.4f}") # classification
+					print(f"Epoch {self.epoch_counter}/{self.cfg.epochs} [Time: {mean_time_spent:.2f}s, Data wait: {self.train_data_wait:.1%}], Train Loss: {train_loss:.4f} | Train ACC: {train_acc:.2f}% | Train F1: {train_f1:.4f}") # classification
 			if self.valid_loader is not None and self.es(self.model, val_loss, self.epoch_counter):
 				# early stopped 된 경우 if 문 안으로 들어온다.
-				done = True
+				self.done = True
+			if self.checkpoints is not None and not self.done and self.epoch_counter % self.checkpoint_every == 0:
+				self.checkpoints.save(self.state_dict(), self.epoch_counter)
+		if self.producer is not None:
+			self.producer.stop()
+		if self.checkpoints is not None:
+			# 끝난 학습도 저장해 두면, resume 시 학습을 건너뛰고 (early stopping으로 복원된) 최종 weight를 그대로 쓴다.
+			self.done = True
+			self.checkpoints.save(self.state_dict(), self.epoch_counter)
+			self.checkpoints.wait()
 		# except Exception as e:
 		# 	print(e)
 		# 	return False # training loop failed
 		return True # training loop succeed
 		
+	def state_dict(self):
+		'''checkpoint에 저장할 학습 상태 (model, optimizer, scheduler, GradScaler, EarlyStopping, RNG, epoch, plot 기록)'''
+		return {
+			'epoch_counter': self.epoch_counter,
+			'done': self.done,
+			'model_state_dict': self.model.state_dict(),
+			'optimizer_state_dict': self.optimizer.state_dict(),
+			'scheduler_state_dict': self.scheduler.state_dict(),
+			'scaler_state_dict': self.scaler.state_dict(),
+			'early_stopping': {
+				'best_loss': self.es.best_loss,
+				'best_loss_epoch': self.es.best_loss_epoch,
+				'counter': self.es.counter,
+				'status': self.es.status,
+				'best_model_state_dict': self.es.best_model_state_dict,
+			},
+			'rng': {
+				'python': random.getstate(),
+				'numpy': np.random.get_state(),
+				'torch': torch.get_rng_state(),
+				'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+			},
+			'history': {
+				'train_loss': self.train_losses_for_plot, 'val_loss': self.val_losses_for_plot,
+				'train_acc': self.train_acc_for_plot, 'val_acc': self.val_acc_for_plot,
+				'train_f1': self.train_f1_for_plot, 'val_f1': self.val_f1_for_plot,
+			},
+		}
+
+	def load_state_dict(self, state):
+		'''state_dict()로 저장한 학습 상태를 복원한다.'''
+		self.epoch_counter = state['epoch_counter']
+		self.done = state['done']
+		self.model.load_state_dict(state['model_state_dict'])
+		self.optimizer.load_state_dict(state['optimizer_state_dict'])
+		self.scheduler.load_state_dict(state['scheduler_state_dict'])
+		self.scaler.load_state_dict(state['scaler_state_dict'])
+		es = state['early_stopping']
+		self.es.best_loss, self.es.best_loss_epoch, self.es.counter, self.es.status = es['best_loss'], es['best_loss_epoch'], es['counter'], es['status']
+		if es['best_model_state_dict'] is not None:
+			self.es.snapshot.load_state_dict(es['best_model_state_dict'])
+			self.es.has_snapshot = True
+		rng = state['rng']
+		random.setstate(rng['python'])
+		np.random.set_state(rng['numpy'])
+		torch.set_rng_state(rng['torch'])
+		if rng['cuda'] is not None and torch.cuda.is_available():
+			torch.cuda.set_rng_state_all(rng['cuda'])
+		history = state['history']
+		self.train_losses_for_plot, self.val_losses_for_plot = history['train_loss'], history['val_loss']
+		self.train_acc_for_plot, self.val_acc_for_plot = history['train_acc'], history['val_acc']
+		self.train_f1_for_plot, self.val_f1_for_plot = history['train_f1'], history['val_f1']
+
 	def plot_loss(self, show:bool=False, savewandb:bool=True, savedir:str=None):
 		"""loss, accuracy, f1-score에 대한 그래프 시각화 함수
 
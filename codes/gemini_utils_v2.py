@@ -5,7 +5,7 @@ import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
 import torch.nn.init as init
 import timm
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, DataLoader, ConcatDataset, Sampler, RandomSampler, SequentialSampler, BatchSampler, get_worker_info, default_collate
 from types import SimpleNamespace
 import yaml
 import random
@@ -14,8 +14,24 @@ import pandas as pd
 from PIL import Image
 import torch.nn.functional as F
 import math
+import io
+import queue
+import threading
+import contextlib
+import json
+import time
+import socket
+import hashlib
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
 from torch.optim.lr_scheduler import _LRScheduler
 import matplotlib.pyplot as plt
+import albumentations as A
+import cv2
+from torchvision.io import decode_jpeg, decode_image, read_file, ImageReadMode
+from tqdm import tqdm
 
 def load_config(config_path='./config.yaml'):
     """.yaml 설정 파일 읽기
@@ -45,28 +61,1228 @@ def get_generator(cfg):
     g.manual_seed(cfg.random_seed)
     return g
 
+### Image Decoding
+class ImageDecoder:
+    """원본 이미지를 RGB uint8 (H, W, 3) numpy 배열로 디코딩한다.
+
+    image_size가 주어지면 긴 변이 image_size 이상으로 유지되는 가장 작은 JPEG DCT scale(1/2, 1/4, 1/8)로 디코딩한다.
+    원본 scan이 학습 해상도보다 훨씬 크기 때문에, 어차피 LongestMaxSize로 버려질 픽셀을 디코딩하지 않는다.
+    DCT scaling은 pil, cv2 backend만 해당한다. torchvision(decode_jpeg)은 축소 디코딩을 지원하지 않아서
+    원본 해상도로 디코딩한 뒤 같은 크기로 area 축소한다. (출력 크기만 같고 디코딩 시간은 줄지 않는다.)
+    grayscale, CMYK 이미지도 항상 RGB로 변환된다.
+    grayscale=True이면 모든 이미지를 1채널 (H, W, 1)로 디코딩한다. (JPEG은 Y 채널만 디코딩)
+
+    :param str backend: 'pil'(draft mode), 'cv2'(IMREAD_REDUCED_*), 'torchvision'(decode_jpeg), defaults to 'pil'
+    :param int image_size: 축소 디코딩 기준 크기, None이면 원본 해상도로 디코딩, defaults to None
+    :param bool grayscale: 1채널 디코딩 여부, defaults to False
+    """
+    CV2_FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+    CV2_GRAY_FLAGS = {
+        1: cv2.IMREAD_GRAYSCALE,
+        2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+
+    def __init__(self, backend='pil', image_size=None, grayscale=False):
+        assert backend in ['pil', 'cv2', 'torchvision'], f"Unknown decode backend: {backend}"
+        self.backend = backend
+        self.image_size = image_size
+        self.grayscale = grayscale
+        self.channels = 1 if grayscale else 3
+
+    def __repr__(self):
+        return f"{self.backend}-{self.image_size if self.image_size else 'full'}{'-gray' if self.grayscale else ''}"
+
+    def get_scale(self, width, height):
+        """긴 변이 image_size 이상으로 남는 가장 큰 축소 배율"""
+        if self.image_size:
+            for scale in (8, 4, 2):
+                if max(width, height) // scale >= self.image_size:
+                    return scale
+        return 1
+
+    def decode(self, source):
+        """:param source: 이미지 파일 경로(str) 또는 인코딩된 이미지 bytes"""
+        from_path = isinstance(source, str)
+        mode = 'L' if self.grayscale else 'RGB'
+        if self.backend == 'pil':
+            img = Image.open(source if from_path else io.BytesIO(source))
+            scale = self.get_scale(*img.size)
+            if scale > 1:
+                # JPEG 외의 포맷에서는 draft가 무시된다.
+                img.draft(mode, (img.width // scale, img.height // scale))
+            img = np.array(img.convert(mode))
+            return img[..., None] if self.grayscale else img
+        elif self.backend == 'cv2':
+            # 헤더만 읽어서 크기를 확인한다. (디코딩 X)
+            with Image.open(source if from_path else io.BytesIO(source)) as header:
+                scale = self.get_scale(*header.size)
+            # PIL과 동일하게 EXIF orientation은 적용하지 않는다.
+            flags = (self.CV2_GRAY_FLAGS if self.grayscale else self.CV2_FLAGS)[scale] | cv2.IMREAD_IGNORE_ORIENTATION
+            if from_path:
+                img = cv2.imread(source, flags)
+            else:
+                img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+            return img[..., None] if self.grayscale else cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        else:
+            data = read_file(source) if from_path else torch.frombuffer(bytearray(source), dtype=torch.uint8)
+            read_mode = ImageReadMode.GRAY if self.grayscale else ImageReadMode.RGB
+            if data[0] == 0xFF and data[1] == 0xD8: # JPEG SOI marker
+                img = decode_jpeg(data, mode=read_mode)
+            else:
+                img = decode_image(data, mode=read_mode)
+            img = np.ascontiguousarray(img.permute(1, 2, 0).numpy())
+            # decode_jpeg는 DCT scaling을 지원하지 않으므로, 같은 배율로 area 축소한다.
+            scale = self.get_scale(img.shape[1], img.shape[0])
+            if scale > 1:
+                size = (-(-img.shape[1] // scale), -(-img.shape[0] // scale)) # ceil, DCT scaling과 같은 크기
+                img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            return img.reshape(img.shape[0], img.shape[1], self.channels) # cv2.resize는 1채널 축을 없앤다.
+
+def get_source_size(cfg):
+    """디코딩/캐시 해상도(긴 변) : aspect_buckets 사용 시 bucket 직사각형의 긴 변, progressive_resizing 단계 해상도가 image_size보다 길 수 있다."""
+    sizes = get_bucket_sizes(cfg)
+    size = cfg.image_size if sizes is None else max(cfg.image_size, int(sizes.max()))
+    resizing = getattr(cfg, 'progressive_resizing', None)
+    if resizing and resizing['enabled']:
+        scale = max(stage_size for _, stage_size in resizing['schedule']) / cfg.image_size
+        size = max(size, int(math.ceil(size * scale)))
+    return size
+
+def get_image_decoder(cfg):
+    """cfg.decode 설정으로 ImageDecoder를 만든다. 설정이 없으면 PIL 원본 해상도 디코딩."""
+    grayscale = getattr(cfg, 'grayscale', False)
+    if not getattr(cfg, 'decode', None):
+        return ImageDecoder(grayscale=grayscale)
+    return ImageDecoder(
+        backend=cfg.decode['backend'],
+        image_size=get_source_size(cfg) if cfg.decode['reduced'] else None,
+        grayscale=grayscale,
+    )
+
+def _get_variants(df):
+    """가상 샘플의 variant 번호, 원본 행은 -1 (augment_class_imbalance 참고)"""
+    if 'variant' not in df:
+        return np.full(len(df), -1, dtype=np.int64)
+    return df['variant'].fillna(-1).to_numpy(dtype=np.int64)
+
 class ImageDataset(Dataset):
     """커스텀 데이터셋 클래스
 
+    DataFrame 대신 ID/target numpy 배열만 들고 있어서, fork된 DataLoader worker마다
+    pandas 객체를 참조(copy-on-write)하지 않는다.
+
     :param _type_ Dataset: _description_
+    :param cache: get_image_cache()로 만든 이미지 캐시. 캐시에 있는 이미지는 JPEG 디코딩 없이 읽는다, defaults to None
+    :param ImageDecoder decoder: 이미지 디코더, defaults to ImageDecoder()
+    :param ShardReader shards: 설정 시 개별 파일 대신 shard 파일에서 이미지 bytes를 읽는다, defaults to None
+    :param variant_transform: df의 variant 열이 0 이상인 가상 샘플에 transform 전에 적용하는 함수 f(img, variant), defaults to None
+    :param variant_cache: variant_transform 결과를 "{variant}/{ID}" key로 저장하는 캐시 (get_variant_cache), defaults to None
+
+    buckets : sample별 aspect ratio bucket (h, w) 배열 (N, 2), assign_aspect_buckets()가 설정하며 transform에 bucket으로 넘긴다.
     """
-    def __init__(self, df:pd.DataFrame, path, transform=None):
-        self.df = df
+    def __init__(self, df:pd.DataFrame, path, transform=None, cache=None, decoder=None, shards=None, variant_transform=None, variant_cache=None):
+        # 고정 길이 문자열 배열 : python str 객체를 worker마다 복사하지 않는다.
+        self.ids = df['ID'].to_numpy().astype(str)
+        self.targets = df['target'].to_numpy(dtype=np.int64)
+        self.variants = _get_variants(df)
         self.path = path
         self.transform = transform
+        self.cache = cache
+        self.decoder = decoder if decoder is not None else ImageDecoder()
+        self.shards = shards
+        self.variant_transform = variant_transform
+        self.variant_cache = variant_cache
+        self.buckets = None
 
     def __len__(self):
-        return len(self.df)
+        return len(self.ids)
+
+    def _transform(self, transform, img, idx):
+        if self.buckets is None:
+            return transform(image=img)['image']
+        return transform(image=img, bucket=self.buckets[idx])['image']
+
+    def _load(self, name):
+        # 캐시에 없는 이미지는 원본 파일을 디코딩한다.
+        img = self.cache.get(name) if self.cache is not None else None
+        if img is None:
+            if self.shards is not None and name in self.shards:
+                img = self.decoder.decode(self.shards.read(name))
+            else:
+                img = self.decoder.decode(os.path.join(self.path, name))
+            if self.cache is not None:
+                img = self.cache.put(name, img)
+        return img
 
     def __getitem__(self, idx):
-        name, target = self.df.iloc[idx]
-        # img = np.array(Image.open(os.path.join(self.path, name)))
-        img = Image.open(os.path.join(self.path, name))
+        name, target, variant = str(self.ids[idx]), self.targets[idx], int(self.variants[idx])
+        if self.variant_transform is not None and variant >= 0:
+            key = f"{variant}/{name}"
+            img = self.variant_cache.get(key) if self.variant_cache is not None else None
+            if img is None:
+                img = self.variant_transform(self._load(name), variant)
+                if self.variant_cache is not None:
+                    img = self.variant_cache.put(key, img)
+        else:
+            img = self._load(name)
         if self.transform:
-            # img = self.transform(image=img)['image']
-            img = self.transform(image=np.array(img))['image']
+            img = self._transform(self.transform, img, idx)
         return img, target
-    
+
+### Image Cache
+def _file_fingerprint(path):
+    """원본 이미지 파일이 바뀌었는지 확인하기 위한 (파일 크기, 수정 시각)"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class MmapImageCache:
+    """LongestMaxSize 결과를 uint8 memory-mapped 배열로 저장하는 디스크 캐시
+
+    이미지마다 한 번만 디코딩하고, 이후 epoch/fold/run 에서는 memmap slice를 그대로(zero-copy) 읽는다.
+    캐시 파일은 split과 image_size별로 만들어지고, 각 이미지는 ID와 원본 파일 fingerprint로 관리된다.
+    캐시된 이미지는 이미 image_size로 줄어든 상태이므로, AUG 증강도 줄어든 이미지 위에서 적용된다.
+
+    :param str cache_dir: 캐시 파일을 저장할 디렉토리
+    :param str split: 'train' 또는 'test'
+    :param int image_size: LongestMaxSize 기준 크기
+    :param ImageDecoder decoder: 캐시를 만들 때 사용할 디코더, defaults to ImageDecoder()
+    """
+    def __init__(self, cache_dir, split, image_size, decoder=None):
+        self.cache_dir = cache_dir
+        self.image_size = image_size
+        self.decoder = decoder if decoder is not None else ImageDecoder()
+        name = f"{split}_{image_size}{'_gray' if self.decoder.grayscale else ''}"
+        self.data_path = os.path.join(cache_dir, f"{name}.npy")
+        self.index_path = os.path.join(cache_dir, f"{name}.json")
+        self.resize = A.LongestMaxSize(max_size=image_size)
+        self.rows = {} # ID -> memmap row
+        self.shapes = None # row -> (h, w)
+        self._data = None # 프로세스(DataLoader worker)마다 lazy하게 연다.
+
+    def __getstate__(self):
+        # worker로 복사될 때 memmap 핸들은 넘기지 않는다.
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def _load_index(self):
+        if not (os.path.exists(self.index_path) and os.path.exists(self.data_path)):
+            return None
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('image_size') != self.image_size or index.get('decoder') != repr(self.decoder):
+            return None
+        return index
+
+    def _decode(self, path):
+        return self.resize(image=self.decoder.decode(path))['image']
+
+    def build(self, img_dir, ids, num_threads=None):
+        """캐시에 없거나 원본 파일이 바뀐 이미지만 디코딩해서 캐시를 갱신한다.
+
+        :param str img_dir: 원본 이미지 디렉토리
+        :param ids: 캐시할 이미지 ID 목록
+        :param int num_threads: 디코딩 thread 개수, defaults to os.cpu_count()
+        :return MmapImageCache: self
+        """
+        ids = list(dict.fromkeys(ids)) # 중복 제거, 순서 유지
+        fingerprints = {img_id: _file_fingerprint(os.path.join(img_dir, img_id)) for img_id in ids}
+        index = self._load_index()
+        old_rows = {}
+        if index is not None:
+            for row, (img_id, fp) in enumerate(zip(index['ids'], index['fingerprints'])):
+                if fingerprints.get(img_id) == fp:
+                    old_rows[img_id] = row
+        stale = [img_id for img_id in ids if img_id not in old_rows]
+        if index is not None and not stale and len(old_rows) == len(index['ids']):
+            print(f"⚙️ Image cache loaded: {self.data_path} ({len(ids)} images)")
+            self._set_index(index)
+            return self
+
+        print(f"⚙️ Building image cache: {self.data_path} ({len(stale)}/{len(ids)} images to decode)")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        size = self.image_size
+        tmp_path = self.data_path + '.tmp.npy'
+        data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(ids), size, size, self.decoder.channels))
+        shapes = []
+        old_data = np.load(self.data_path, mmap_mode='r') if old_rows else None
+        for row, img_id in enumerate(ids):
+            if img_id in old_rows:
+                h, w = index['shapes'][old_rows[img_id]]
+                data[row, :h, :w] = old_data[old_rows[img_id], :h, :w]
+                shapes.append([h, w])
+            else:
+                shapes.append(None)
+        # cv2, PIL 디코딩은 GIL을 놓기 때문에 thread로 병렬 처리한다.
+        stale_rows = [row for row, shape in enumerate(shapes) if shape is None]
+        with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as pool:
+            decoded = pool.map(lambda row: self._decode(os.path.join(img_dir, ids[row])), stale_rows)
+            for row, img in tqdm(zip(stale_rows, decoded), total=len(stale_rows), desc="Caching images"):
+                h, w = img.shape[:2]
+                data[row, :h, :w] = img
+                shapes[row] = [h, w]
+        data.flush()
+        del data, old_data
+
+        index = {
+            'image_size': size,
+            'decoder': repr(self.decoder),
+            'ids': ids,
+            'shapes': shapes,
+            'fingerprints': [fingerprints[img_id] for img_id in ids],
+        }
+        # 데이터 파일을 먼저 교체하고 index를 교체해야, 중간에 실패해도 index가 틀린 데이터를 가리키지 않는다.
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_index_path, 'w') as f:
+            json.dump(index, f)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.replace(tmp_path, self.data_path)
+        os.replace(tmp_index_path, self.index_path)
+        self._set_index(index)
+        return self
+
+    def _set_index(self, index):
+        self.rows = {img_id: row for row, img_id in enumerate(index['ids'])}
+        self.shapes = np.asarray(index['shapes'], dtype=np.int32)
+        self._data = None
+
+    def get(self, img_id):
+        """캐시된 이미지를 memmap slice(H, W, C)로 반환한다. 캐시에 없으면 None."""
+        row = self.rows.get(img_id)
+        if row is None:
+            return None
+        if self._data is None:
+            # copy-on-write 모드: 디스크 파일은 read-only로 유지하면서 in-place 변환도 허용한다.
+            self._data = np.load(self.data_path, mmap_mode='c')
+        h, w = self.shapes[row]
+        return self._data[row, :h, :w]
+
+    def put(self, img_id, img):
+        """memmap 캐시는 build() 시점에만 채워지므로, 캐시에 없는 이미지는 그대로 반환한다."""
+        return img
+
+class SharedImageCache:
+    """모든 DataLoader worker가 공유하는 shared-memory RAM 이미지 캐시
+
+    LongestMaxSize(image_size) 결과를 고정 크기 slot에 저장하고, byte 예산을 넘으면 가장 오래 사용하지 않은(LRU) slot을 교체한다.
+    shared-memory tensor와 lock은 DataLoader를 만들기 전에 main 프로세스에서 생성되어 worker에 그대로 공유된다.
+    디스크 캐시 없이, 처음 읽힐 때 디코딩된 이미지가 이후 epoch/fold의 모든 worker에서 재사용된다.
+
+    :param ids: 캐시할 수 있는 이미지 ID 목록
+    :param int image_size: LongestMaxSize 기준 크기
+    :param int budget_bytes: 이미지 저장에 사용할 최대 메모리(byte)
+    :param int channels: 이미지 채널 수 (grayscale이면 1), defaults to 3
+    """
+    def __init__(self, ids, image_size, budget_bytes, channels=3):
+        self.image_size = image_size
+        self.channels = channels
+        self.resize = A.LongestMaxSize(max_size=image_size)
+        # ID -> key 검색은 정렬된 고정 길이 문자열 배열에서 searchsorted로 한다.
+        self.keys = np.unique(np.asarray(ids).astype(str))
+        slot_bytes = image_size * image_size * channels
+        n_slots = int(max(1, min(len(self.keys), budget_bytes // slot_bytes)))
+        self.data = torch.empty((n_slots, image_size, image_size, channels), dtype=torch.uint8).share_memory_()
+        self.slot_key = torch.full((n_slots,), -1, dtype=torch.int64).share_memory_() # slot -> key
+        self.slot_hw = torch.zeros((n_slots, 2), dtype=torch.int64).share_memory_()
+        self.slot_tick = torch.zeros((n_slots,), dtype=torch.int64).share_memory_() # 마지막 사용 시각
+        self.key_slot = torch.full((len(self.keys),), -1, dtype=torch.int64).share_memory_() # key -> slot
+        self.tick = torch.zeros((1,), dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+        print(f"⚙️ Shared image cache: {n_slots} slots ({n_slots * slot_bytes / 2**20:.0f} MB) for {len(self.keys)} images")
+
+    def _key(self, img_id):
+        k = int(np.searchsorted(self.keys, img_id))
+        if k < len(self.keys) and self.keys[k] == img_id:
+            return k
+        return None
+
+    def get(self, img_id):
+        """캐시된 이미지의 복사본(H, W, C)을 반환한다. 캐시에 없으면 None."""
+        k = self._key(img_id)
+        if k is None:
+            return None
+        with self.lock:
+            slot = int(self.key_slot[k])
+            if slot < 0:
+                return None
+            self.tick += 1
+            self.slot_tick[slot] = self.tick[0]
+            h, w = self.slot_hw[slot].tolist()
+            # lock을 놓은 뒤 다른 worker가 slot을 교체할 수 있으므로 복사해서 반환한다.
+            return self.data[slot, :h, :w].numpy().copy()
+
+    def put(self, img_id, img):
+        """디코딩된 원본 이미지를 resize해서 캐시에 저장하고, resize된 이미지를 반환한다."""
+        if img.ndim != 3 or img.shape[2] != self.channels:
+            return img # 채널 수가 다른 이미지는 캐시하지 않는다.
+        img = self.resize(image=img)['image']
+        k = self._key(img_id)
+        if k is None:
+            return img
+        h, w = img.shape[:2]
+        with self.lock:
+            if int(self.key_slot[k]) >= 0: # 다른 worker가 먼저 저장한 경우
+                return img
+            free = (self.slot_key < 0).nonzero()
+            slot = int(free[0]) if len(free) else int(torch.argmin(self.slot_tick))
+            evicted = int(self.slot_key[slot])
+            if evicted >= 0:
+                self.key_slot[evicted] = -1
+            self.data[slot, :h, :w] = torch.from_numpy(img)
+            self.slot_hw[slot] = torch.tensor([h, w])
+            self.tick += 1
+            self.slot_tick[slot] = self.tick[0]
+            self.slot_key[slot] = k
+            self.key_slot[k] = slot
+        return img
+
+def get_image_cache(cfg, ids, split='train'):
+    """cfg.image_cache 설정에 따라 이미지 캐시를 만든다.
+
+    :param cfg: 설정 namespace
+    :param ids: 캐시할 이미지 ID 목록
+    :param str split: cfg.data_dir 하위의 이미지 디렉토리 이름, defaults to 'train'
+    :return: 캐시 객체, 캐시를 사용하지 않으면 None
+    """
+    if not getattr(cfg, 'image_cache', None) or cfg.image_cache['mode'] in [None, 'None']:
+        return None
+    mode = cfg.image_cache['mode']
+    if mode == 'mmap':
+        cache = MmapImageCache(cfg.image_cache['cache_dir'], split, get_source_size(cfg), decoder=get_image_decoder(cfg))
+        return cache.build(os.path.join(cfg.data_dir, split), ids)
+    if mode == 'shm':
+        return SharedImageCache(ids, get_source_size(cfg), budget_bytes=int(cfg.image_cache['shm_budget_mb'] * 2**20), channels=get_image_decoder(cfg).channels)
+    raise ValueError(f"Unknown image_cache mode: {mode}")
+
+def get_variant_cache(cfg, df):
+    """df의 가상 샘플(variant >= 0) 결과를 image_size 해상도의 uint8로 저장하는 shared-memory 캐시 (validation TTA view 등)
+
+    :param cfg: 설정 namespace
+    :param pd.DataFrame df: ID, variant 데이터프레임
+    :return SharedImageCache: 가상 샘플이 없으면 None
+    """
+    variants = _get_variants(df)
+    keys = [f"{v}/{img_id}" for img_id, v in zip(df['ID'], variants) if v >= 0]
+    if not keys:
+        return None
+    budget_mb = (getattr(cfg, 'image_cache', None) or {}).get('view_budget_mb', 2048)
+    return SharedImageCache(keys, get_source_size(cfg), budget_bytes=int(budget_mb * 2**20), channels=get_image_decoder(cfg).channels)
+
+### Image Shards
+class ShardReader:
+    """pack_image_shards()로 만든 shard 파일에서 이미지 bytes를 offset으로 읽는다.
+
+    수천 개의 작은 파일 대신 몇 개의 큰 파일만 열어 두고 os.pread로 읽으므로, 파일별 open/seek 지연이 없다.
+
+    :param str shard_dir: shard 디렉토리
+    :param str split: 'train' 또는 'test'
+    """
+    def __init__(self, shard_dir, split):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, f"{split}-index.json"), 'r') as f:
+            index = json.load(f)
+        self.shard_names = index['shards']
+        self.rows = {img_id: row for row, img_id in enumerate(index['ids'])}
+        self.shard = np.asarray(index['shard'], dtype=np.int64)
+        self.offset = np.asarray(index['offset'], dtype=np.int64)
+        self.length = np.asarray(index['length'], dtype=np.int64)
+        self._fds = {} # 프로세스(DataLoader worker)마다 lazy하게 연다.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fds'] = {}
+        return state
+
+    def __contains__(self, img_id):
+        return img_id in self.rows
+
+    def locate(self, img_id):
+        """(shard 번호, offset, length)"""
+        row = self.rows[img_id]
+        return int(self.shard[row]), int(self.offset[row]), int(self.length[row])
+
+    def read_range(self, shard, offset, length):
+        fd = self._fds.get(shard)
+        if fd is None:
+            fd = os.open(os.path.join(self.shard_dir, self.shard_names[shard]), os.O_RDONLY)
+            self._fds[shard] = fd
+        return os.pread(fd, length, offset)
+
+    def read(self, img_id):
+        return self.read_range(*self.locate(img_id))
+
+def pack_image_shards(img_dir, ids, shard_dir, split, shard_size_mb=256):
+    """원본 이미지 파일을 shard_size_mb 크기의 shard 파일 몇 개로 이어 붙이고 offset index를 저장한다.
+
+    :param str img_dir: 원본 이미지 디렉토리
+    :param ids: 묶을 이미지 ID 목록
+    :param str shard_dir: shard를 저장할 디렉토리
+    :param str split: shard 파일 이름 prefix ('train', 'test')
+    :param int shard_size_mb: shard 하나의 최대 크기(MB), defaults to 256
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    ids = list(dict.fromkeys(ids))
+    shard_bytes = shard_size_mb * 2**20
+    index = {'shards': [], 'ids': ids, 'shard': [], 'offset': [], 'length': [], 'fingerprints': []}
+    f, offset = None, 0
+    for img_id in tqdm(ids, desc=f"Packing {split} shards"):
+        path = os.path.join(img_dir, img_id)
+        with open(path, 'rb') as src:
+            data = src.read()
+        if f is None or offset + len(data) > shard_bytes:
+            if f is not None:
+                f.close()
+            index['shards'].append(f"{split}-{len(index['shards']):05d}.bin")
+            f = open(os.path.join(shard_dir, index['shards'][-1] + '.tmp'), 'wb')
+            offset = 0
+        f.write(data)
+        index['shard'].append(len(index['shards']) - 1)
+        index['offset'].append(offset)
+        index['length'].append(len(data))
+        index['fingerprints'].append(_file_fingerprint(path))
+        offset += len(data)
+    if f is not None:
+        f.close()
+    for name in index['shards']:
+        os.replace(os.path.join(shard_dir, name + '.tmp'), os.path.join(shard_dir, name))
+    tmp_index_path = os.path.join(shard_dir, f"{split}-index.json.tmp")
+    with open(tmp_index_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_index_path, os.path.join(shard_dir, f"{split}-index.json"))
+    print(f"⚙️ Packed {len(ids)} images into {len(index['shards'])} shards: {shard_dir}")
+
+def get_image_shards(cfg, ids, split='train'):
+    """cfg.shards 설정 시 shard가 없거나 원본이 바뀌었으면 다시 묶고 ShardReader를 반환한다.
+
+    :param cfg: 설정 namespace
+    :param ids: shard에 포함되어야 하는 이미지 ID 목록
+    :param str split: cfg.data_dir 하위의 이미지 디렉토리 이름, defaults to 'train'
+    :return ShardReader: shard를 사용하지 않으면 None
+    """
+    if not getattr(cfg, 'shards', None) or not cfg.shards['enabled']:
+        return None
+    shard_dir = cfg.shards['shard_dir']
+    img_dir = os.path.join(cfg.data_dir, split)
+    index_path = os.path.join(shard_dir, f"{split}-index.json")
+    ids = list(dict.fromkeys(ids))
+    up_to_date = False
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        packed = dict(zip(index['ids'], index['fingerprints']))
+        up_to_date = all(packed.get(img_id) == _file_fingerprint(os.path.join(img_dir, img_id)) for img_id in ids)
+    if not up_to_date:
+        pack_image_shards(img_dir, ids, shard_dir, split, shard_size_mb=cfg.shards['shard_size_mb'])
+    return ShardReader(shard_dir, split)
+
+class ShardImageDataset(IterableDataset):
+    """shard 파일을 큰 단위로 순차적으로 읽는 학습용 데이터셋
+
+    shard를 chunk_size_mb 크기의 연속 구간(chunk)으로 나누고, epoch마다 chunk 순서를 섞어 worker에 나눠 준다.
+    각 chunk는 한 번의 pread로 읽고, 디코딩한 샘플은 buffer_size 크기의 shuffle buffer에서 무작위로 꺼낸다.
+    batch_size가 설정되면(get_dataloader) 섞은 전체 순서를 batch_size 단위로 나눠 worker가 돌아가며 가져가므로,
+    worker마다 자투리 batch가 생기지 않고 batch 수가 len(loader)와 같다.
+    shard에 없는 ID(offline 증강 이미지 등)는 path의 원본 파일에서 읽는다.
+
+    :param pd.DataFrame df: ID, target 데이터프레임
+    :param ShardReader shards: shard reader
+    :param str path: shard에 없는 이미지를 읽을 디렉토리
+    :param transform: albumentations transform, defaults to None
+    :param ImageDecoder decoder: 이미지 디코더, defaults to ImageDecoder()
+    :param int buffer_size: shuffle buffer 크기, defaults to 512
+    :param int chunk_size_mb: 한 번에 읽을 shard 구간 크기(MB), defaults to 16
+    :param int seed: epoch별 shuffle seed, defaults to 0
+    :param variant_transform: ImageDataset 참고, defaults to None
+    """
+    def __init__(self, df:pd.DataFrame, shards, path, transform=None, decoder=None, buffer_size=512, chunk_size_mb=16, seed=0, variant_transform=None):
+        self.ids = df['ID'].to_numpy().astype(str)
+        self.targets = df['target'].to_numpy(dtype=np.int64)
+        self.variants = _get_variants(df)
+        self.shards = shards
+        self.path = path
+        self.transform = transform
+        self.decoder = decoder if decoder is not None else ImageDecoder()
+        self.variant_transform = variant_transform
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.batch_size = None # DataLoader batch 크기 (get_dataloader에서 설정)
+        self.epoch = torch.zeros(1, dtype=torch.int64).share_memory_() # persistent worker와 공유
+        # (shard, offset) 순서로 정렬한 뒤 chunk_size_mb 단위로 나눈다.
+        located = [(i,) + shards.locate(img_id) for i, img_id in enumerate(self.ids) if img_id in shards]
+        located.sort(key=lambda x: (x[1], x[2]))
+        self.chunks = []
+        chunk_bytes = chunk_size_mb * 2**20
+        for row in located:
+            last = self.chunks[-1] if self.chunks else None
+            if last is None or last[-1][1] != row[1] or row[2] + row[3] - last[0][2] > chunk_bytes:
+                self.chunks.append([row])
+            else:
+                last.append(row)
+        self.loose = [i for i, img_id in enumerate(self.ids) if img_id not in shards]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def set_epoch(self, epoch):
+        """epoch마다 다른 순서로 섞기 위해 TrainModule에서 호출한다."""
+        self.epoch[0] = epoch
+
+    def _load(self, idx, data=None):
+        if data is None:
+            img = self.decoder.decode(os.path.join(self.path, str(self.ids[idx])))
+        else:
+            img = self.decoder.decode(data)
+        if self.variant_transform is not None and self.variants[idx] >= 0:
+            img = self.variant_transform(img, int(self.variants[idx]))
+        if self.transform:
+            img = self.transform(image=img)['image']
+        return img, self.targets[idx]
+
+    def _samples(self, chunks, loose):
+        for chunk in chunks:
+            start = chunk[0][2]
+            end = max(offset + length for _, _, offset, length in chunk)
+            data = self.shards.read_range(chunk[0][1], start, end - start) # chunk 전체를 한 번에 순차 read
+            for idx, _, offset, length in chunk:
+                yield self._load(idx, data[offset - start:offset - start + length])
+        for idx in loose:
+            yield self._load(idx)
+
+    def _worker_batches(self, order, loose, worker_id, num_workers):
+        """전체 순서를 batch_size 단위로 나눈 batch 중 worker_id번째부터 num_workers 간격의 batch를 (chunk 목록, loose 목록)으로 반환한다.
+        DataLoader는 worker를 같은 순서로 돌며 batch를 꺼내므로, 자투리 batch는 전체에서 마지막 하나뿐이다."""
+        rows = [(c, row) for c in order for row in self.chunks[c]] + [(None, (idx,)) for idx in loose]
+        starts = range(worker_id * self.batch_size, len(rows), num_workers * self.batch_size)
+        chunks, loose = [], []
+        for start in starts:
+            # batch 안에서 같은 chunk에 속한 연속 구간은 한 번의 pread로 읽는다.
+            for c, group in itertools.groupby(rows[start:start + self.batch_size], key=lambda x: x[0]):
+                group = [row for _, row in group]
+                if c is None:
+                    loose.extend(row[0] for row in group)
+                else:
+                    chunks.append(group)
+        return chunks, loose
+
+    def __iter__(self):
+        epoch = int(self.epoch[0])
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.chunks))
+        loose = rng.permutation(self.loose)
+        worker = get_worker_info()
+        if worker is not None:
+            rng = np.random.default_rng([self.seed, epoch, worker.id])
+        if self.batch_size: # 모든 worker가 같은 순서를 만들고, batch 단위로 겹치지 않게 나눠 가진다.
+            chunks, loose = self._worker_batches(order, loose, worker.id if worker is not None else 0, worker.num_workers if worker is not None else 1)
+        else:
+            if worker is not None: # 모든 worker가 같은 순서를 만들고, 서로 겹치지 않게 나눠 가진다.
+                order = order[worker.id::worker.num_workers]
+                loose = loose[worker.id::worker.num_workers]
+            chunks = [self.chunks[i] for i in order]
+        buffer = []
+        for sample in self._samples(chunks, loose):
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            j = rng.integers(len(buffer))
+            buffer[j], sample = sample, buffer[j]
+            yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+class MultiViewDataset(ImageDataset):
+    """이미지를 한 번만 디코딩해서 transforms마다 하나씩, K개의 증강 view를 만드는 데이터셋
+
+    (K, C, H, W) view와 target을 반환하고, collate_views로 batch를 (B*K, C, H, W)로 펼친다.
+    한 이미지의 view는 항상 같은 batch에 들어가므로 JPEG 디코딩은 epoch마다 이미지당 한 번이다.
+
+    :param transforms: view별 albumentations transform 리스트
+    :param kwargs: ImageDataset 인자
+    """
+    def __init__(self, df:pd.DataFrame, path, transforms, **kwargs):
+        super().__init__(df, path, transform=None, **kwargs)
+        self.transforms = transforms
+
+    @property
+    def num_views(self):
+        return len(self.transforms)
+
+    def __getitem__(self, idx):
+        img, target = super().__getitem__(idx)
+        views = torch.stack([torch.as_tensor(self._transform(transform, img, idx)) for transform in self.transforms])
+        return views, target
+
+def collate_views(batch):
+    """MultiViewDataset batch (B, K, C, H, W) -> (B*K, C, H, W), target은 view 수만큼 반복한다."""
+    views, targets = default_collate(batch)
+    return views.flatten(0, 1), targets.repeat_interleave(views.shape[1])
+
+def get_train_dataset(cfg, df, path, transforms, cache=None, decoder=None, shards=None, variant_transform=None):
+    """학습용 데이터셋
+
+    - online 증강 : shard를 사용하면 ShardImageDataset, 아니면 ImageDataset
+      (WeightedRandomSampler, aspect ratio bucket은 index 기반이므로 이 경우에는 shard에서 offset으로 읽는 ImageDataset을 사용한다.)
+      multi_view['online_views'] > 1이면 online 증강 view를 K개 만드는 MultiViewDataset
+    - offline 증강 : multi_view 설정 시 증강 기법마다 view를 하나씩 만드는 MultiViewDataset,
+      아니면 증강 기법마다 ImageDataset을 만든 ConcatDataset
+
+    :param transforms: get_augmentation()의 train_transforms
+    """
+    multi_view = getattr(cfg, 'multi_view', None) or {'enabled': False}
+    kwargs = dict(cache=cache, decoder=decoder, shards=shards, variant_transform=variant_transform)
+    if cfg.online_augmentation:
+        if multi_view['enabled'] and multi_view['online_views'] > 1:
+            return MultiViewDataset(df, path, [transforms[0]] * multi_view['online_views'], **kwargs)
+        if shards is not None and not cfg.weighted_random_sampler and get_bucket_sizes(cfg) is None:
+            return ShardImageDataset(
+                df, shards, path, transform=transforms[0], decoder=decoder,
+                buffer_size=cfg.shards['shuffle_buffer'], chunk_size_mb=cfg.shards['chunk_size_mb'], seed=cfg.random_seed,
+                variant_transform=variant_transform
+            )
+        return ImageDataset(df, path, transform=transforms[0], **kwargs)
+    if multi_view['enabled']:
+        return MultiViewDataset(df, path, transforms, **kwargs)
+    return ConcatDataset([ImageDataset(df, path, transform=t, **kwargs) for t in transforms])
+
+### Aspect ratio bucket
+# 정사각형 letterbox 대신, 종횡비가 비슷한 이미지끼리 batch를 만들고 batch마다 bucket 직사각형으로 resize한다.
+# bucket은 픽셀 수가 image_size² 에 가깝도록 만들어서, 흰색 padding 대신 문서 내용에 연산을 사용한다.
+def get_bucket_sizes(cfg):
+    """cfg.aspect_buckets['ratios'](width / height)별 bucket (h, w) 배열 (K, 2), 사용하지 않으면 None"""
+    buckets = getattr(cfg, 'aspect_buckets', None)
+    if not buckets or not buckets['enabled']:
+        return None
+    m = buckets['multiple']
+    ratios = np.asarray(buckets['ratios'], dtype=np.float64)
+    h = np.maximum(m, np.round(cfg.image_size / np.sqrt(ratios) / m) * m)
+    w = np.maximum(m, np.round(cfg.image_size * np.sqrt(ratios) / m) * m)
+    return np.stack([h, w], axis=1).astype(np.int64)
+
+def read_image_size(source):
+    """이미지 헤더만 읽어서 (width, height)를 반환한다. (디코딩 X)
+
+    :param source: 이미지 파일 경로(str) 또는 인코딩된 이미지 bytes
+    """
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        return img.size
+
+_IMAGE_SIZES = {} # (path, ID) -> (width, height), fold/loader마다 헤더를 다시 읽지 않는다.
+
+def get_image_sizes(dataset):
+    """ImageDataset sample별 원본 (width, height) 배열 (N, 2)"""
+    def read(name):
+        if dataset.shards is not None and name in dataset.shards:
+            return read_image_size(dataset.shards.read(name))
+        return read_image_size(os.path.join(dataset.path, name))
+    missing = [str(name) for name in np.unique(dataset.ids) if (dataset.path, str(name)) not in _IMAGE_SIZES]
+    if missing:
+        # PIL 헤더 파싱은 대부분 파일 I/O이므로 thread로 병렬 처리한다.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            for name, size in zip(missing, pool.map(read, missing)):
+                _IMAGE_SIZES[(dataset.path, name)] = size
+    return np.asarray([_IMAGE_SIZES[(dataset.path, str(name))] for name in dataset.ids], dtype=np.float64).reshape(-1, 2)
+
+def assign_aspect_buckets(cfg, dataset):
+    """sample마다 종횡비(log 기준)가 가장 가까운 bucket을 정하고, ImageDataset.buckets에 (h, w)를 설정한다.
+
+    :param cfg: 설정 namespace
+    :param dataset: ImageDataset(MultiViewDataset 포함) 또는 ImageDataset의 ConcatDataset
+    :return np.ndarray: sample별 bucket 번호, bucket을 사용하지 않거나 지원하지 않는 데이터셋(IterableDataset 등)이면 None
+    """
+    sizes = get_bucket_sizes(cfg)
+    datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+    if sizes is None or not all(isinstance(d, ImageDataset) for d in datasets):
+        return None
+    bucket_ratios = np.log(sizes[:, 1] / sizes[:, 0])
+    indices = []
+    for d in datasets:
+        wh = get_image_sizes(d)
+        index = np.abs(np.log(wh[:, 0] / wh[:, 1])[:, None] - bucket_ratios[None, :]).argmin(axis=1)
+        d.buckets = sizes[index]
+        indices.append(index)
+    return np.concatenate(indices)
+
+class AspectRatioBatchSampler(Sampler):
+    """같은 aspect ratio bucket의 sample끼리 batch를 만드는 batch sampler
+
+    sampler가 내는 순서대로 sample을 bucket별로 모으고, bucket이 batch_size만큼 차면 batch로 내보낸다.
+    RandomSampler, WeightedRandomSampler의 무작위성을 그대로 유지하고, 마지막에 남은 sample은 bucket별로 작은 batch가 된다.
+    한 batch의 이미지는 모두 같은 (h, w)이므로 batch마다 크기가 달라도 default_collate로 묶인다.
+
+    :param sampler: index sampler (SequentialSampler, RandomSampler, WeightedRandomSampler 등)
+    :param np.ndarray buckets: sample별 bucket 번호 (assign_aspect_buckets)
+    :param int batch_size: batch 크기
+    """
+    def __init__(self, sampler, buckets, batch_size):
+        self.sampler = sampler
+        self.buckets = buckets
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        groups = {}
+        for idx in self.sampler:
+            bucket = self.buckets[idx]
+            group = groups.setdefault(bucket, [])
+            group.append(idx)
+            if len(group) == self.batch_size:
+                yield groups.pop(bucket)
+        for bucket in sorted(groups):
+            yield groups[bucket]
+
+    def __len__(self):
+        # sampler가 모든 sample을 한 번씩 낸다고 가정한다. (WeightedRandomSampler는 근사값)
+        counts = np.bincount(self.buckets)
+        return int(np.sum(-(-counts // self.batch_size)))
+
+### DataLoader
+def _make_loader(dataset, batch_size, shuffle=False, sampler=None, **kwargs):
+    """batch_sampler가 있으면 DataLoader에 batch_size, shuffle, sampler를 넘기지 않는다. (같이 쓸 수 없다)"""
+    if kwargs.get('batch_sampler') is not None:
+        return DataLoader(dataset, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler, **kwargs)
+
+class ThreadPoolLoader:
+    """worker 프로세스 대신 thread pool에서 batch를 만드는 map-style Dataset loader (dataloader['backend']: 'thread')
+
+    cv2/PIL 디코딩과 대부분의 이미지 연산은 GIL을 풀기 때문에 thread로도 병렬로 처리되고,
+    worker마다 DataFrame, transform, import한 모듈을 복사하지 않으며 worker 시작 비용도 없다.
+    batch 하나를 thread 하나가 만들고, 최대 prefetch개의 batch를 미리 만든다.
+    ordered=False이면 먼저 완성된 batch부터 내보낸다. (순서가 의미 없는 train loader 전용)
+    DataLoader처럼 dataset, batch_sampler 속성과 len()을 제공한다.
+
+    :param dataset: map-style Dataset
+    :param batch_sampler: index list를 내는 batch sampler (BatchSampler, AspectRatioBatchSampler)
+    :param int num_workers: thread 수
+    :param collate_fn: defaults to default_collate
+    :param int prefetch: 미리 만들 batch 수, defaults to 2 * num_workers
+    :param bool ordered: batch_sampler 순서대로 내보낼지, defaults to True
+    :param bool pin_memory: batch를 thread에서 pinned memory로 복사할지 (CUDA 사용 시), defaults to False
+    """
+    def __init__(self, dataset, batch_sampler, num_workers, collate_fn=None, prefetch=None, ordered=True, pin_memory=False):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.num_workers = max(1, num_workers)
+        self.collate_fn = collate_fn or default_collate
+        self.prefetch = prefetch or 2 * self.num_workers
+        self.ordered = ordered
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._pool = None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _load(self, indices):
+        batch = self.collate_fn([self.dataset[i] for i in indices])
+        if self.pin_memory:
+            batch = [t.pin_memory() for t in batch]
+        return batch
+
+    def __iter__(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='loader')
+        batches = iter(self.batch_sampler)
+        pending = deque()
+        def submit():
+            indices = next(batches, None)
+            if indices is not None:
+                pending.append(self._pool.submit(self._load, indices))
+        for _ in range(self.prefetch):
+            submit()
+        try:
+            while pending:
+                if self.ordered:
+                    future = pending.popleft()
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    future = next(f for f in pending if f in done)
+                    pending.remove(future)
+                batch = future.result()
+                submit()
+                yield batch
+        finally:
+            for future in pending: # 중간에 멈추면 시작하지 않은 batch는 취소한다.
+                future.cancel()
+
+    def __del__(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+def _pin_memory(cfg, loader_cfg):
+    """uint8 batch는 DeviceTransfer가 재사용하는 pinned buffer로 복사하므로, DataLoader에서 따로 pin하지 않는다."""
+    return loader_cfg['pin_memory'] and not (getattr(cfg, 'device_transfer', None) or {}).get('uint8', False)
+
+def _dataloader_tuning_key(cfg, dataset, role, batch_size):
+    """호스트와 데이터 파이프라인 설정이 같으면 같은 tuning 결과를 재사용한다."""
+    key = {
+        'host': socket.gethostname(),
+        'cpus': os.cpu_count(),
+        'role': role,
+        'dataset': type(dataset).__name__,
+        'batch_size': batch_size,
+        'image_size': cfg.image_size,
+        'decode': getattr(cfg, 'decode', None),
+        'image_cache': (getattr(cfg, 'image_cache', None) or {}).get('mode'),
+        'shards': (getattr(cfg, 'shards', None) or {}).get('enabled'),
+        'online_augmentation': cfg.online_augmentation,
+        'augmentation_engine': getattr(cfg, 'augmentation_engine', 'albumentations'),
+        'aspect_buckets': get_bucket_sizes(cfg) is not None,
+        'uint8_transfer': (getattr(cfg, 'device_transfer', None) or {}).get('uint8', False),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def benchmark_dataloader(dataset, batch_size, num_batches=200, shuffle=False, sampler=None, **loader_kwargs):
+    """DataLoader 설정 하나의 처리량(batches/sec)을 측정한다.
+
+    두 epoch 동안 num_batches//2 batch씩 읽으면서 두 번째 epoch의 시작 지연(worker 생성)과 정상 상태의 처리량을 측정하고,
+    실제 epoch 길이(len(loader))로 환산한다. persistent_workers의 이점(시작 지연 감소)도 여기에 반영된다.
+
+    :return float: epoch 기준 batches/sec
+    """
+    loader = _make_loader(dataset, batch_size, shuffle, sampler, **loader_kwargs)
+    epoch_batches = len(loader)
+    n = max(2, min(num_batches // 2, epoch_batches))
+    for _ in range(2):
+        st = time.time()
+        it = iter(loader)
+        next(it)
+        startup = time.time() - st
+        st = time.time()
+        count = sum(1 for _ in itertools.islice(it, n - 1))
+        elapsed = time.time() - st
+        del it
+    del loader
+    if count == 0:
+        return 1. / startup
+    return epoch_batches / (startup + elapsed / count * (epoch_batches - 1))
+
+def tune_dataloader(cfg, dataset, batch_size, shuffle=False, sampler=None, num_batches=200, **extra):
+    """num_workers -> prefetch_factor -> persistent_workers 순서로 하나씩 벤치마크해서 가장 빠른 설정을 고른다.
+
+    :param extra: 모든 후보에 공통으로 넘길 DataLoader 인자 (collate_fn, batch_sampler 등)
+    :return dict: DataLoader kwargs와 측정한 batches/sec
+    """
+    cpus = os.cpu_count() or 1
+    base = {'pin_memory': _pin_memory(cfg, cfg.dataloader)}
+    def run(kwargs):
+        bps = benchmark_dataloader(dataset, batch_size, num_batches, shuffle, sampler, **base, **kwargs, **extra)
+        print(f"  {kwargs} -> {bps:.2f} batches/s")
+        return bps
+
+    # 1. num_workers : 처리량이 두 번 연속 떨어지면 더 늘리지 않는다.
+    best, best_bps, drops = {'num_workers': 0}, run({'num_workers': 0}), 0
+    for w in sorted({w for w in [2, 4, 8, 12, 16, 24, 32, 48, 64, cpus] if w <= cpus}):
+        bps = run({'num_workers': w, 'prefetch_factor': 2})
+        if bps > best_bps:
+            best, best_bps, drops = {'num_workers': w, 'prefetch_factor': 2}, bps, 0
+        else:
+            drops += 1
+            if drops == 2:
+                break
+    if best['num_workers'] > 0:
+        # 2. prefetch_factor
+        for pf in [4, 8]:
+            bps = run({**best, 'prefetch_factor': pf})
+            if bps > best_bps:
+                best, best_bps = {**best, 'prefetch_factor': pf}, bps
+        # 3. persistent_workers
+        bps = run({**best, 'persistent_workers': True})
+        if bps > best_bps:
+            best, best_bps = {**best, 'persistent_workers': True}, bps
+    return {**base, **best, 'batches_per_sec': best_bps}
+
+def get_dataloader(cfg, dataset, role, batch_size=None, shuffle=False, sampler=None, tune=True):
+    """DataLoader 생성. cfg.dataloader['num_workers']가 'auto'이면 벤치마크 결과를 호스트/설정별로 캐시해서 사용한다.
+
+    :param cfg: 설정 namespace
+    :param dataset: torch Dataset
+    :param str role: 'train', 'val', 'test' 등 tuning 캐시를 구분하는 이름
+    :param int batch_size: defaults to cfg.batch_size
+    :param bool shuffle: IterableDataset에서는 무시된다, defaults to False
+    :param sampler: torch sampler, 설정 시 shuffle은 무시된다, defaults to None
+    :param bool tune: False면 'auto'여도 벤치마크하지 않는다. (batch로 묶을 수 없는 raw 이미지 loader 등), defaults to True
+    :return DataLoader:
+    """
+    batch_size = batch_size or cfg.batch_size
+    shuffle = shuffle and sampler is None and not isinstance(dataset, IterableDataset)
+    extra = {}
+    if isinstance(dataset, MultiViewDataset):
+        # 이미지 batch_size // K 개 -> view batch 크기는 batch_size와 비슷하게 유지된다.
+        batch_size = max(1, batch_size // dataset.num_views)
+        extra['collate_fn'] = collate_views
+    if isinstance(dataset, ShardImageDataset):
+        # worker들이 batch 단위로 sample을 나눠 가져야 batch 수가 len(loader)와 같다. (scheduler steps_per_epoch)
+        dataset.batch_size = batch_size
+    buckets = assign_aspect_buckets(cfg, dataset)
+    if buckets is not None:
+        # 같은 bucket끼리 batch를 만든다. (predict는 batch_sampler 순서로 예측을 원래 순서로 되돌린다.)
+        index_sampler = sampler if sampler is not None else RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        extra['batch_sampler'] = AspectRatioBatchSampler(index_sampler, buckets, batch_size)
+    loader_cfg = getattr(cfg, 'dataloader', None) or {'num_workers': 8, 'pin_memory': True, 'prefetch_factor': 2, 'persistent_workers': False}
+    if loader_cfg.get('backend', 'process') == 'thread' and not isinstance(dataset, IterableDataset):
+        # shard dataset(IterableDataset)은 worker 정보로 shard를 나누므로 process worker를 그대로 쓴다.
+        num_workers = loader_cfg['num_workers'] if loader_cfg['num_workers'] != 'auto' else (os.cpu_count() or 1)
+        batch_sampler = extra.get('batch_sampler')
+        if batch_sampler is None:
+            index_sampler = sampler if sampler is not None else RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(index_sampler, batch_size, drop_last=False)
+        # predict는 batch 순서로 예측을 모으므로, 순서 없는 전달은 shuffle/sampler를 쓰는 train loader에만 적용한다.
+        ordered = loader_cfg.get('ordered', True) or not (shuffle or sampler is not None)
+        prefetch = max(1, num_workers) * (loader_cfg['prefetch_factor'] or 2)
+        print(f"⚙️ DataLoader({role}): thread pool, {num_workers} threads, prefetch {prefetch} batches, {'ordered' if ordered else 'unordered'}")
+        return ThreadPoolLoader(dataset, batch_sampler, num_workers, collate_fn=extra.get('collate_fn'), prefetch=prefetch,
+                                ordered=ordered, pin_memory=_pin_memory(cfg, loader_cfg))
+    if loader_cfg['num_workers'] != 'auto' or not tune:
+        num_workers = loader_cfg['num_workers'] if loader_cfg['num_workers'] != 'auto' else min(8, os.cpu_count() or 1)
+        kwargs = {'num_workers': num_workers, 'pin_memory': _pin_memory(cfg, loader_cfg)}
+        if kwargs['num_workers'] > 0:
+            kwargs['prefetch_factor'] = loader_cfg['prefetch_factor']
+            kwargs['persistent_workers'] = loader_cfg['persistent_workers']
+        return _make_loader(dataset, batch_size, shuffle, sampler, **kwargs, **extra)
+
+    cache_path = loader_cfg['tune_cache']
+    key = _dataloader_tuning_key(cfg, dataset, role, batch_size)
+    tuned = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            tuned = json.load(f)
+    if key not in tuned:
+        print(f"⚙️ Tuning DataLoader({role}) on {socket.gethostname()} ({os.cpu_count()} cpus)...")
+        tuned[key] = tune_dataloader(cfg, dataset, batch_size, shuffle, sampler, loader_cfg['tune_batches'], **extra)
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(tuned, f, indent=2)
+        os.replace(cache_path + '.tmp', cache_path)
+    kwargs = {k: v for k, v in tuned[key].items() if k != 'batches_per_sec'}
+    print(f"⚙️ DataLoader({role}): {kwargs}, {tuned[key]['batches_per_sec']:.2f} batches/s")
+    return _make_loader(dataset, batch_size, shuffle, sampler, **kwargs, **extra)
+
+def rebatch_dataloader(cfg, loader, batch_size, role='train'):
+    """loader와 같은 dataset, index sampler로 batch_size만 바꾼 DataLoader (progressive resizing)
+
+    :param cfg: 설정 namespace
+    :param DataLoader loader: get_dataloader()로 만든 DataLoader (또는 ThreadPoolLoader)
+    :param int batch_size: 새 batch 크기 (MultiViewDataset은 get_dataloader에서 view 수로 나뉜다.)
+    :param str role: tuning 캐시 이름, defaults to 'train'
+    :return DataLoader:
+    """
+    sampler = None
+    if not isinstance(loader.dataset, IterableDataset):
+        # BatchSampler, AspectRatioBatchSampler 모두 index sampler(RandomSampler, WeightedRandomSampler 등)를 가진다.
+        sampler = loader.batch_sampler.sampler
+    return get_dataloader(cfg, loader.dataset, role, batch_size=batch_size, sampler=sampler)
+
+def count_batches(loader, batch_size):
+    """rebatch_dataloader(cfg, loader, batch_size)가 만들 DataLoader의 batch 수 (DataLoader를 만들지 않고 센다.)"""
+    dataset = loader.dataset
+    if isinstance(dataset, MultiViewDataset): # get_dataloader와 같이 view 수로 나눈다.
+        batch_size = max(1, batch_size // dataset.num_views)
+    if isinstance(dataset, IterableDataset):
+        return math.ceil(len(dataset) / batch_size)
+    if isinstance(loader.batch_sampler, AspectRatioBatchSampler):
+        return len(AspectRatioBatchSampler(loader.batch_sampler.sampler, loader.batch_sampler.buckets, batch_size))
+    return len(BatchSampler(loader.batch_sampler.sampler, batch_size, drop_last=False))
+
+def get_epoch_steps(loader, batch_sizes):
+    """epoch별 train step 수 (progressive resizing으로 batch 크기가 바뀌면 epoch마다 다르다.)
+
+    :param DataLoader loader: get_dataloader()로 만든 train DataLoader (또는 ThreadPoolLoader)
+    :param batch_sizes: epoch별 batch 크기 (gemini_augmentation_v2.get_batch_size)
+    :return list: epoch별 step 수, get_scheduler의 steps_per_epoch로 전달한다.
+    """
+    counts = {batch_size: count_batches(loader, batch_size) for batch_size in set(batch_sizes)}
+    return [counts[batch_size] for batch_size in batch_sizes]
+
+### Device transfer
+class DeviceTransfer:
+    """loader batch를 학습 device로 옮기고, uint8 batch는 device에서 Normalize한다.
+
+    uint8=True이면 loader batch는 uint8 (B, H, W, C)이다. (device_transfer['uint8'])
+    CUDA에서는 shape별로 미리 할당한 pinned buffer ring에 복사한 뒤 non_blocking으로 전송하고,
+    buffer를 다시 쓰기 전에 이전 전송의 CUDA event를 기다린다. (batch마다 pinned memory를 새로 할당하지 않는다.)
+    (B, H, W, C)를 permute한 (B, C, H, W)는 그대로 channels_last memory format이다.
+
+    :param device: 학습 device
+    :param mean: Normalize mean
+    :param std: Normalize std
+    :param bool uint8: loader batch가 uint8 (B, H, W, C)인지, defaults to False
+    :param bool channels_last: 입력을 channels_last memory format으로 반환할지, defaults to False
+    :param int num_buffers: shape별 pinned buffer 개수, defaults to 2
+    :param int prefetch: prefetch()가 미리 device로 옮겨 둘 batch 수, 0이면 prefetch하지 않는다, defaults to 2
+    """
+    def __init__(self, device, mean, std, uint8=False, channels_last=False, num_buffers=2, prefetch=2):
+        self.device = torch.device(device)
+        self.uint8 = uint8
+        self.channels_last = channels_last
+        self.num_buffers = num_buffers
+        self.prefetch_depth = prefetch
+        # [0, 255] 입력 기준 Normalize : (x - mean * 255) / (std * 255)
+        self.mean = torch.tensor(mean, dtype=torch.float32, device=self.device).view(1, -1, 1, 1) * 255
+        self.std = torch.tensor(std, dtype=torch.float32, device=self.device).view(1, -1, 1, 1) * 255
+        self.buffers = {} # (H, W, C), dtype -> [[pinned buffer, CUDA event], ...]
+        self.cursor = {}
+
+    def _pinned_copy(self, x):
+        key = (tuple(x.shape[1:]), x.dtype)
+        ring = self.buffers.setdefault(key, [])
+        i = self.cursor.get(key, 0)
+        self.cursor[key] = (i + 1) % self.num_buffers
+        if i == len(ring):
+            ring.append([torch.empty(x.shape, dtype=x.dtype, pin_memory=True), None])
+        slot = ring[i]
+        if slot[1] is not None:
+            slot[1].synchronize() # 이 buffer의 이전 전송이 끝나야 덮어쓸 수 있다.
+        if slot[0].shape[0] < x.shape[0]: # 더 큰 batch (progressive resizing 등)
+            slot[0] = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        buffer = slot[0][:x.shape[0]]
+        buffer.copy_(x)
+        out = buffer.to(self.device, non_blocking=True)
+        slot[1] = torch.cuda.Event()
+        slot[1].record()
+        return out
+
+    def __call__(self, x, normalize=True):
+        """
+        :param torch.Tensor x: loader batch
+        :param bool normalize: uint8 batch를 Normalize할지 (tensor 엔진은 BatchAugmentation에서 Normalize한다), defaults to True
+        :return torch.Tensor: device의 (B, C, H, W) batch
+        """
+        if not self.uint8:
+            x = x.to(self.device, non_blocking=True)
+        else:
+            x = self._pinned_copy(x) if self.device.type == 'cuda' else x.to(self.device)
+            x = x.permute(0, 3, 1, 2) # (B, H, W, C) -> channels_last (B, C, H, W)
+            if normalize:
+                x = (x.float() - self.mean) / self.std
+        return self.to_memory_format(x)
+
+    def to_memory_format(self, x):
+        if self.channels_last:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x.contiguous()
+
+    def prefetch(self, loader, normalize=True):
+        """loader의 (x, y) batch를 device로 옮기면서 순회하는 DevicePrefetcher"""
+        return DevicePrefetcher(loader, self, normalize=normalize, depth=self.prefetch_depth)
+
+def get_device_transfer(cfg, norm_mean, norm_std):
+    """cfg.device_transfer 설정의 DeviceTransfer
+
+    :param cfg: 설정 namespace
+    :param norm_mean: Normalize mean (gemini_augmentation_v2.get_norm_stats)
+    :param norm_std: Normalize std
+    :return DeviceTransfer:
+    """
+    transfer = getattr(cfg, 'device_transfer', None) or {}
+    return DeviceTransfer(cfg.device, norm_mean, norm_std, uint8=transfer.get('uint8', False), channels_last=transfer.get('channels_last', False),
+                          prefetch=transfer.get('prefetch', 2))
+
+class DevicePrefetcher:
+    """loader를 감싸서, 현재 batch를 계산하는 동안 다음 batch를 미리 device로 옮겨 두는 iterator
+
+    CUDA에서는 다음 batch의 DeviceTransfer를 side stream에서 실행하고, batch를 꺼낼 때 current stream이 side stream을 기다린다.
+    그 외 device에서는 background thread가 loader에서 꺼내 옮긴 batch를 depth개까지 queue에 쌓아 둔다.
+    (epoch producer의 ring buffer처럼 다음 batch를 꺼내면 재사용되는 메모리를 가리키는 batch는 복사해 둔다.)
+    wait_time은 학습 loop가 다음 batch를 기다린 누적 시간(data stall)이다.
+
+    :param loader: (x, y) batch iterable
+    :param DeviceTransfer transfer: batch 전송
+    :param bool normalize: uint8 batch를 Normalize할지, defaults to True
+    :param int depth: 미리 준비할 batch 수, 0이면 prefetch 없이 순서대로 전송한다, defaults to 2
+    """
+    def __init__(self, loader, transfer, normalize=True, depth=2):
+        self.loader = loader
+        self.transfer = transfer
+        self.normalize = normalize
+        self.depth = depth
+        self.wait_time = 0.0
+        self.num_batches = 0
+
+    def _send(self, batch):
+        x, y = batch
+        return self.transfer(x, normalize=self.normalize), y.to(self.transfer.device, non_blocking=True)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            iterator = self._iter_sync()
+        elif self.transfer.device.type == 'cuda':
+            iterator = self._iter_stream()
+        else:
+            iterator = self._iter_thread()
+        st = time.time()
+        for batch in iterator:
+            self.wait_time += time.time() - st
+            self.num_batches += 1
+            yield batch
+            st = time.time()
+
+    def _iter_sync(self):
+        for batch in self.loader:
+            yield self._send(batch)
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream(self.transfer.device)
+        current = torch.cuda.current_stream(self.transfer.device)
+        pending = []
+        for batch in self.loader:
+            with torch.cuda.stream(stream):
+                pending.append(self._send(batch))
+            if len(pending) > self.depth - 1:
+                yield self._consume(pending.pop(0), stream, current)
+        while pending:
+            yield self._consume(pending.pop(0), stream, current)
+
+    def _consume(self, batch, stream, current):
+        current.wait_stream(stream)
+        for t in batch: # side stream에서 할당된 memory를 current stream이 다 쓸 때까지 재사용하지 않는다.
+            t.record_stream(current)
+        return batch
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        def produce():
+            try:
+                for x, y in self.loader:
+                    sent = self._send((x, y))
+                    if sent[0].data_ptr() == x.data_ptr():
+                        sent = (sent[0].clone(), sent[1])
+                    if not self._put(batches, sent, stop):
+                        return
+                self._put(batches, None, stop)
+            except Exception as e:
+                self._put(batches, e, stop)
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    @staticmethod
+    def _put(batches, item, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
 ### Getters
 def get_activation(activation_option):
     ACTIVATIONS = {
@@ -95,6 +1311,7 @@ class TimmWrapper(nn.Module):
             pretrained=cfg.pretrained,
             num_classes=0, global_pool='avg',
             act_layer=get_activation(cfg.timm['activation']),
+            in_chans=1 if getattr(cfg, 'grayscale', False) else 3, # pretrained stem conv는 timm이 채널 방향으로 합쳐서 1채널로 바꾼다.
             **additional_options
         )
         self.dropout = nn.Dropout(p=cfg.custom_layer['drop'])
@@ -144,9 +1361,147 @@ class TimmWrapper(nn.Module):
         x = self.classifier(x)
         return x
 
-def get_timm_model(cfg):
+class CompiledForward:
+    """torch.compile한 model.forward
+
+    호출마다 dynamo suppress_errors(fallback)를 적용해서, warmup 이후 새 입력 shape로 다시 compile할 때도
+    지원하지 않는 연산은 graph 단위로 eager 실행한다. fallback이면 compile된 forward가 예외를 내는 경우 이후 계속 eager forward를 사용한다.
+    새 graph를 compile한 호출은 compile_time에 더하고, log_compiles이면 step 시간과 따로 출력한다.
+
+    :param forward: eager forward (bound method)
+    :param bool fallback: compile 실패 시 eager로 실행할지, defaults to True
+    :param compile_kwargs: torch.compile 인자 (mode, dynamic)
+    """
+    def __init__(self, forward, fallback=True, **compile_kwargs):
+        self.eager = forward
+        self.compiled = torch.compile(forward, **compile_kwargs)
+        self.fallback = fallback
+        self.failed = False
+        self.compile_time = 0.0
+        self.log_compiles = False # warmup이 끝난 뒤 생기는 compile을 출력한다.
+
+    def __call__(self, *args, **kwargs):
+        if self.failed:
+            return self.eager(*args, **kwargs)
+        graphs = torch._dynamo.utils.counters['stats']['unique_graphs']
+        st = time.time()
+        try:
+            with torch._dynamo.config.patch(suppress_errors=self.fallback): # 전역 dynamo 설정은 바꾸지 않는다.
+                out = self.compiled(*args, **kwargs)
+        except Exception as e:
+            if not self.fallback:
+                raise
+            self.failed = True
+            print(f"⚠️ torch.compile failed, falling back to eager execution: {type(e).__name__}: {e}")
+            return self.eager(*args, **kwargs)
+        if torch._dynamo.utils.counters['stats']['unique_graphs'] > graphs:
+            elapsed = time.time() - st
+            self.compile_time += elapsed
+            if self.log_compiles:
+                shape = tuple(args[0].shape) if args and torch.is_tensor(args[0]) else None
+                print(f"⚙️ torch.compile recompiled for input {shape}: compile time {elapsed:.1f}s (total {self.compile_time:.1f}s)")
+        return out
+
+def _execution_shapes(cfg):
+    """compile warmup할 입력 (n, h, w) 목록 (train, eval)
+
+    train은 progressive resizing 단계별 해상도와 그 단계의 micro-batch 크기(scale_batch, grad_accumulation 반영),
+    eval(validation/predict/TTA)은 image_size와 batch_size, batch 1이다. aspect_buckets 사용 시 해상도마다 BucketResize와 같은 bucket 직사각형들이다.
+    batch마다 더 작은 batch(마지막 batch)도 넣어서 dynamo가 batch 차원을 dynamic으로 compile하게 한다.
+    """
+    resizing = getattr(cfg, 'progressive_resizing', None)
+    progressive = bool(resizing and resizing['enabled'])
+    train_sizes = sorted({size for _, size in resizing['schedule']}) if progressive else [cfg.image_size]
+    accumulation = max(1, getattr(cfg, 'grad_accumulation', 1) or 1)
+    buckets = get_bucket_sizes(cfg)
+    def shapes(size):
+        if buckets is None:
+            return [(size, size)]
+        scale = size / cfg.image_size
+        return [tuple(max(1, round(int(s) * scale)) for s in bucket) for bucket in buckets]
+    def micro_batch(size):
+        # gemini_augmentation_v2.get_batch_size와 같은 단계별 batch를 TrainModule처럼 grad_accumulation개로 나눈다.
+        n = max(1, int(cfg.batch_size * (cfg.image_size / size) ** 2)) if progressive and resizing['scale_batch'] else cfg.batch_size
+        return -(-n // accumulation)
+    train = [(n, h, w) for size in train_sizes for h, w in shapes(size)
+             for n in dict.fromkeys([micro_batch(size), max(2, micro_batch(size) // 2)])] # train mode BatchNorm은 batch가 2 이상이어야 한다.
+    evaluation = [(n, h, w) for h, w in shapes(cfg.image_size) for n in dict.fromkeys([cfg.batch_size, 1])]
+    return list(dict.fromkeys(train)), list(dict.fromkeys(evaluation))
+
+def _warmup_compiled(cfg, model, precision=None):
+    """학습/평가에서 실제로 들어올 입력 shape(_execution_shapes)의 dummy batch로 train(forward + backward), eval graph를 미리 compile하고 각 소요 시간을 반환한다.
+
+    BatchNorm 통계, gradient, RNG 상태는 warmup 전으로 되돌린다.
+    """
+    in_chans = 1 if getattr(cfg, 'grayscale', False) else 3
+    memory_format = torch.channels_last if (getattr(cfg, 'device_transfer', None) or {}).get('channels_last', False) else torch.contiguous_format
+    def dummy(n, h, w):
+        return torch.zeros(n, in_chans, h, w, device=cfg.device).contiguous(memory_format=memory_format)
+    train_shapes, eval_shapes = _execution_shapes(cfg)
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    autocast = precision.autocast if precision is not None else contextlib.nullcontext # 학습과 같은 autocast로 compile해야 첫 step에서 다시 compile하지 않는다.
+    times = {}
+    try:
+        with torch.random.fork_rng(devices=[] if torch.device(cfg.device).type != 'cuda' else None):
+            model.train()
+            st = time.time()
+            for shape in train_shapes:
+                with autocast():
+                    loss = model(dummy(*shape)).float().mean()
+                loss.backward()
+            times['train'] = time.time() - st
+            model.eval()
+            st = time.time()
+            with torch.no_grad(), autocast():
+                for shape in eval_shapes:
+                    model(dummy(*shape))
+            times['eval'] = time.time() - st
+    finally:
+        model.load_state_dict(state)
+        model.zero_grad(set_to_none=True)
+        model.train()
+    return times
+
+def apply_execution_mode(cfg, model, precision=None):
+    """cfg.execution 설정에 따라 model을 channels_last로 바꾸고 torch.compile한다. (train, validation, predict 공통)
+
+    channels_last는 device_transfer['channels_last']를 따른다. (model memory format은 여기서만 바꾼다.)
+    compile은 model.forward만 CompiledForward instance 속성으로 바꾸므로 state_dict key가 바뀌지 않고,
+    속성을 지우면 class의 eager forward로 돌아간다. progressive resizing 단계, aspect bucket, 작은 batch shape를 warmup에서 미리 compile해서
+    compile 시간을 step 시간과 따로 출력하고, 그 뒤에 생기는 compile도 CompiledForward가 compile 시간으로 따로 출력한다.
+    fallback이면 model이 살아 있는 동안 graph 단위 compile 오류는 eager로 실행하고, compile된 forward가 실패하면 eager forward로 되돌린다.
+
+    :param cfg: 설정 namespace
+    :param model: torch model
+    :param precision: 학습에서 사용할 PrecisionPolicy (gemini_train_v2.get_precision_policy), defaults to autocast 없음
+    :return: model
+    """
+    if (getattr(cfg, 'device_transfer', None) or {}).get('channels_last', False):
+        model = model.to(memory_format=torch.channels_last)
+    execution = getattr(cfg, 'execution', None) or {}
+    if not execution.get('compile', False):
+        return model
+    fallback = execution.get('fallback', True)
+    mode = execution.get('mode', 'default')
+    dynamic = execution.get('dynamic', None)
+    model.forward = CompiledForward(model.forward, fallback=fallback, mode=None if mode == 'default' else mode, dynamic=None if dynamic == 'None' else dynamic)
+    try:
+        times = _warmup_compiled(cfg, model, precision=precision)
+    except Exception as e: # backward graph compile 오류 등 CompiledForward 밖에서 난 예외
+        if not fallback:
+            raise
+        print(f"⚠️ torch.compile failed, falling back to eager execution: {type(e).__name__}: {e}")
+        model.forward.failed = True
+    if model.forward.failed:
+        del model.forward # compile한 forward를 버리고 eager forward로 되돌린다.
+        return model
+    model.forward.log_compiles = True
+    print(f"⚙️ torch.compile(mode={mode}) compile time: train {times['train']:.1f}s, eval {times['eval']:.1f}s")
+    return model
+
+def get_timm_model(cfg, precision=None):
     if hasattr(cfg, 'custom_layer') and cfg.custom_layer:
-        return TimmWrapper(cfg).to(cfg.device)
+        return apply_execution_mode(cfg, TimmWrapper(cfg).to(cfg.device), precision=precision)
 
     else: # timm 모델 구조 사용
         additional_options = {} # dropout 관련 옵션이 있는 모델의 경우
@@ -158,9 +1513,10 @@ def get_timm_model(cfg):
             pretrained=cfg.pretrained,
             num_classes=17,
             act_layer=get_activation(cfg.timm['activation']),
+            in_chans=1 if getattr(cfg, 'grayscale', False) else 3, # pretrained stem conv는 timm이 채널 방향으로 합쳐서 1채널로 바꾼다.
             **additional_options
         )
-        return model.to(cfg.device)
+        return apply_execution_mode(cfg, model.to(cfg.device), precision=precision)
     
 class FocalLoss(nn.Module):
     def __init__(self, alpha=1, gamma=2, reduction='mean', weight=None):
@@ -298,6 +1654,13 @@ class CosineAnnealingWarmupRestarts(_LRScheduler):
             param_group['lr'] = lr
 
 def get_scheduler(optimizer, cfg, steps_per_epoch):
+    """
+    :param steps_per_epoch: epoch당 step 수, 또는 epoch별 step 수 list (get_epoch_steps, progressive resizing)
+    """
+    if isinstance(steps_per_epoch, (list, tuple)): # OneCycleLR는 epoch별 step 수의 합만큼 step한다.
+        total_steps = sum(steps_per_epoch)
+    else:
+        total_steps = steps_per_epoch * cfg.epochs
     # scheduler_params = {k: v for k, v in vars(cfg.scheduler_params).items()}
     # if cfg.scheduler_name == 'OneCycleLR':
     #     scheduler_params['steps_per_epoch'] = steps_per_epoch
@@ -308,7 +1671,7 @@ def get_scheduler(optimizer, cfg, steps_per_epoch):
         'StepLR': lr_scheduler.StepLR(optimizer, step_size=50, gamma=0.1),
         'ExponentialLR': lr_scheduler.ExponentialLR(optimizer, gamma=0.1),
         'CosineAnnealingLR': lr_scheduler.CosineAnnealingLR(optimizer, T_max=cfg.scheduler_params['T_max'], eta_min=cfg.scheduler_params['min_lr']),
-        'OneCycleLR': lr_scheduler.OneCycleLR(optimizer, max_lr=cfg.scheduler_params['max_lr'], steps_per_epoch=steps_per_epoch, epochs=cfg.epochs),
+        'OneCycleLR': lr_scheduler.OneCycleLR(optimizer, max_lr=cfg.scheduler_params['max_lr'], total_steps=total_steps),
         'ReduceLROnPlateau': lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=cfg.patience-5, min_lr=cfg.scheduler_params['min_lr']),
         'CosineAnnealingWarmupRestarts': CosineAnnealingWarmupRestarts(optimizer, first_cycle_steps=cfg.scheduler_params['T_max'], cycle_mult=1.0, max_lr=cfg.scheduler_params['max_lr'], min_lr=cfg.scheduler_params['min_lr'], warmup_steps=3, gamma=0.9)
     }
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# main과 같이 repo root 기준으로 codes 패키지를 import 한다.
+# gemini_train_v2는 gemini_augmentation_v2를 codes 디렉토리 기준으로 import 하므로 codes도 추가한다.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'codes')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+@pytest.fixture
+def image_dir(tmp_path):
+    """같은 크기의 작은 JPEG 이미지 23장과 ID 목록"""
+    img_dir = tmp_path / 'train'
+    img_dir.mkdir()
+    rng = np.random.default_rng(0)
+    ids = []
+    for i in range(23):
+        img_id = f"{i:03d}.jpg"
+        Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).save(img_dir / img_id)
+        ids.append(img_id)
+    return img_dir, ids
@@ -0,0 +1,75 @@
+import os
+from types import SimpleNamespace
+
+import torch
+import yaml
+
+from codes.gemini_augmentation_v2 import get_norm_stats
+from codes.gemini_train_v2 import TrainModule, get_precision_policy
+from codes.gemini_utils_v2 import get_device_transfer
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codes', 'config_v2.yaml')
+
+class RandomImages(torch.utils.data.Dataset):
+    """index로 고정된 random 이미지 (transform은 TrainModule이 설치하지만 사용하지 않는다.)"""
+    def __init__(self, n, seed):
+        generator = torch.Generator().manual_seed(seed)
+        self.x = torch.randn(n, 3, 16, 16, generator=generator)
+        self.y = torch.randint(0, 4, (n,), generator=generator)
+        self.transform = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, idx):
+        return self.x[idx], self.y[idx]
+
+def make_cfg(checkpoint_dir, resume=False):
+    with open(CONFIG, 'r') as f:
+        cfg = yaml.safe_load(f)
+    cfg.update(device='cpu', epochs=3, patience=10, batch_size=4, image_size=16, mixed_precision=False, scheduler_name='CosineAnnealingLR',
+               checkpoint={'every': 1, 'keep': 10, 'checkpoint_dir': str(checkpoint_dir)}, histogram={'every': 0}, resume=resume)
+    return SimpleNamespace(**cfg)
+
+def make_trainer(cfg):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.ReLU(), torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(8, 4))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=cfg.epochs)
+    train_loader = torch.utils.data.DataLoader(RandomImages(24, 1), batch_size=cfg.batch_size, shuffle=True)
+    valid_loader = torch.utils.data.DataLoader(RandomImages(8, 2), batch_size=cfg.batch_size)
+    return TrainModule(model, torch.nn.CrossEntropyLoss(), optimizer, scheduler, train_loader, valid_loader, cfg, verbose=1,
+                       precision=get_precision_policy(cfg), transfer=get_device_transfer(cfg, *get_norm_stats(cfg)))
+
+def test_resume_from_interrupted_run_matches_full_run(tmp_path):
+    cfg = make_cfg(tmp_path)
+    full = make_trainer(cfg)
+    assert full.training_loop()
+    # epoch 2까지 저장한 뒤 중단된 것처럼 이후 checkpoint를 지운다.
+    for path in full.checkpoints.checkpoints():
+        if not path.endswith('_epoch0001.ckpt') and not path.endswith('_epoch0002.ckpt'):
+            os.remove(path)
+    resumed = make_trainer(make_cfg(tmp_path, resume=True))
+    assert resumed.training_loop()
+    assert resumed.epoch_counter == full.epoch_counter
+    assert resumed.val_losses_for_plot == full.val_losses_for_plot
+    for name, value in full.model.state_dict().items():
+        assert torch.equal(value, resumed.model.state_dict()[name]), name
+    assert resumed.optimizer.param_groups[0]['lr'] == full.optimizer.param_groups[0]['lr']
+
+def test_resume_finished_run_skips_training(tmp_path):
+    full = make_trainer(make_cfg(tmp_path))
+    full.training_loop()
+    resumed = make_trainer(make_cfg(tmp_path, resume=True))
+    resumed.training_loop()
+    assert resumed.done and resumed.epoch_counter == full.epoch_counter
+    for name, value in full.model.state_dict().items():
+        assert torch.equal(value, resumed.model.state_dict()[name]), name
+
+def test_checkpoints_are_rotated(tmp_path):
+    cfg = make_cfg(tmp_path)
+    cfg.checkpoint = {'every': 1, 'keep': 2, 'checkpoint_dir': str(tmp_path)}
+    trainer = make_trainer(cfg)
+    trainer.training_loop()
+    assert [os.path.basename(p) for p in trainer.checkpoints.checkpoints()] == ['train_epoch0003.ckpt', 'train_epoch0004.ckpt']
+    assert not [p for p in os.listdir(tmp_path) if p.endswith('.tmp')]
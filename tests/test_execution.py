@@ -0,0 +1,67 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+import yaml
+
+from codes.gemini_utils_v2 import CompiledForward, _execution_shapes, apply_execution_mode
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codes', 'config_v2.yaml')
+
+@pytest.fixture(autouse=True)
+def reset_dynamo():
+    torch._dynamo.reset() # 같은 forward code의 compile cache, recompile 횟수를 test마다 비운다.
+    yield
+
+def make_cfg(**kw):
+    with open(CONFIG, 'r') as f:
+        cfg = yaml.safe_load(f)
+    cfg.update(device='cpu', image_size=16, batch_size=4, execution={'compile': True, 'mode': 'default', 'dynamic': 'None', 'fallback': True})
+    cfg.update(kw)
+    return SimpleNamespace(**cfg)
+
+def make_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(4, 2))
+
+def test_execution_shapes_cover_progressive_stages_and_buckets():
+    cfg = make_cfg(image_size=64, progressive_resizing={'enabled': True, 'schedule': [[0, 32], [2, 64]], 'scale_batch': True},
+                   aspect_buckets={'enabled': True, 'ratios': [0.5, 1.0], 'multiple': 16})
+    train, evaluation = _execution_shapes(cfg)
+    assert evaluation == [(4, 96, 48), (1, 96, 48), (4, 64, 64), (1, 64, 64)]
+    # 32px 단계는 scale_batch로 batch가 4배가 된다.
+    assert train == [(16, 48, 24), (8, 48, 24), (16, 32, 32), (8, 32, 32), (4, 96, 48), (2, 96, 48), (4, 64, 64), (2, 64, 64)]
+
+def test_execution_shapes_split_train_batch_by_grad_accumulation():
+    train, evaluation = _execution_shapes(make_cfg(batch_size=5, grad_accumulation=2))
+    assert train == [(3, 16, 16), (2, 16, 16)]
+    assert evaluation == [(5, 16, 16), (1, 16, 16)]
+
+def test_compiled_forward_keeps_state_dict_and_global_config():
+    model = make_model()
+    keys = list(model.state_dict())
+    suppress_errors = torch._dynamo.config.suppress_errors
+    model = apply_execution_mode(make_cfg(), model)
+    assert isinstance(model.forward, CompiledForward) and not model.forward.failed
+    assert list(model.state_dict()) == keys
+    assert torch._dynamo.config.suppress_errors == suppress_errors
+
+def test_compile_after_warmup_is_counted_as_compile_time():
+    model = apply_execution_mode(make_cfg(execution={'compile': True, 'mode': 'default', 'dynamic': False, 'fallback': True}), make_model())
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(4, 3, 16, 16)) # warmup한 shape
+        before = model.forward.compile_time
+        model(torch.zeros(4, 3, 24, 24)) # 새 shape -> recompile
+    assert model.forward.compile_time > before
+
+def test_failure_after_warmup_falls_back_to_eager():
+    model = apply_execution_mode(make_cfg(), make_model())
+    def unsupported(*args, **kwargs):
+        raise RuntimeError('unsupported op')
+    model.forward.compiled = unsupported
+    x = torch.randn(2, 3, 16, 16)
+    out = model(x)
+    assert model.forward.failed
+    assert torch.allclose(out, model.forward.eager(x))
@@ -0,0 +1,23 @@
+import torch
+
+from codes.gemini_train_v2 import HistogramLogger
+
+def make_model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(32, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4))
+    model(torch.randn(8, 32)).sum().backward()
+    return model
+
+def test_sampling_does_not_touch_global_rng():
+    logger = HistogramLogger(make_model(), sample_ratio=0.5, seed=1)
+    state = torch.get_rng_state()
+    logger.log()
+    assert torch.equal(state, torch.get_rng_state())
+
+def test_sampling_is_reproducible_with_seed():
+    model = make_model()
+    first = HistogramLogger(model, sample_ratio=0.5, seed=1).log()
+    again = HistogramLogger(model, sample_ratio=0.5, seed=1).log()
+    assert first.keys() == again.keys()
+    for key in first:
+        assert first[key].histogram == again[key].histogram
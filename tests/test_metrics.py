@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import accuracy_score, f1_score
+
+from codes.gemini_train_v2 import MetricAccumulator
+
+@pytest.mark.parametrize('num_classes', [2, 17])
+def test_matches_sklearn(num_classes):
+    generator = torch.Generator().manual_seed(num_classes)
+    metrics = MetricAccumulator()
+    criterion = torch.nn.CrossEntropyLoss()
+    losses, sizes, targets, preds = [], [], [], []
+    for batch_size in [8, 8, 5, 1, 8]:
+        outputs = torch.randn(batch_size, num_classes, generator=generator)
+        y = torch.randint(0, num_classes, (batch_size,), generator=generator)
+        loss = criterion(outputs, y)
+        metrics.update(loss, outputs, y)
+        losses.append(loss.item())
+        sizes.append(batch_size)
+        targets.extend(y.tolist())
+        preds.extend(outputs.argmax(1).tolist())
+    loss, acc, f1 = metrics.compute()
+    assert loss == pytest.approx(np.average(losses, weights=sizes), rel=1e-6)
+    assert acc == pytest.approx(100 * accuracy_score(targets, preds))
+    assert f1 == pytest.approx(f1_score(targets, preds, average='macro'))
+
+def test_loss_sum_is_float32():
+    metrics = MetricAccumulator()
+    outputs = torch.randn(4, 3)
+    metrics.update(torch.tensor(1.0), outputs, torch.zeros(4, dtype=torch.int64))
+    assert metrics.loss_sum.dtype == torch.float32
@@ -0,0 +1,50 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import yaml
+from PIL import Image
+
+from codes.gemini_evalute_v2 import predict
+from codes.gemini_utils_v2 import AspectRatioBatchSampler, ImageDataset, get_dataloader
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codes', 'config_v2.yaml')
+SHAPES = [(40, 20), (20, 40), (30, 30)] # (width, height), bucket이 번갈아 나오도록
+
+def value_transform(image, bucket):
+    """이미지의 (단색) 값을 bucket 크기 1채널 tensor로 채운다."""
+    return {'image': torch.full((1, int(bucket[0]), int(bucket[1])), float(image[0, 0, 0]))}
+
+class ValueClassifier(torch.nn.Module):
+    """입력 평균값 / 10 번째 class를 예측한다."""
+    def forward(self, x):
+        value = x.mean(dim=(1, 2, 3)).round().long() // 10
+        return torch.nn.functional.one_hot(value, 17).float()
+
+@pytest.fixture
+def bucket_dataset(tmp_path):
+    ids = []
+    for i in range(17):
+        img_id = f"{i:03d}.png"
+        Image.new('RGB', SHAPES[i % len(SHAPES)], (10 * i,) * 3).save(tmp_path / img_id)
+        ids.append(img_id)
+    df = pd.DataFrame({'ID': ids, 'target': range(len(ids))})
+    return ImageDataset(df, str(tmp_path), transform=value_transform)
+
+def make_cfg():
+    with open(CONFIG, 'r') as f:
+        cfg = yaml.safe_load(f)
+    cfg.update(device='cpu', image_size=32, batch_size=4, dataloader={'num_workers': 0, 'pin_memory': False},
+               aspect_buckets={'enabled': True, 'ratios': [0.5, 1.0, 2.0], 'multiple': 8})
+    return SimpleNamespace(**cfg)
+
+def test_predict_restores_dataset_order(bucket_dataset):
+    loader = get_dataloader(make_cfg(), bucket_dataset, 'test')
+    assert isinstance(loader.batch_sampler, AspectRatioBatchSampler)
+    batch_order = [idx for batch in loader.batch_sampler for idx in batch]
+    assert batch_order != sorted(batch_order) # bucket별 batch는 dataset 순서와 다르다.
+    preds = predict(ValueClassifier(), loader, 'cpu')
+    assert list(map(int, preds)) == list(range(len(bucket_dataset)))
@@ -0,0 +1,48 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from torch.utils.data import BatchSampler, SequentialSampler
+
+from codes.gemini_augmentation_v2 import get_variant_transform
+from codes.gemini_utils_v2 import ImageDataset, ThreadPoolLoader
+
+def make_transform():
+    cfg = SimpleNamespace(class_imbalance={'aug_class': [0], 'max_samples': 10}, image_size=64, random_seed=42, grayscale=False)
+    return get_variant_transform(cfg)
+
+def image():
+    return np.random.default_rng(0).integers(1, 256, (64, 64, 3), dtype=np.uint8)
+
+def test_same_variant_gives_same_image():
+    transform, img = make_transform(), image()
+    first = transform(img, 3)
+    transform(img, 5)
+    assert np.array_equal(first, transform(img, 3))
+    assert not np.array_equal(first, transform(img, 4))
+
+def test_threaded_matches_serial():
+    transform, img = make_transform(), image()
+    variants = list(range(64)) * 4
+    serial = [transform(img, v) for v in variants]
+    shared = make_transform() # thread들이 같은 객체를 공유한다. (ThreadPoolLoader)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        threaded = list(pool.map(lambda v: shared(img, v), variants))
+    assert all(np.array_equal(a, b) for a, b in zip(serial, threaded))
+
+def test_pickled_copy_matches():
+    transform, img = make_transform(), image()
+    clone = pickle.loads(pickle.dumps(transform)) # process worker
+    assert np.array_equal(transform(img, 7), clone(img, 7))
+
+def test_thread_pool_loader_matches_serial(image_dir):
+    img_dir, ids = image_dir
+    df = pd.DataFrame({'ID': ids * 4, 'target': 0, 'variant': list(range(len(ids) * 4))}) # 모두 가상 샘플
+    dataset = ImageDataset(df, str(img_dir), variant_transform=make_transform())
+    serial = [dataset[i][0] for i in range(len(dataset))]
+    batch_sampler = BatchSampler(SequentialSampler(dataset), batch_size=4, drop_last=False)
+    loader = ThreadPoolLoader(dataset, batch_sampler, num_workers=8)
+    threaded = [img.numpy() for images, _ in loader for img in images]
+    assert all(np.array_equal(a, b) for a, b in zip(serial, threaded))
@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+import torch
+
+from codes.gemini_utils_v2 import ShardImageDataset, ShardReader, pack_image_shards
+
+def make_dataset(tmp_path, image_dir, shard_size_mb=1, chunk_size_mb=16, buffer_size=4, loose=0):
+    img_dir, ids = image_dir
+    shard_dir = tmp_path / 'shards'
+    pack_image_shards(str(img_dir), ids[:len(ids) - loose], str(shard_dir), 'train', shard_size_mb=shard_size_mb)
+    df = pd.DataFrame({'ID': ids, 'target': range(len(ids))}) # target = 원래 index
+    return ShardImageDataset(df, ShardReader(str(shard_dir), 'train'), str(img_dir), buffer_size=buffer_size, chunk_size_mb=chunk_size_mb, seed=7)
+
+def epoch_batches(dataset, batch_size, num_workers, epoch=0):
+    dataset.batch_size = batch_size
+    dataset.set_epoch(epoch)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    return len(loader), [targets.tolist() for _, targets in loader]
+
+@pytest.mark.parametrize('num_workers', [0, 2, 4])
+@pytest.mark.parametrize('loose', [0, 5])
+@pytest.mark.parametrize('chunk_size_mb', [0, 16]) # 0: 이미지마다 chunk 하나
+def test_batch_count_matches_len(tmp_path, image_dir, num_workers, loose, chunk_size_mb):
+    dataset = make_dataset(tmp_path, image_dir, chunk_size_mb=chunk_size_mb, loose=loose)
+    length, batches = epoch_batches(dataset, 4, num_workers)
+    assert length == len(batches) == 6
+    assert [len(b) for b in batches[:-1]] == [4] * 5 and len(batches[-1]) == 3
+    assert sorted(t for b in batches for t in b) == list(range(23))
+
+def test_without_batch_size_each_worker_ends_with_partial_batch(tmp_path, image_dir):
+    dataset = make_dataset(tmp_path, image_dir, chunk_size_mb=0)
+    dataset.batch_size = None
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=4)
+    assert sum(1 for _ in loader) > len(loader)
+
+def test_order_is_deterministic_per_epoch(tmp_path, image_dir):
+    dataset = make_dataset(tmp_path, image_dir, chunk_size_mb=0)
+    _, first = epoch_batches(dataset, 4, 2, epoch=1)
+    _, again = epoch_batches(dataset, 4, 2, epoch=1)
+    _, other = epoch_batches(dataset, 4, 2, epoch=2)
+    assert first == again
+    assert first != other